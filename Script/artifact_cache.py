@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+## @ artifact_cache.py
+#
+# Shared cache of SBL and UEFI payload build artifacts
+#
+# Copyright (c) 2021, Intel Corporation. All rights reserved.<BR>
+# SPDX-License-Identifier: BSD-2-Clause-Patent
+#
+##
+
+import os
+import sys
+import shutil
+import hashlib
+import zipfile
+import argparse
+import tempfile
+import urllib.error
+import urllib.request
+import http.server
+from   test_base   import download_url, unzip_file
+from   build_cache import get_file_hash
+
+
+def get_artifact_key (name, repo, commit, inputs = None):
+    # An artifact is identified by the build step, which includes the arch,
+    # the source repository and commit, and the content of extra input files.
+    items = ['name:%s' % name, 'repo:%s' % repo, 'commit:%s' % commit]
+    for path in inputs or []:
+        items.append ('file:%s:%s' % (os.path.basename (path), get_file_hash (path)))
+    return hashlib.sha256 ('\n'.join (items).encode()).hexdigest()
+
+
+class ArtifactCache:
+    # Artifacts are zip files named by their key. They are looked up in the
+    # local directory first and then on the shared HTTP store, which also
+    # receives the artifacts built after a miss. Without a URL the local
+    # directory is the whole store, it can be a shared network path too.
+    def __init__(self, url = '', local_dir = ''):
+        self.url       = url.rstrip ('/')
+        self.local_dir = local_dir
+
+    def get_local_path (self, key):
+        return os.path.join (self.local_dir, key[:2], key + '.zip')
+
+    def fetch_archive (self, key, zip_file):
+        if self.local_dir and os.path.exists (self.get_local_path (key)):
+            shutil.copyfile (self.get_local_path (key), zip_file)
+            return True
+        if not self.url:
+            return False
+        try:
+            download_url ('%s/%s.zip' % (self.url, key), zip_file)
+        except (urllib.error.URLError, OSError) as ex:
+            if not isinstance (ex, urllib.error.HTTPError) or ex.code != 404:
+                # do not wait for an unreachable store again in this run
+                print ('Artifact store %s is not usable, using local artifacts only: %s' % (self.url, ex))
+                self.url = ''
+            return False
+        if self.local_dir:
+            self.store_local (key, zip_file)
+        return True
+
+    def store_local (self, key, zip_file):
+        path = self.get_local_path (key)
+        if not os.path.exists (os.path.dirname (path)):
+            os.makedirs (os.path.dirname (path), exist_ok = True)
+        shutil.copyfile (zip_file, path + '.%d.tmp' % os.getpid())
+        os.replace (path + '.%d.tmp' % os.getpid(), path)
+
+    def fetch (self, key, outputs, dest = '.'):
+        # Restore the outputs of an artifact under dest, return False on a miss
+        with tempfile.TemporaryDirectory (prefix = 'upld_art_') as tmp_dir:
+            zip_file = os.path.join (tmp_dir, key + '.zip')
+            if not self.fetch_archive (key, zip_file):
+                return False
+            try:
+                with zipfile.ZipFile (zip_file) as zip_ref:
+                    names = sorted(zip_ref.namelist ())
+            except zipfile.BadZipFile:
+                print ('Artifact %s is corrupted !' % key)
+                return False
+            if names != sorted(output.replace (os.sep, '/') for output in outputs):
+                print ('Artifact %s does not contain the expected files !' % key)
+                return False
+            unzip_file (zip_file, dest)
+        return True
+
+    def upload (self, key, outputs):
+        with tempfile.TemporaryDirectory (prefix = 'upld_art_') as tmp_dir:
+            zip_file = os.path.join (tmp_dir, key + '.zip')
+            with zipfile.ZipFile (zip_file, 'w', zipfile.ZIP_DEFLATED) as zip_ref:
+                for output in outputs:
+                    zip_ref.write (output, output.replace (os.sep, '/'))
+            if self.local_dir:
+                self.store_local (key, zip_file)
+            if not self.url:
+                return True
+            with open (zip_file, 'rb') as fd:
+                request = urllib.request.Request ('%s/%s.zip' % (self.url, key), data = fd.read (), method = 'PUT')
+            try:
+                urllib.request.urlopen (request).close ()
+            except (urllib.error.URLError, OSError) as ex:
+                print ('Failed to upload artifact %s: %s' % (key, ex))
+                return False
+        return True
+
+
+class StoreHandler (http.server.SimpleHTTPRequestHandler):
+    # Minimal artifact store for local testing, GET and PUT of flat files
+    def do_PUT (self):
+        name = os.path.basename (self.path)
+        if not name.endswith ('.zip'):
+            self.send_error (400)
+            return
+        data = self.rfile.read (int(self.headers['Content-Length']))
+        path = os.path.join (self.directory, name)
+        with open (path + '.tmp', 'wb') as fd:
+            fd.write (data)
+        os.replace (path + '.tmp', path)
+        self.send_response (201)
+        self.end_headers ()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    sub = parser.add_subparsers (dest='command')
+    cmd = sub.add_parser ('serve', help='Run a local artifact store')
+    cmd.add_argument('-d', dest='store_dir', type=str, help='Store directory', default = '.')
+    cmd.add_argument('-p', dest='port', type=int, help='Port to listen on', default = 8000)
+    args = parser.parse_args()
+
+    if args.command != 'serve':
+        parser.print_help ()
+        return 1
+
+    if not os.path.exists (args.store_dir):
+        os.makedirs (args.store_dir)
+    handler = lambda *hargs: StoreHandler (*hargs, directory = args.store_dir)
+    server  = http.server.ThreadingHTTPServer (('', args.port), handler)
+    print ('Serving artifacts from %s on port %d' % (args.store_dir, args.port))
+    try:
+        server.serve_forever ()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+## @ bench_db.py
+#
+# Universal payload test result history and regression check
+#
+# Copyright (c) 2021, Intel Corporation. All rights reserved.<BR>
+# SPDX-License-Identifier: BSD-2-Clause-Patent
+#
+##
+
+import os
+import sys
+import time
+import sqlite3
+import argparse
+import platform
+import statistics
+
+HISTORY_DB = 'Outputs/bench_history.db'
+
+DB_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+  id          INTEGER PRIMARY KEY AUTOINCREMENT,
+  date        TEXT,
+  host        TEXT,
+  label       TEXT,
+  sbl_commit  TEXT,
+  uefi_commit TEXT
+);
+CREATE TABLE IF NOT EXISTS results (
+  run_id      INTEGER REFERENCES runs(id),
+  name        TEXT,
+  payload     TEXT,
+  profile     TEXT,
+  passed      INTEGER,
+  wall_time   REAL,
+  swap_time   REAL,
+  boot_time   REAL,
+  size        INTEGER
+);
+CREATE INDEX IF NOT EXISTS results_run ON results (run_id);
+'''
+
+
+def open_db (db_file = HISTORY_DB):
+    db_dir = os.path.dirname (db_file)
+    if db_dir and not os.path.exists (db_dir):
+        os.makedirs (db_dir, exist_ok = True)
+    # shards running on the same machine may write at the same time
+    db = sqlite3.connect (db_file, timeout = 30)
+    db.row_factory = sqlite3.Row
+    db.executescript (DB_SCHEMA)
+    return db
+
+
+def record_run (results, sbl_commit = '', uefi_commit = '', label = '', db_file = HISTORY_DB):
+    # Store one test run, results are the per-case dicts from qemu_test
+    with open_db (db_file) as db:
+        cursor = db.execute ('INSERT INTO runs (date, host, label, sbl_commit, uefi_commit) VALUES (?, ?, ?, ?, ?)',
+                             (time.strftime ('%Y-%m-%d %H:%M:%S'), platform.node(), label, sbl_commit, uefi_commit))
+        run_id = cursor.lastrowid
+        for result in results:
+            db.execute ('INSERT INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                        (run_id, result['name'], result['payload'], result.get ('profile', ''), int(result['ret'] == 0),
+                         result['time'], result.get ('swap_time'), result.get ('boot_time'), result.get ('size')))
+    db.close ()
+    return run_id
+
+
+def get_runs (db, host = None, limit = 20):
+    rows = db.execute ('SELECT * FROM runs WHERE host = ? ORDER BY id DESC LIMIT ?', (host or platform.node(), limit)).fetchall ()
+    return list(reversed(rows))
+
+
+def get_samples (db, run_ids, name, field):
+    # Values of a field from the passing results of a test case
+    marks = ','.join ('?' * len(run_ids))
+    rows  = db.execute ('SELECT %s FROM results WHERE passed = 1 AND name = ? AND run_id IN (%s) AND %s IS NOT NULL' % \
+                        (field, marks, field), [name] + list(run_ids)).fetchall ()
+    return [row[0] for row in rows]
+
+
+def is_regression (base, current, threshold, sigma):
+    # The current mean is a regression when it is slower than the baseline
+    # mean by more than the relative threshold, and by more than 'sigma'
+    # standard deviations of the baseline when there are enough samples
+    # to estimate the noise.
+    if not base or not current:
+        return False
+    base_mean = statistics.mean (base)
+    delta     = statistics.mean (current) - base_mean
+    if delta <= base_mean * threshold:
+        return False
+    if len(base) >= 3:
+        return delta > sigma * statistics.stdev (base)
+    return True
+
+
+def compare_runs (db, base_ids, cur_ids, threshold = 0.05, size_threshold = 0.01, sigma = 3.0):
+    # Return [(name, field, base mean, current mean, regression)] for all
+    # test cases present in both run sets.
+    marks = ','.join ('?' * len(cur_ids))
+    names = [row[0] for row in db.execute ('SELECT DISTINCT name FROM results WHERE run_id IN (%s) ORDER BY name' % marks, list(cur_ids))]
+    report = []
+    for name in names:
+        for field in ['boot_time', 'size']:
+            base    = get_samples (db, base_ids, name, field)
+            current = get_samples (db, cur_ids, name, field)
+            if not base or not current:
+                continue
+            if field == 'size':
+                # payload size is deterministic, any growth over the threshold counts
+                regressed = is_regression (base, current, size_threshold, 0)
+            else:
+                regressed = is_regression (base, current, threshold, sigma)
+            report.append ((name, field, statistics.mean (base), statistics.mean (current), regressed))
+    return report
+
+
+def print_trend (db, runs, field = 'boot_time'):
+    names = sorted(set(row[0] for row in db.execute ('SELECT name FROM results')))
+    print ('%-12s %s' % ('Run', ' '.join ('%12s' % name for name in names)))
+    for run in runs:
+        values = []
+        for name in names:
+            row = db.execute ('SELECT passed, %s FROM results WHERE run_id = ? AND name = ?' % field, (run['id'], name)).fetchone ()
+            if row is None:
+                values.append ('%12s' % '')
+            elif not row[0]:
+                values.append ('%12s' % 'FAILED')
+            elif row[1] is None:
+                values.append ('%12s' % '-')
+            else:
+                values.append ('%12.2f' % row[1] if field != 'size' else '%12d' % row[1])
+        print ('%-12s %s' % ('%d %s' % (run['id'], (run['sbl_commit'] or '')[:6]), ' '.join (values)))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-d', dest='db_file', type=str, help='History database file', default = HISTORY_DB)
+    sub = parser.add_subparsers (dest='command')
+
+    cmd = sub.add_parser ('trend', help='Show a field of the recent runs of this host')
+    cmd.add_argument('-n', dest='count', type=int, help='Number of runs to show', default = 20)
+    cmd.add_argument('-f', dest='field', choices=['boot_time', 'swap_time', 'wall_time', 'size'], default = 'boot_time')
+
+    cmd = sub.add_parser ('compare', help='Compare recent runs against a baseline run')
+    cmd.add_argument('-b', dest='baseline', type=int, help='Baseline run id, default is the run before the compared runs', default = 0)
+    cmd.add_argument('-n', dest='count', type=int, help='Number of runs on each side of the comparison', default = 1)
+    cmd.add_argument('-t', dest='threshold', type=float, help='Relative boot time threshold', default = 0.05)
+    cmd.add_argument('-s', dest='size_threshold', type=float, help='Relative payload size threshold', default = 0.01)
+    args = parser.parse_args()
+
+    if not os.path.exists (args.db_file):
+        print ('No test history in %s !' % args.db_file)
+        return 1
+
+    db = open_db (args.db_file)
+    if args.command == 'compare':
+        runs = get_runs (db, limit = 1000)
+        ids  = [run['id'] for run in runs]
+        cur_ids = ids[-args.count:]
+        if args.baseline:
+            if args.baseline not in ids:
+                print ('Run %d is not a run of this host !' % args.baseline)
+                return 1
+            end = ids.index (args.baseline) + 1
+        else:
+            end = len(ids) - len(cur_ids)
+        base_ids = ids[max(0, end - args.count):end]
+        if not base_ids or not cur_ids:
+            print ('Not enough runs to compare !')
+            return 1
+
+        print ('Baseline runs %s, compared runs %s\n' % (base_ids, cur_ids))
+        print ('%-12s %-10s %12s %12s %8s' % ('Test', 'Field', 'Baseline', 'Current', 'Change'))
+        failed = 0
+        for name, field, base, current, regressed in compare_runs (db, base_ids, cur_ids, args.threshold, args.size_threshold):
+            change = (current - base) * 100.0 / base if base else 0
+            print ('%-12s %-10s %12.2f %12.2f %+7.1f%% %s' % (name, field, base, current, change, 'REGRESSION' if regressed else ''))
+            failed += regressed
+        if failed:
+            print ('\n%d regressions found !' % failed)
+            return 1
+        print ('\nNo regression found.')
+    else:
+        print_trend (db, get_runs (db, limit = getattr (args, 'count', 20)), getattr (args, 'field', 'boot_time'))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
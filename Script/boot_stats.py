@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+## @ boot_stats.py
+#
+# Recent boot durations and adaptive boot timeouts
+#
+# Copyright (c) 2021, Intel Corporation. All rights reserved.<BR>
+# SPDX-License-Identifier: BSD-2-Clause-Patent
+#
+##
+
+import os
+import sys
+import json
+import argparse
+import contextlib
+if os.name == 'nt':
+    import msvcrt
+else:
+    import fcntl
+
+STATS_FILE      = 'Outputs/boot_stats.json'
+DEFAULT_TIMEOUT = 8
+KEEP_SAMPLES    = 20
+MIN_SAMPLES     = 3
+
+
+@contextlib.contextmanager
+def lock_stats (stats_file):
+    # test cases running in parallel update the same stats file
+    stats_dir = os.path.dirname (stats_file)
+    if stats_dir and not os.path.exists (stats_dir):
+        os.makedirs (stats_dir, exist_ok = True)
+    with open (stats_file + '.lock', 'w') as fd:
+        if os.name == 'nt':
+            # LK_LOCK gives up after 10 seconds, boots hold the lock briefly
+            msvcrt.locking (fd.fileno(), msvcrt.LK_LOCK, 1)
+        else:
+            fcntl.flock (fd, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if os.name == 'nt':
+                fd.seek (0)
+                msvcrt.locking (fd.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock (fd, fcntl.LOCK_UN)
+
+
+def load_boot_stats (stats_file = STATS_FILE):
+    if not os.path.exists (stats_file):
+        return {}
+    try:
+        with open (stats_file) as fd:
+            return json.load (fd)
+    except ValueError:
+        return {}
+
+
+def add_boot_time (pld_name, profile, boot_time, stats_file = STATS_FILE, keep = KEEP_SAMPLES):
+    with lock_stats (stats_file):
+        stats   = load_boot_stats (stats_file)
+        samples = stats.setdefault ('%s/%s' % (pld_name, profile), [])
+        samples.append (round(boot_time, 3))
+        del samples[:-keep]
+        with open (stats_file + '.tmp', 'w') as fd:
+            json.dump (stats, fd, indent = 2, sort_keys = True)
+        os.replace (stats_file + '.tmp', stats_file)
+
+
+def get_percentile (samples, percentile):
+    # nearest rank percentile
+    samples = sorted(samples)
+    rank    = max(1, -(-len(samples) * percentile // 100))
+    return samples[int(rank) - 1]
+
+
+def get_adaptive_timeout (pld_name, profile, floor = 3, ceiling = 60, percentile = 95, margin = 0.25,
+                          stats_file = STATS_FILE):
+    # The timeout is a high percentile of the recent passing boots of the
+    # payload with the same QEMU profile, plus a relative margin and one
+    # second, kept within [floor, ceiling]. Without enough history the
+    # previous fixed timeout is used.
+    samples = load_boot_stats (stats_file).get ('%s/%s' % (pld_name, profile), [])
+    if len(samples) < MIN_SAMPLES:
+        timeout = DEFAULT_TIMEOUT
+    else:
+        timeout = get_percentile (samples, percentile) * (1 + margin) + 1
+    return max(floor, min(ceiling, timeout))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-f', dest='stats_file', type=str, help='Boot stats file', default = STATS_FILE)
+    parser.add_argument('-p', dest='percentile', type=int, help='Percentile of the boot durations', default = 95)
+    args = parser.parse_args()
+
+    stats = load_boot_stats (args.stats_file)
+    print ('%-24s %8s %10s %10s %10s' % ('Payload/Profile', 'Samples', 'Min(s)', 'P%d(s)' % args.percentile, 'Timeout(s)'))
+    for key in sorted(stats):
+        samples = stats[key]
+        pld_name, profile = key.split ('/')
+        timeout = get_adaptive_timeout (pld_name, profile, percentile = args.percentile, stats_file = args.stats_file)
+        print ('%-24s %8d %10.2f %10.2f %10.2f' % (key, len(samples), min(samples), get_percentile (samples, args.percentile), timeout))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+## @ build_cache.py
+#
+# Content addressed cache for payload build outputs
+#
+# Copyright (c) 2021, Intel Corporation. All rights reserved.<BR>
+# SPDX-License-Identifier: BSD-2-Clause-Patent
+#
+##
+
+import os
+import json
+import shutil
+import hashlib
+
+
+def get_file_hash (path, hash_type = 'sha256'):
+    digest = hashlib.new (hash_type)
+    with open (path, 'rb') as fd:
+        for chunk in iter(lambda: fd.read (0x100000), b''):
+            digest.update (chunk)
+    return digest.hexdigest()
+
+
+class BuildCache:
+    # Build outputs are stored once under 'objects' by their content hash.
+    # Each build step has a manifest named by the hash of all its inputs,
+    # which maps the step outputs to the stored objects.
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.obj_dir   = os.path.join (cache_dir, 'objects')
+        self.man_dir   = os.path.join (cache_dir, 'manifests')
+
+    def get_key (self, name, inputs):
+        # inputs can be file paths, directory paths or plain strings
+        digest = hashlib.sha256 ()
+        digest.update (name.encode())
+        for item in inputs:
+            item = str(item)
+            if os.path.isfile (item):
+                digest.update (('file:%s:%s' % (item, get_file_hash (item))).encode())
+            elif os.path.isdir (item):
+                for root, dirs, files in os.walk (item):
+                    dirs.sort ()
+                    for file in sorted(files):
+                        path = os.path.join (root, file)
+                        digest.update (('file:%s:%s' % (path, get_file_hash (path))).encode())
+            else:
+                digest.update (('str:%s' % item).encode())
+        return digest.hexdigest()
+
+    def get_manifest_path (self, key):
+        return os.path.join (self.man_dir, key[:2], key + '.json')
+
+    def restore (self, key, outputs):
+        man_path = self.get_manifest_path (key)
+        if not os.path.exists (man_path):
+            return False
+
+        with open (man_path) as fd:
+            manifest = json.load (fd)
+        if sorted(manifest.keys()) != sorted(outputs):
+            return False
+        for output in outputs:
+            if not os.path.exists (os.path.join (self.obj_dir, manifest[output])):
+                return False
+
+        for output in outputs:
+            out_dir = os.path.dirname (output)
+            if out_dir and not os.path.exists (out_dir):
+                os.makedirs (out_dir)
+            shutil.copyfile (os.path.join (self.obj_dir, manifest[output]), output)
+        return True
+
+    def store (self, key, outputs):
+        if not os.path.exists (self.obj_dir):
+            os.makedirs (self.obj_dir)
+
+        manifest = {}
+        for output in outputs:
+            obj_hash = get_file_hash (output)
+            obj_path = os.path.join (self.obj_dir, obj_hash)
+            if not os.path.exists (obj_path):
+                shutil.copyfile (output, obj_path + '.tmp')
+                os.replace (obj_path + '.tmp', obj_path)
+            manifest[output] = obj_hash
+
+        man_path = self.get_manifest_path (key)
+        if not os.path.exists (os.path.dirname (man_path)):
+            os.makedirs (os.path.dirname (man_path))
+        with open (man_path + '.tmp', 'w') as fd:
+            json.dump (manifest, fd, indent = 2)
+        os.replace (man_path + '.tmp', man_path)
+
+
+def run_cached (cache, name, inputs, outputs, build_func):
+    # Restore the outputs of a build step from the cache, or run the step
+    # and store its outputs when there is no matching cache entry.
+    if cache is None:
+        return build_func ()
+
+    key = cache.get_key (name, inputs)
+    if cache.restore (key, outputs):
+        print ('Restored %s from build cache' % name)
+        return 0
+
+    ret = build_func ()
+    if ret == 0:
+        cache.store (key, outputs)
+    return ret
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+## @ console_replay.py
+#
+# Record the console output of a QEMU run and replay it in place of QEMU
+#
+# Copyright (c) 2021, Intel Corporation. All rights reserved.<BR>
+# SPDX-License-Identifier: BSD-2-Clause-Patent
+#
+##
+
+import os
+import sys
+import gzip
+import json
+import time
+import argparse
+
+# A recording is a JSON line file, gzip compressed when it ends with .gz.
+# The first line describes the run, then each chunk of console output has
+# the time it was read relative to the QEMU start, and the last line tells
+# whether QEMU exited by itself or was stopped by the test.
+RECORD_VERSION = 1
+
+
+def open_recording (rec_file, mode):
+    if rec_file.endswith ('.gz'):
+        return gzip.open (rec_file, mode + 't')
+    return open (rec_file, mode)
+
+
+class ConsoleRecorder:
+    def __init__(self, rec_file, cmd):
+        rec_dir = os.path.dirname (rec_file)
+        if rec_dir and not os.path.exists (rec_dir):
+            os.makedirs (rec_dir, exist_ok = True)
+        self.fd = open_recording (rec_file, 'w')
+        self.write ({'version' : RECORD_VERSION, 'cmd' : [str(arg) for arg in cmd]})
+
+    def write (self, record):
+        self.fd.write (json.dumps (record) + '\n')
+
+    def add (self, stamp, data):
+        # latin-1 maps every byte to one character, so any output round trips
+        self.write ({'t' : round(stamp, 6), 'data' : data.decode ('latin-1')})
+
+    def close (self, stamp, retcode, killed):
+        self.write ({'t' : round(stamp, 6), 'exit' : retcode, 'killed' : killed})
+        self.fd.close ()
+
+
+def load_recording (rec_file):
+    with open_recording (rec_file, 'r') as fd:
+        records = [json.loads (line) for line in fd if line.strip ()]
+    if not records or records[0].get ('version') != RECORD_VERSION:
+        raise Exception ('%s is not a console recording !' % rec_file)
+    return records[1:]
+
+
+def replay (rec_file, speed = 1.0, out = None):
+    # Write the recorded output with its original timing divided by speed,
+    # speed 0 writes it all at once. A run that was stopped by the test
+    # keeps waiting until it is stopped again, like QEMU would.
+    out     = out or sys.stdout.buffer
+    records = load_recording (rec_file)
+    start   = time.monotonic()
+    for record in records:
+        if speed:
+            delay = start + record['t'] / speed - time.monotonic()
+            if delay > 0:
+                time.sleep (delay)
+        if 'data' in record:
+            out.write (record['data'].encode ('latin-1'))
+            out.flush ()
+        elif record.get ('killed'):
+            while True:
+                time.sleep (3600)
+        else:
+            return record['exit'] or 0
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('rec_file', type=str, help='Console recording')
+    parser.add_argument('-s', '--speed', dest='speed', type=float, default = 1.0, help='Replay speed factor, 0 for no delay')
+    args = parser.parse_args()
+
+    try:
+        return replay (args.rec_file, args.speed)
+    except (BrokenPipeError, KeyboardInterrupt):
+        return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,296 @@
+#!/usr/bin/env python
+## @ fat_image.py
+#
+# Create FAT disk images from a directory for QEMU boot tests
+#
+# Copyright (c) 2021, Intel Corporation. All rights reserved.<BR>
+# SPDX-License-Identifier: BSD-2-Clause-Patent
+#
+##
+
+import os
+import sys
+import struct
+import hashlib
+import argparse
+import subprocess
+from   upld_elf import copy_file_range
+from   toolchain import get_tool
+
+SECTOR_SIZE   = 512
+PART_START    = 2048
+ROOT_ENTRIES  = 512
+SHORT_CHARS   = set("ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789!#$%&'()-@^_`{}~")
+# fixed time stamp keeps images of the same content identical
+FAT_DATE      = ((2021 - 1980) << 9) | (1 << 5) | 1
+FAT_TIME      = 0
+
+
+class FatNode:
+    def __init__(self, path, name, is_dir):
+        self.path      = path
+        self.name      = name
+        self.is_dir    = is_dir
+        self.size      = 0 if is_dir else os.path.getsize (path)
+        self.children  = []
+        self.cluster   = 0
+        self.clusters  = 0
+        self.short     = b''
+        self.entries   = b''
+
+
+def get_dir_hash (src_dir):
+    # Hash of all file names and contents under a directory
+    digest = hashlib.sha256 ()
+    for root, dirs, files in os.walk (src_dir):
+        dirs.sort ()
+        for name in sorted(dirs + files):
+            path = os.path.join (root, name)
+            rel  = os.path.relpath (path, src_dir).replace (os.sep, '/')
+            if os.path.isdir (path):
+                digest.update (('dir:%s\n' % rel).encode())
+                continue
+            digest.update (('file:%s:%d\n' % (rel, os.path.getsize (path))).encode())
+            with open (path, 'rb') as fd:
+                for chunk in iter(lambda: fd.read (0x100000), b''):
+                    digest.update (chunk)
+    return digest.hexdigest()
+
+
+def build_tree (path, name = ''):
+    node = FatNode (path, name, True)
+    for entry in sorted(os.listdir (path)):
+        sub_path = os.path.join (path, entry)
+        if os.path.isdir (sub_path):
+            node.children.append (build_tree (sub_path, entry))
+        elif os.path.isfile (sub_path):
+            node.children.append (FatNode (sub_path, entry, False))
+    return node
+
+
+def get_short_name (name, used):
+    # Return the 11 byte 8.3 name and whether a long name entry is needed
+    if name.count ('.') <= 1 and not name.startswith ('.'):
+        base, _, ext = name.partition ('.')
+        if 0 < len(base) <= 8 and len(ext) <= 3 and set(base + ext) <= SHORT_CHARS:
+            short = ('%-8s%-3s' % (base, ext)).encode()
+            if short not in used:
+                return short, False
+
+    upper = name.upper ().lstrip ('.')
+    base, dot, ext = upper.rpartition ('.')
+    if not dot:
+        base, ext = ext, ''
+    base = ''.join(ch if ch in SHORT_CHARS else '_' for ch in base if ch not in ' .')
+    ext  = ''.join(ch if ch in SHORT_CHARS else '_' for ch in ext if ch != ' ')[:3]
+    for idx in range(1, 1000000):
+        tail  = '~%d' % idx
+        short = ('%-8s%-3s' % (base[:8 - len(tail)] + tail, ext)).encode()
+        if short not in used:
+            return short, True
+    raise Exception ('Too many similar file names for %s !' % name)
+
+
+def get_lfn_entries (name, short):
+    checksum = 0
+    for byte in short:
+        checksum = (((checksum & 1) << 7) + (checksum >> 1) + byte) & 0xFF
+
+    chars = name.encode ('utf-16-le')
+    chars += b'\x00\x00'
+    if len(chars) % 26:
+        chars += b'\xff' * (26 - len(chars) % 26)
+    count   = len(chars) // 26
+    entries = []
+    for idx in range(count):
+        part  = chars[idx * 26:(idx + 1) * 26]
+        order = (idx + 1) | (0x40 if idx == count - 1 else 0)
+        entries.append (struct.pack ('<B10sBBB12sH4s', order, part[0:10], 0x0F, 0, checksum, part[10:22], 0, part[22:26]))
+    return b''.join(reversed(entries))
+
+
+def get_dir_entry (short, attr, cluster, size):
+    return struct.pack ('<11sBBBHHHHHHHI', short, attr, 0, 0, FAT_TIME, FAT_DATE, FAT_DATE,
+                        cluster >> 16, FAT_TIME, FAT_DATE, cluster & 0xFFFF, size)
+
+
+def assign_names (node):
+    used = set()
+    for child in node.children:
+        child.short, need_lfn = get_short_name (child.name, used)
+        used.add (child.short)
+        child.lfn = get_lfn_entries (child.name, child.short) if need_lfn else b''
+        if child.is_dir:
+            assign_names (child)
+
+
+def get_dir_size (node, is_root):
+    size = 0 if is_root else 64
+    for child in node.children:
+        size += len(child.lfn) + 32
+    return size
+
+
+def allocate_clusters (node, cluster_size, next_cluster, is_root = True):
+    if is_root:
+        if get_dir_size (node, True) > ROOT_ENTRIES * 32:
+            raise Exception ('Too many entries in the root directory !')
+    else:
+        node.clusters = (get_dir_size (node, False) + cluster_size - 1) // cluster_size
+    for child in node.children:
+        if not child.is_dir:
+            child.clusters = (child.size + cluster_size - 1) // cluster_size
+    if node.clusters:
+        node.cluster  = next_cluster
+        next_cluster += node.clusters
+    for child in node.children:
+        if child.is_dir:
+            next_cluster = allocate_clusters (child, cluster_size, next_cluster, False)
+        elif child.clusters:
+            child.cluster = next_cluster
+            next_cluster += child.clusters
+    return next_cluster
+
+
+def get_dir_data (node, parent_cluster, is_root):
+    data = bytearray ()
+    if not is_root:
+        data.extend (get_dir_entry (b'.          ', 0x10, node.cluster, 0))
+        data.extend (get_dir_entry (b'..         ', 0x10, parent_cluster, 0))
+    for child in node.children:
+        data.extend (child.lfn)
+        data.extend (get_dir_entry (child.short, 0x10 if child.is_dir else 0x20, child.cluster, child.size))
+    return data
+
+
+def get_fat16_layout (total_sectors):
+    root_sectors = ROOT_ENTRIES * 32 // SECTOR_SIZE
+    reserved     = 4
+    for spc in [1, 2, 4, 8, 16, 32, 64]:
+        fat_sectors = 1
+        while True:
+            data_sectors = total_sectors - reserved - 2 * fat_sectors - root_sectors
+            clusters     = data_sectors // spc
+            need         = ((clusters + 2) * 2 + SECTOR_SIZE - 1) // SECTOR_SIZE
+            if need <= fat_sectors:
+                break
+            fat_sectors = need
+        if clusters <= 65524:
+            if clusters < 4085:
+                raise Exception ('Disk image is too small for FAT16 !')
+            return spc, reserved, fat_sectors, root_sectors, clusters
+    raise Exception ('Disk image is too large for FAT16 !')
+
+
+def create_fat_image (src_dir, img_file, img_size = 0):
+    # Create a raw disk image with an MBR and a single FAT16 partition
+    # holding the content of src_dir.
+    root = build_tree (src_dir)
+    assign_names (root)
+
+    if not img_size:
+        content = 0
+        for dir_path, dirs, files in os.walk (src_dir):
+            content += sum(os.path.getsize (os.path.join (dir_path, name)) + 0x10000 for name in files + dirs)
+        img_size = max(64 << 20, (content * 5 // 4 + (16 << 20)) & ~0xFFFFF)
+
+    total_sectors = img_size // SECTOR_SIZE - PART_START
+    spc, reserved, fat_sectors, root_sectors, clusters = get_fat16_layout (total_sectors)
+    cluster_size  = spc * SECTOR_SIZE
+    last_cluster  = allocate_clusters (root, cluster_size, 2)
+    if last_cluster - 2 > clusters:
+        raise Exception ('Directory %s does not fit into a %d MB disk image !' % (src_dir, img_size >> 20))
+
+    part_offset = PART_START * SECTOR_SIZE
+    fat_offset  = part_offset + reserved * SECTOR_SIZE
+    root_offset = fat_offset + 2 * fat_sectors * SECTOR_SIZE
+    data_offset = root_offset + root_sectors * SECTOR_SIZE
+
+    # MBR with one LBA FAT16 partition
+    mbr = bytearray (SECTOR_SIZE)
+    mbr[446:462] = struct.pack ('<B3sB3sII', 0x80, b'\xfe\xff\xff', 0x0E, b'\xfe\xff\xff', PART_START, total_sectors)
+    mbr[510:512] = b'\x55\xaa'
+
+    # FAT16 boot sector
+    boot = bytearray (SECTOR_SIZE)
+    boot[0:62] = struct.pack ('<3s8sHBHBHHBHHHIIBBBI11s8s', b'\xeb\x3c\x90', b'MSWIN4.1', SECTOR_SIZE, spc,
+                              reserved, 2, ROOT_ENTRIES, total_sectors if total_sectors < 0x10000 else 0,
+                              0xF8, fat_sectors, 63, 255, PART_START, total_sectors if total_sectors >= 0x10000 else 0,
+                              0x80, 0, 0x29, 0x55504C44, b'UPLD DISK  ', b'FAT16   ')
+    boot[510:512] = b'\x55\xaa'
+
+    # FAT with contiguous cluster chains
+    fat = bytearray (fat_sectors * SECTOR_SIZE)
+    struct.pack_into ('<HH', fat, 0, 0xFFF8, 0xFFFF)
+    nodes = [root]
+    files = []
+    dirs  = []
+    while nodes:
+        node = nodes.pop (0)
+        for child in node.children:
+            if child.is_dir:
+                nodes.append (child)
+                dirs.append ((child, node))
+            elif child.clusters:
+                files.append (child)
+        if node.clusters:
+            for idx in range(node.clusters):
+                cluster = node.cluster + idx
+                struct.pack_into ('<H', fat, cluster * 2, 0xFFFF if idx == node.clusters - 1 else cluster + 1)
+    for node in files:
+        for idx in range(node.clusters):
+            cluster = node.cluster + idx
+            struct.pack_into ('<H', fat, cluster * 2, 0xFFFF if idx == node.clusters - 1 else cluster + 1)
+
+    tmp_file = img_file + '.%d.tmp' % os.getpid()
+    with open (tmp_file, 'wb') as fd:
+        fd.truncate (img_size)
+        fd.write (mbr)
+        fd.seek (part_offset)
+        fd.write (boot)
+        for idx in range(2):
+            fd.seek (fat_offset + idx * len(fat))
+            fd.write (fat)
+        fd.seek (root_offset)
+        fd.write (get_dir_data (root, 0, True))
+        for node, parent in dirs:
+            fd.seek (data_offset + (node.cluster - 2) * cluster_size)
+            fd.write (get_dir_data (node, parent.cluster, False))
+        fd.flush ()
+        for node in files:
+            os.lseek (fd.fileno(), data_offset + (node.cluster - 2) * cluster_size, os.SEEK_SET)
+            with open (node.path, 'rb') as in_fd:
+                copy_file_range (fd.fileno(), in_fd.fileno(), 0, node.size)
+    os.replace (tmp_file, img_file)
+
+
+def get_disk_image (src_dir, cache_dir):
+    # Return a cached raw FAT image of src_dir, create it when needed
+    img_file = os.path.join (cache_dir, get_dir_hash (src_dir) + '.img')
+    if not os.path.exists (img_file):
+        if not os.path.exists (cache_dir):
+            os.makedirs (cache_dir, exist_ok = True)
+        create_fat_image (src_dir, img_file)
+    return img_file
+
+
+def create_overlay (base_img, overlay_file):
+    # Guest writes go into a throwaway qcow2 overlay, the base stays intact
+    cmd = [get_tool ('qemu-img'), 'create', '-q', '-f', 'qcow2', '-b', os.path.realpath (base_img), '-F', 'raw', overlay_file]
+    subprocess.check_call (cmd)
+    return overlay_file
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('src_dir',  type=str, help='Directory to put into the disk image')
+    parser.add_argument('img_file', type=str, help='Raw disk image file path')
+    parser.add_argument('-s', dest='size', type=int, help='Disk image size in MB', default = 0)
+    args = parser.parse_args()
+
+    create_fat_image (args.src_dir, args.img_file, args.size << 20)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
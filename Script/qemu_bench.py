@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+## @ qemu_bench.py
+#
+# Measure universal payload boot time with each QEMU launch profile
+#
+# Copyright (c) 2021, Intel Corporation. All rights reserved.<BR>
+# SPDX-License-Identifier: BSD-2-Clause-Patent
+#
+##
+
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+from   test_base import *
+
+BENCH_FILE = 'Outputs/qemu_bench.json'
+
+
+def load_bench_results (bench_file = BENCH_FILE):
+    if not os.path.exists (bench_file):
+        return {}
+    with open (bench_file) as fd:
+        return json.load (fd)
+
+
+def save_bench_results (results, bench_file = BENCH_FILE):
+    bench_dir = os.path.dirname (bench_file)
+    if bench_dir and not os.path.exists (bench_dir):
+        os.makedirs (bench_dir)
+    with open (bench_file, 'w') as fd:
+        json.dump (results, fd, indent = 2, sort_keys = True)
+
+
+def get_best_profile (pld_name, bench_file = BENCH_FILE, host = None):
+    # Return the fastest profile that passed the boot test on this host
+    results = load_bench_results (bench_file).get (host or platform.node(), {})
+    best = None
+    for name, pld_results in results.items():
+        result = pld_results.get (pld_name)
+        if not result or not result['passed'] or name not in QEMU_PROFILES:
+            continue
+        if best is None or result['boot_time'] < best[1]:
+            best = (name, result['boot_time'])
+    return best[0] if best else None
+
+
+def bench_profile (bios_img, os_dir, check_lines, profile, repeat, timeout):
+    samples = []
+    passed  = True
+    for idx in range(repeat):
+        start  = time.time()
+        output = run_qemu (bios_img, os_dir, timeout = timeout, check_lines = check_lines, profile = profile)
+        boot_time = time.time() - start
+        if check_result (output, check_lines):
+            passed = False
+            break
+        samples.append (boot_time)
+    return passed, samples
+
+
+def main():
+    from sbl_upld import get_check_lines
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('bios_img', type=str, help='QEMU Slim Bootloader firmware image')
+    parser.add_argument('os_dir',   type=str, help='Directory containing bootable OS image')
+    parser.add_argument('pld_name', type=str, help='Payload name, such as uboot_32 or uefi_64')
+    parser.add_argument('-p', dest='profiles', type=str, help='Comma separated QEMU profiles to measure', default = '')
+    parser.add_argument('-n', dest='repeat',   type=int, help='Number of boots for each profile', default = 3)
+    parser.add_argument('-t', dest='timeout',  type=int, help='Boot timeout in seconds', default = 30)
+    parser.add_argument('-o', dest='bench_file', type=str, help='Benchmark result file', default = BENCH_FILE)
+    args = parser.parse_args()
+
+    if args.repeat < 1:
+        parser.error ('-n must be at least 1')
+
+    if args.profiles:
+        profiles = args.profiles.split(',')
+    else:
+        # 'icount' is for counting instructions, its boot time is not comparable
+        profiles = [name for name in sorted(QEMU_PROFILES) if (name != 'kvm' or is_kvm_usable ()) and name != 'icount']
+
+    check_lines = get_check_lines (args.pld_name)
+    results     = load_bench_results (args.bench_file)
+    host_result = results.setdefault (platform.node(), {})
+    for name in profiles:
+        print ('######### Benchmarking QEMU profile %s' % name)
+        passed, samples = bench_profile (args.bios_img, args.os_dir, check_lines, get_qemu_profile (name), args.repeat, args.timeout)
+        samples.sort ()
+        host_result.setdefault (name, {})[args.pld_name] = {
+            'passed'    : passed,
+            'boot_time' : samples[len(samples) // 2] if passed else None,
+            'samples'   : samples,
+            'date'      : time.strftime ('%Y-%m-%d %H:%M:%S'),
+        }
+    save_bench_results (results, args.bench_file)
+
+    print ('\n%-10s %-8s %12s' % ('Profile', 'Result', 'Boot(s)'))
+    for name in profiles:
+        result = host_result[name][args.pld_name]
+        boot_time = '%12.2f' % result['boot_time'] if result['passed'] else '%12s' % '-'
+        print ('%-10s %-8s %s' % (name, 'PASSED' if result['passed'] else 'FAILED', boot_time))
+
+    best = get_best_profile (args.pld_name, args.bench_file)
+    if best is None:
+        print ('\nNo QEMU profile passed the boot test !')
+        return 1
+
+    print ('\nFastest passing profile for %s: %s' % (args.pld_name, best))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
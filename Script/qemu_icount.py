@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+## @ qemu_icount.py
+#
+# Guest instruction counts at boot markers through QMP
+#
+# Copyright (c) 2021, Intel Corporation. All rights reserved.<BR>
+# SPDX-License-Identifier: BSD-2-Clause-Patent
+#
+##
+
+import json
+import time
+import socket
+import threading
+
+
+class QmpClient:
+    # Minimal synchronous QMP client over a unix socket
+    def __init__(self, sock_path):
+        self.sock_path = sock_path
+        self.sock      = None
+        self.reader    = None
+
+    def connect (self, timeout = 10, io_timeout = 1):
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                self.sock = socket.socket (socket.AF_UNIX, socket.SOCK_STREAM)
+                self.sock.connect (self.sock_path)
+                break
+            except OSError:
+                self.sock.close ()
+                if time.monotonic() >= deadline:
+                    raise Exception ('Could not connect to QMP socket %s !' % self.sock_path)
+                time.sleep (0.05)
+        self.sock.settimeout (io_timeout)
+        self.reader = self.sock.makefile ('r')
+        self.read ()
+        self.execute ('qmp_capabilities')
+
+    def read (self):
+        line = self.reader.readline ()
+        if not line:
+            raise Exception ('QMP connection closed !')
+        return json.loads (line)
+
+    def execute (self, command, arguments = None):
+        request = {'execute' : command}
+        if arguments:
+            request['arguments'] = arguments
+        self.sock.sendall ((json.dumps (request) + '\n').encode())
+        while True:
+            reply = self.read ()
+            # asynchronous events may arrive before the reply
+            if 'return' in reply:
+                return reply['return']
+            if 'error' in reply:
+                raise Exception ('QMP %s failed: %s' % (command, reply['error'].get ('desc')))
+
+    def close (self):
+        if self.sock:
+            self.reader.close ()
+            self.sock.close ()
+            self.sock = None
+
+
+class IcountSampler:
+    # Read the guest instruction count each time a check line is matched.
+    # The guest is stopped first so that it does not run on while the count
+    # is read, but it keeps running from the serial output until the host
+    # has read the line and the stop command arrives. Each count is later
+    # than its marker by an amount that depends on the host, so the counts
+    # are approximate: compare runs with a tolerance, not for equality.
+    #
+    # on_match runs on the console engine thread, so the connection is made
+    # by a helper thread while QEMU starts, and each command has a short
+    # timeout. A marker seen before the connection is up is not sampled.
+    def __init__(self, sock_path, io_timeout = 0.5):
+        self.qmp        = QmpClient (sock_path)
+        self.io_timeout = io_timeout
+        self.counts     = []
+        self.error      = None
+        self.ready      = threading.Event()
+
+    def start (self, timeout = 10):
+        def connect ():
+            try:
+                self.qmp.connect (timeout, self.io_timeout)
+                self.ready.set ()
+            except Exception as ex:
+                self.error = str(ex)
+        self.thread = threading.Thread (target = connect, daemon = True)
+        self.thread.start ()
+
+    def on_match (self, index, line):
+        if self.error or not self.ready.is_set ():
+            return
+        try:
+            self.qmp.execute ('stop')
+            info = self.qmp.execute ('query-replay')
+            self.counts.append ((index, info.get ('icount')))
+            self.qmp.execute ('cont')
+        except Exception as ex:
+            self.error = str(ex)
+
+    def close (self):
+        if self.ready.is_set ():
+            self.qmp.close ()
+
+
+def get_icount_stages (counts, check_lines):
+    # Return the instruction count at each marker and since the previous one
+    stages = []
+    last   = 0
+    for index, icount in counts:
+        if icount is None:
+            continue
+        stages.append ({'marker' : check_lines[index], 'icount' : icount, 'delta' : icount - last})
+        last = icount
+    return stages
+
+
+def print_icount_stages (stages):
+    print ('%-48s %16s %16s' % ('Boot marker', 'Instructions', 'Delta'))
+    for stage in stages:
+        print ('%-48s %16d %16d' % (stage['marker'][:48], stage['icount'], stage['delta']))
+    print ('Instruction counts are sampled after the host reads each marker and are approximate')
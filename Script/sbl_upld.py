@@ -8,9 +8,18 @@
 
 import os
 import sys
+import json
+import shutil
+import tempfile
+import time
 import struct
+import argparse
+import threading
 from   ctypes import Structure, c_char, c_uint32, c_uint8, c_uint64, c_uint16, sizeof, ARRAY
 from   test_base import *
+from   boot_stats import STATS_FILE, DEFAULT_TIMEOUT, add_boot_time, get_adaptive_timeout, get_percentile
+from   qemu_icount import IcountSampler, get_icount_stages, print_icount_stages
+from   trace_prof import span
 
 def get_check_lines (pld_name):
 
@@ -51,13 +60,222 @@ def get_check_lines (pld_name):
 
     return lines
 
-def usage():
-    print("usage:\n  python %s bios_image os_image_dir\n" % sys.argv[0])
-    print("  bios_image  :  QEMU Slim Bootloader firmware image.")
-    print("                 This image can be generated through the normal Slim Bootloader build process.")
-    print("  os_image_dir:  Directory containing bootable OS image.")
-    print("                 This image can be generated using GenContainer.py tool.")
-    print("")
+def get_failure_lines (pld_name):
+    # Console output that means the boot can not succeed any more
+    lines = [
+              "ASSERT ",
+              "!!!! IA32 Exception",
+              "!!!! X64 Exception",
+              "Exception Type -",
+              "Failed to load payload",
+              "CpuDeadLoop",
+            ]
+
+    if pld_name.startswith('uboot'):
+        lines.extend([
+              "### ERROR ### Please RESET the board ###",
+              "resetting ...",
+              ])
+
+    if pld_name.startswith('uefi'):
+        lines.extend([
+              "ASSERT_EFI_ERROR",
+              "DXE_ASSERT",
+              ])
+
+    if pld_name.startswith('linux'):
+        lines.extend([
+              "Kernel panic",
+              "BUG: unable to handle",
+              ])
+
+    return lines
+
+
+def get_stage_latency (output, check_lines):
+    # Locate the check lines the same way as check_result and return the
+    # time each marker was seen and the time spent since the previous one.
+    stages = []
+    index  = 0
+    last   = 0.0
+    for line in check_lines:
+        while index < len(output) and line not in output[index]:
+            index += 1
+        if index >= len(output):
+            break
+        stamp = output.times[index]
+        stages.append ({'marker' : line, 'time' : round(stamp, 3), 'delta' : round(stamp - last, 3)})
+        last   = stamp
+        index += 1
+    return stages
+
+
+def is_slow_boot (output, timeout):
+    # A boot stopped by the timeout was still going if the guest printed
+    # something in the last quarter of it, otherwise it hung silently.
+    return output.last_output is not None and timeout - output.last_output <= timeout / 4
+
+
+def print_stage_latency (stages):
+    print ('%-48s %10s %10s' % ('Boot marker', 'Time(s)', 'Delta(s)'))
+    for stage in stages:
+        print ('%-48s %10.3f %10.3f' % (stage['marker'][:48], stage['time'], stage['delta']))
+
+
+def get_qemu_profile_by_name (pld_name, name, memory = None, smp = None):
+    if name == 'best':
+        from qemu_bench import get_best_profile
+        name = get_best_profile (pld_name) or 'auto'
+    return get_qemu_profile (name, memory, smp)
+
+
+def get_idle_timeout (profile, timeout):
+    # Stages such as the UEFI FV decompression print nothing for a good part
+    # of the boot under TCG. The idle timeout has to stay below the boot
+    # timeout, otherwise a hang is always stopped by the boot timeout.
+    fraction = 0.5 if profile['accel'].startswith ('kvm') else 0.75
+    return max(1, int(timeout * fraction))
+
+
+class LoadMonitor (threading.Thread):
+    # Sample the host load average while boots are running
+    def __init__(self, interval = 1.0):
+        threading.Thread.__init__(self, daemon = True)
+        self.interval = interval
+        self.samples  = []
+        self.stopped  = threading.Event()
+
+    def run (self):
+        while True:
+            self.samples.append (os.getloadavg()[0])
+            if self.stopped.wait (self.interval):
+                break
+
+    def stop (self):
+        self.stopped.set ()
+        self.join ()
+        if not self.samples:
+            return {}
+        return {'cpus' : os.cpu_count(), 'load_min' : min(self.samples), 'load_max' : max(self.samples),
+                'load_avg' : round(sum(self.samples) / len(self.samples), 2)}
+
+
+def get_run_log_file (log_file, index):
+    # console.log.gz -> console.3.log.gz
+    if not log_file:
+        return None
+    base, ext = os.path.splitext (log_file)
+    if ext == '.gz':
+        base, inner = os.path.splitext (base)
+        ext = inner + ext
+    return '%s.%d%s' % (base, index, ext)
+
+
+class SoakSession (ConsoleSession):
+    # One soak run. Each run boots its own copy of the firmware image, QEMU
+    # writes to the flash, and its own disk when runs overlap. A replayed run
+    # uses neither. The copies are made when the console engine starts the
+    # run and removed when it finishes, so only 'jobs' of them exist at once.
+    def __init__(self, args, index, profile, timeout, check_lines, fail_lines):
+        ConsoleSession.__init__(self, None, timeout, check_lines, fail_lines, args.idle_timeout,
+                                get_run_log_file (args.log_file, index), echo = False,
+                                record_file = get_run_log_file (args.console_record, index))
+        self.args        = args
+        self.index       = index
+        self.profile     = profile
+        self.check_lines = check_lines
+        self.run_dir     = None
+        self.result      = None
+
+    def start (self):
+        args     = self.args
+        os_dir   = args.os_dir
+        bios_img = args.bios_img
+        self.run_dir = tempfile.mkdtemp (prefix = 'upld_soak_')
+        try:
+            if not args.console_replay:
+                bios_img = os.path.join (self.run_dir, os.path.basename (args.bios_img))
+                shutil.copyfile (args.bios_img, bios_img)
+                if args.disk_cache and os.path.isdir (os_dir):
+                    from fat_image import get_disk_image, create_overlay
+                    os_dir = create_overlay (get_disk_image (os_dir, args.disk_cache), os.path.join (self.run_dir, 'disk.qcow2'))
+                elif args.jobs > 1 and os.path.isdir (os_dir):
+                    os_dir = shutil.copytree (os_dir, os.path.join (self.run_dir, 'Disk'))
+            self.cmd   = get_qemu_cmd (bios_img, os_dir, profile = self.profile,
+                                       replay_file = args.console_replay, replay_speed = args.replay_speed)
+            self.begin = time.time()
+            return ConsoleSession.start (self)
+        except Exception:
+            shutil.rmtree (self.run_dir)
+            raise
+
+    def finish (self):
+        if self.done:
+            return
+        ConsoleSession.finish (self)
+        wall = time.time() - self.begin
+        shutil.rmtree (self.run_dir)
+
+        output  = self.lines
+        stages  = get_stage_latency (output, self.check_lines)
+        passed  = len(stages) == len(self.check_lines) and not output.failure
+        failure = output.failure
+        if not passed and not failure:
+            failure = "Missing '%s'" % self.check_lines[len(stages)]
+        print ('Run %3d: %s in %.2fs%s' % (self.index, 'PASSED' if passed else 'FAILED', wall, '' if passed else ' (%s)' % failure))
+        sys.stdout.flush ()
+        self.result = {'run' : self.index, 'passed' : passed, 'failure' : failure, 'wall' : round(wall, 3), 'stages' : stages}
+
+
+def soak_boot (args, profile, timeout, check_lines, fail_lines):
+    # Boot the same image many times, report the pass rate and the time
+    # distribution to each boot marker together with the host load.
+    # All runs share one console engine, which keeps 'jobs' of them running.
+    engine   = ConsoleEngine (max(1, args.jobs))
+    sessions = [SoakSession (args, index, profile, timeout, check_lines, fail_lines) for index in range(args.repeat)]
+    for session in sessions:
+        engine.add (session)
+    monitor = LoadMonitor ()
+    monitor.start ()
+    with span ('soak boot'):
+        engine.run ()
+    host = monitor.stop ()
+    runs = [session.result for session in sessions]
+
+    passed  = sum(run['passed'] for run in runs)
+    markers = []
+    for line in check_lines:
+        samples = [stage['time'] for run in runs for stage in run['stages'] if stage['marker'] == line]
+        entry   = {'marker' : line, 'count' : len(samples)}
+        if samples:
+            entry.update ({'min' : min(samples), 'max' : max(samples), 'p50' : get_percentile (samples, 50),
+                           'p90' : get_percentile (samples, 90), 'p99' : get_percentile (samples, 99)})
+        markers.append (entry)
+
+    failures = {}
+    for run in runs:
+        if not run['passed']:
+            failures[run['failure']] = failures.get (run['failure'], 0) + 1
+
+    print ('\n%-48s %6s %8s %8s %8s %8s' % ('Boot marker', 'Count', 'P50(s)', 'P90(s)', 'P99(s)', 'Max(s)'))
+    for entry in markers:
+        if entry['count']:
+            print ('%-48s %6d %8.3f %8.3f %8.3f %8.3f' % (entry['marker'][:48], entry['count'], entry['p50'], entry['p90'], entry['p99'], entry['max']))
+        else:
+            print ('%-48s %6d %8s %8s %8s %8s' % (entry['marker'][:48], 0, '-', '-', '-', '-'))
+    for failure, count in sorted(failures.items(), key = lambda item: -item[1]):
+        print ('%4d x %s' % (count, failure))
+    if host:
+        print ('Host load: %.2f avg, %.2f max on %d CPUs' % (host['load_avg'], host['load_max'], host['cpus']))
+    print ('\nPass rate: %d/%d (%.1f%%)\n' % (passed, len(runs), passed * 100.0 / len(runs)))
+
+    if args.bench_file:
+        with open (args.bench_file, 'w') as fd:
+            json.dump ({'payload' : args.pld_name, 'profile' : profile['name'], 'timeout' : timeout, 'repeat' : args.repeat,
+                        'jobs' : args.jobs, 'passed' : passed, 'pass_rate' : round(passed / len(runs), 4), 'failures' : failures,
+                        'markers' : markers, 'host' : host, 'runs' : runs}, fd, indent = 2)
+
+    return 0 if passed == len(runs) else -1
 
 
 def main():
@@ -65,23 +283,131 @@ def main():
         print ("This script needs Python3 !")
         return -1
 
-    if len(sys.argv) != 4:
-        usage()
-        return -2
+    parser = argparse.ArgumentParser()
+    parser.add_argument('bios_img', type=str, help='QEMU Slim Bootloader firmware image. This image can be generated through the normal Slim Bootloader build process.')
+    parser.add_argument('os_dir',   type=str, help='Directory containing bootable OS image.')
+    parser.add_argument('pld_name', type=str, help='Payload name, such as uboot_32, linux_64 or uefi_32.')
+    parser.add_argument('-q', '--profile', dest='profile', type=str, default = 'auto',
+                        help="QEMU launch profile: %s, 'auto', or 'best' for the fastest benchmarked one" % ', '.join(sorted(QEMU_PROFILES)))
+    parser.add_argument('-m', '--memory', dest='memory', type=str, help='QEMU guest memory size, such as 512M')
+    parser.add_argument('-s', '--smp',    dest='smp',    type=int, help='QEMU guest vCPU count')
+    parser.add_argument('-t', '--timeout', dest='timeout', type=float, default = 0, help='Boot timeout in seconds, 0 to derive it from recent boot durations')
+    parser.add_argument('--timeout-floor',   dest='timeout_floor',   type=float, default = 3,  help='Lower limit of the derived boot timeout')
+    parser.add_argument('--timeout-ceiling', dest='timeout_ceiling', type=float, default = 60, help='Upper limit of the derived boot timeout')
+    parser.add_argument('--stats', dest='stats_file', type=str, default = STATS_FILE, help='Recent boot duration file, empty to disable')
+    parser.add_argument('-f', '--fail', dest='fail_lines', action='append', default=[], help='Additional console failure signature')
+    parser.add_argument('-w', '--idle-timeout', dest='idle_timeout', type=int, help='Stop QEMU after this many seconds without console output, 0 to disable, default half of the boot timeout with KVM and three quarters with TCG')
+    parser.add_argument('-d', '--disk-cache', dest='disk_cache', type=str, help='Boot from a cached FAT image of os_dir kept in this directory')
+    parser.add_argument('-o', '--log', dest='log_file', type=str, help='Write the console log into this file instead of stdout, gzip compressed if it ends with .gz')
+    parser.add_argument('-l', '--latency', dest='latency_file', type=str, help='Write boot stage latency into this JSON file')
+    parser.add_argument('-n', '--repeat', dest='repeat', type=int, default = 0, help='Soak mode, boot the image this many times and report the boot time distribution')
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int, default = 1, help='Number of soak mode boots to run at the same time')
+    parser.add_argument('-b', '--bench', dest='bench_file', type=str, help='Write soak mode results into this JSON file')
+    parser.add_argument('--rr-file', dest='rr_file', type=str, help="Keep the QEMU execution recording of the 'icount' profile in this file")
+    parser.add_argument('--rr-replay', dest='replay_file', type=str, help="Replay a QEMU execution recording with the 'icount' profile")
+    parser.add_argument('--console-record', dest='console_record', type=str, help='Record the console output with its timing into this file')
+    parser.add_argument('--console-replay', dest='console_replay', type=str, help='Replay a console recording instead of running QEMU')
+    parser.add_argument('--replay-speed', dest='replay_speed', type=float, default = 1.0, help='Console replay speed factor, 0 for no delay')
+    args = parser.parse_args()
+
+    bios_img = args.bios_img
+    os_dir   = args.os_dir
+    pld_name = args.pld_name
+    profile  = get_qemu_profile_by_name (pld_name, args.profile, args.memory, args.smp)
+
+    if (args.rr_file or args.replay_file) and not profile.get ('icount'):
+        print ("Record and replay need the 'icount' QEMU profile !")
+        return -1
+    if (args.rr_file or args.replay_file) and args.repeat:
+        print ("QEMU execution record and replay are not supported in soak mode !")
+        return -1
+
+    timeout  = args.timeout
+    if not timeout:
+        if args.stats_file:
+            timeout = get_adaptive_timeout (pld_name, profile['name'], args.timeout_floor, args.timeout_ceiling, stats_file = args.stats_file)
+        else:
+            timeout = max(args.timeout_floor, min(args.timeout_ceiling, DEFAULT_TIMEOUT))
 
-    bios_img = sys.argv[1]
-    os_dir   = sys.argv[2]
-    pld_name = sys.argv[3]
+    if args.idle_timeout is None:
+        args.idle_timeout = get_idle_timeout (profile, timeout)
 
-    print("Universal Payload boot test for Slim BootLoader")
+    print("Universal Payload boot test for Slim BootLoader (QEMU profile %s, timeout %.1fs)" % (profile['name'], timeout))
 
-    # run QEMU boot with timeout
-    output = []
-    lines = run_qemu(bios_img, os_dir, timeout = 8)
-    output.extend(lines)
+    # run QEMU boot with timeout, it stops as soon as all check lines are seen
+    check_lines = get_check_lines(pld_name)
+    fail_lines  = get_failure_lines(pld_name) + args.fail_lines
+    if args.repeat:
+        return soak_boot (args, profile, timeout, check_lines, fail_lines)
+
+    # boot from a throwaway overlay on top of a cached FAT image of the OS directory
+    tmp_dir = None
+    if args.disk_cache and os.path.isdir (os_dir) and not args.console_replay:
+        from fat_image import get_disk_image, create_overlay
+        tmp_dir = tempfile.mkdtemp (prefix = 'upld_disk_')
+        with span ('disk image'):
+            os_dir  = create_overlay (get_disk_image (os_dir, args.disk_cache), os.path.join (tmp_dir, 'disk.qcow2'))
+
+    # QEMU only reports the instruction count through QMP when it records or
+    # replays the execution, so the 'icount' profile always records
+    sampler = None
+    if profile.get ('icount') and not args.console_replay:
+        if not tmp_dir:
+            tmp_dir = tempfile.mkdtemp (prefix = 'upld_disk_')
+        if args.replay_file:
+            profile['rr'] = ('replay', args.replay_file)
+        else:
+            profile['rr'] = ('record', args.rr_file or os.path.join (tmp_dir, 'boot.rr'))
+        profile['qmp'] = os.path.join (tmp_dir, 'qmp.sock')
+        sampler = IcountSampler (profile['qmp'])
+        sampler.start ()
+
+    try:
+        with span ('qemu boot %s' % pld_name):
+            output = run_qemu(bios_img, os_dir, timeout = timeout, check_lines = check_lines, profile = profile,
+                              fail_lines = fail_lines, idle_timeout = args.idle_timeout, log_file = args.log_file,
+                              on_match = sampler.on_match if sampler else None, record_file = args.console_record,
+                              replay_file = args.console_replay, replay_speed = args.replay_speed)
+    finally:
+        if sampler:
+            sampler.close ()
+        if tmp_dir:
+            shutil.rmtree (tmp_dir)
 
     # check test result
-    ret = check_result (output, get_check_lines(pld_name))
+    if output.failure:
+        print ('\n%s !' % output.failure)
+    ret = check_result (output, check_lines)
+
+    # boot latency between the check line markers
+    stages = get_stage_latency (output, check_lines)
+    print ('')
+    print_stage_latency (stages)
+    result = {'payload' : pld_name, 'profile' : profile['name'], 'passed' : ret == 0,
+              'failure' : output.failure, 'stages' : stages}
+
+    # guest instructions between the markers, approximate, see IcountSampler
+    if sampler:
+        if sampler.error:
+            print ('\nFailed to read the instruction count: %s' % sampler.error)
+        icount = get_icount_stages (sampler.counts, check_lines)
+        print ('')
+        print_icount_stages (icount)
+        result['icount'] = icount
+
+    if args.latency_file:
+        with open (args.latency_file, 'w') as fd:
+            json.dump (result, fd, indent = 2)
+
+    # Complete boots count towards the timeout of later runs. A boot stopped
+    # by the timeout took at least that long, keeping it lets the timeout
+    # grow back on a loaded host. Failures and silent hangs are not boot times,
+    # and replayed boots do not tell how long the image takes to boot.
+    if args.stats_file and not args.console_replay:
+        if ret == 0 and stages:
+            add_boot_time (pld_name, profile['name'], stages[-1]['time'], args.stats_file)
+        elif ret != 0 and not output.failure and is_slow_boot (output, timeout):
+            add_boot_time (pld_name, profile['name'], timeout, args.stats_file)
 
     print ('\nBoot test %s !\n' % ('PASSED' if ret == 0 else 'FAILED'))
 
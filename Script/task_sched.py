@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+## @ task_sched.py
+#
+# Dependency aware task scheduler for build stages
+#
+# Copyright (c) 2021, Intel Corporation. All rights reserved.<BR>
+# SPDX-License-Identifier: BSD-2-Clause-Patent
+#
+##
+
+import os
+import sys
+import time
+import traceback
+import concurrent.futures
+from   trace_prof import span
+
+
+class Task:
+    # A build task. A task depends on the tasks listed in 'deps' and on any
+    # task producing one of its 'inputs' as an output.
+    def __init__(self, name, func, deps = None, inputs = None, outputs = None):
+        self.name    = name
+        self.func    = func
+        self.deps    = list(deps or [])
+        self.inputs  = list(inputs or [])
+        self.outputs = list(outputs or [])
+        self.status  = 'PENDING'
+        self.start   = 0
+        self.end     = 0
+
+
+def resolve_deps (tasks, done = ()):
+    # Tasks named in 'done' are treated as completed, so a subset of a task
+    # graph can run without the tasks it depends on.
+    names    = {}
+    producer = {}
+    for task in tasks:
+        if task.name in names:
+            raise Exception ("Duplicated task '%s' !" % task.name)
+        names[task.name] = task
+        for output in task.outputs:
+            producer[output] = task.name
+
+    deps = {}
+    for task in tasks:
+        deps[task.name] = set(task.deps)
+        for item in task.inputs:
+            if item in producer and producer[item] != task.name:
+                deps[task.name].add (producer[item])
+        deps[task.name] -= set(done)
+        for dep in deps[task.name]:
+            if dep not in names:
+                raise Exception ("Task '%s' depends on unknown task '%s' !" % (task.name, dep))
+
+    # detect dependency cycles
+    visited = {}
+    def visit (name, path):
+        if visited.get(name) == 1:
+            raise Exception ('Task dependency cycle: %s' % ' -> '.join(path + [name]))
+        if visited.get(name) == 2:
+            return
+        visited[name] = 1
+        for dep in sorted(deps[name]):
+            visit (dep, path + [name])
+        visited[name] = 2
+
+    for task in tasks:
+        visit (task.name, [])
+
+    return deps
+
+
+def is_under (path, base):
+    path = os.path.normpath (path)
+    base = os.path.normpath (base)
+    return path == base or path.startswith (base + os.sep)
+
+
+def get_affected_tasks (tasks, changed):
+    # Return the tasks using one of the changed paths as input, together
+    # with all the tasks consuming their outputs, in the original order.
+    # Ordering only dependencies in 'deps' do not make a task affected.
+    affected = set()
+    for task in tasks:
+        if any(is_under (path, item) for path in changed for item in task.inputs):
+            affected.add (task.name)
+
+    while True:
+        outputs = set(output for task in tasks if task.name in affected for output in task.outputs)
+        count   = len(affected)
+        for task in tasks:
+            if task.name not in affected and outputs & set(task.inputs):
+                affected.add (task.name)
+        if len(affected) == count:
+            break
+
+    return [task for task in tasks if task.name in affected]
+
+
+def run_task (task):
+    task.start = time.time()
+    try:
+        with span (task.name, 'task'):
+            ret = task.func ()
+    except Exception:
+        traceback.print_exc ()
+        ret = -1
+    task.end = time.time()
+    return ret
+
+
+def print_task_report (tasks, begin):
+    print ('\n%-20s %-10s %10s %10s' % ('Task', 'Status', 'Start(s)', 'Time(s)'))
+    for task in tasks:
+        if task.start:
+            print ('%-20s %-10s %10.2f %10.2f' % (task.name, task.status, task.start - begin, task.end - task.start))
+        else:
+            print ('%-20s %-10s %10s %10s' % (task.name, task.status, '-', '-'))
+    print ('Total time: %.2f seconds\n' % (time.time() - begin))
+
+
+def run_tasks (tasks, jobs = 1, done = ()):
+    # Run tasks in dependency order with up to 'jobs' tasks at a time.
+    # When a task fails no new task is started, and the running tasks are
+    # allowed to finish before returning.
+    deps    = resolve_deps (tasks, done)
+    pending = list(tasks)
+    running = {}
+    failed  = None
+    begin   = time.time()
+
+    with concurrent.futures.ThreadPoolExecutor (max_workers = max(1, jobs)) as executor:
+        while pending or running:
+            if failed is None:
+                done_names = set(task.name for task in tasks if task.status == 'PASSED')
+                for task in list(pending):
+                    if len(running) >= max(1, jobs):
+                        break
+                    if deps[task.name] <= done_names:
+                        pending.remove (task)
+                        task.status = 'RUNNING'
+                        running[executor.submit (run_task, task)] = task
+            elif not running:
+                break
+
+            if not running:
+                # nothing can make progress
+                failed = pending[0]
+                break
+
+            done, not_done = concurrent.futures.wait (running, return_when = concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                task = running.pop (future)
+                if future.result ():
+                    task.status = 'FAILED'
+                    if failed is None:
+                        failed = task
+                        print ("Task '%s' failed, waiting for running tasks to complete ..." % task.name)
+                else:
+                    task.status = 'PASSED'
+                sys.stdout.flush ()
+
+    for task in pending:
+        task.status = 'SKIPPED'
+
+    print_task_report (tasks, begin)
+
+    if failed is not None:
+        print ("Build failed in task '%s' !" % failed.name)
+        return 1
+
+    return 0
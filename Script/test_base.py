@@ -10,11 +10,18 @@
 import os
 import sys
 import struct
-import signal
+import re
+import gzip
+import queue
+import selectors
+import time
 import subprocess
 import zipfile
 import urllib.request
-from   threading import Timer
+import threading
+from   toolchain import get_tool
+from   trace_prof import ProcessSpan
+from   console_replay import ConsoleRecorder
 
 
 def unzip_file (zip_file, tgt_dir):
@@ -33,44 +40,377 @@ def create_dirs (dirs):
             os.mkdir (dir_name)
 
 
-def run_qemu (bios_img, fwu_path, fwu_mode=False, timeout=0):
-    if os.name == 'nt':
-        path = r"C:\Program Files\qemu\qemu-system-x86_64"
+# QEMU launch profiles, 'auto' picks 'kvm' when /dev/kvm is usable and
+# 'tcg_mt' otherwise. 'tcg' is the original single threaded TCG setup.
+# 'icount' runs one instruction per virtual nanosecond and never sleeps, so
+# the guest execution does not depend on the host speed, the points where
+# the instruction count is sampled still do.
+QEMU_PROFILES = {
+    'tcg'    : {'accel' : 'tcg',                           'memory' : '256M', 'smp' : 1},
+    'tcg_mt' : {'accel' : 'tcg,thread=multi,tb-size=512',  'memory' : '256M', 'smp' : 2},
+    'kvm'    : {'accel' : 'kvm',                           'memory' : '256M', 'smp' : 2},
+    'icount' : {'accel' : 'tcg',                           'memory' : '256M', 'smp' : 1, 'icount' : 'shift=0,align=off,sleep=off'},
+}
+
+
+def is_kvm_usable ():
+    return os.name == 'posix' and os.access ('/dev/kvm', os.R_OK | os.W_OK)
+
+
+def get_qemu_profile (name = 'auto', memory = None, smp = None):
+    if name == 'auto':
+        name = 'kvm' if is_kvm_usable () else 'tcg_mt'
+    if name not in QEMU_PROFILES:
+        raise Exception ("Unknown QEMU profile '%s' !" % name)
+    profile = dict(QEMU_PROFILES[name])
+    profile['name'] = name
+    if memory:
+        profile['memory'] = memory
+    if smp:
+        profile['smp'] = smp
+    return profile
+
+
+def get_drive_spec (fwu_path):
+    # a directory is exported through vvfat, an image file is used directly
+    if os.path.isdir (fwu_path):
+        return "format=raw,file=fat:rw:%s" % fwu_path
+    if fwu_path.endswith ('.qcow2'):
+        return "format=qcow2,file=%s" % fwu_path
+    return "format=raw,file=%s" % fwu_path
+
+
+def get_qemu_cmd (bios_img, fwu_path, fwu_mode=False, profile=None, replay_file=None, replay_speed=1.0):
+    path = get_tool ('qemu-system-x86_64')
+    if profile is None:
+        profile = get_qemu_profile ()
+    if profile.get('rr'):
+        # record/replay needs the disk accesses to go through blkreplay
+        drive_list = ["-drive", "id=mydisk,if=none,%s" % get_drive_spec (fwu_path),
+                      "-drive", "driver=blkreplay,if=none,image=mydisk,id=mydrive"]
     else:
-        path = r"qemu-system-x86_64"
+        drive_list = ["-drive", "id=mydrive,if=none,%s" % get_drive_spec (fwu_path)]
     cmd_list = [
-        path, "-nographic", "-machine", "q35,accel=tcg",
+        path, "-nographic", "-machine", "q35", "-accel", profile['accel'],
         "-serial", "mon:stdio",
-        "-m", "256M", "-drive",
-        "id=mydrive,if=none,format=raw,file=fat:rw:%s" % fwu_path, "-device",
+        "-m", profile['memory'], "-smp", str(profile['smp'])] + drive_list + ["-device",
         "ide-hd,drive=mydrive", "-boot", "order=%s" % ('dan' if fwu_mode else 'abd'),
         "-no-reboot", "-drive", "file=%s,if=pflash,format=raw" % bios_img
     ]
+    if profile.get('icount'):
+        icount = profile['icount']
+        if profile.get('rr'):
+            icount += ',rr=%s,rrfile=%s' % profile['rr']
+        cmd_list.extend (["-icount", icount])
+    if profile.get('qmp'):
+        cmd_list.extend (["-qmp", "unix:%s,server=on,wait=off" % profile['qmp']])
+    if replay_file:
+        # a recorded console stands in for QEMU, no firmware image is needed
+        cmd_list = [sys.executable, os.path.join (os.path.dirname (os.path.realpath (__file__)), 'console_replay.py'),
+                    replay_file, '-s', str(replay_speed)]
+    return cmd_list
+
 
-    lines = run_process (cmd_list, timeout)
+def run_qemu (bios_img, fwu_path, fwu_mode=False, timeout=0, check_lines=None, profile=None, fail_lines=None, idle_timeout=0, log_file=None, echo=None,
+              on_match=None, record_file=None, replay_file=None, replay_speed=1.0):
+    cmd_list = get_qemu_cmd (bios_img, fwu_path, fwu_mode, profile, replay_file, replay_speed)
+    lines = run_process (cmd_list, timeout, check_lines, fail_lines, idle_timeout, log_file, echo, on_match, record_file)
     return lines
 
 
-def run_process (cmd, timeout = 0):
-    def timerout (p):
-        timer.cancel()
-        os.kill(p.pid, signal.SIGTERM)
-
-    lines = []
-    p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, bufsize=1, universal_newlines=True)
-    if timeout:
-      timer = Timer(timeout, timerout, args=[p])
-      timer.start()
-    for line in iter(p.stdout.readline, ''):
-        line = line.rstrip()
-        print (line)
-        lines.append (line)
-    p.stdout.close()
-    retcode = p.wait()
-    if timeout:
-        timer.cancel()
+class LineMatcher:
+    # Match the check lines in order against the output lines as they arrive.
+    # It follows the same rule as check_result: each output line can satisfy
+    # at most one check line.
+    def __init__(self, check_lines):
+        self.check_lines = list(check_lines)
+        self.index       = 0
 
-    return lines
+    def done (self):
+        return self.index >= len(self.check_lines)
+
+    def feed (self, line):
+        if not self.done() and self.check_lines[self.index] in line:
+            self.index += 1
+            return True
+        return False
+
+    def is_last (self, line):
+        # check if a line would complete the last check line
+        return self.index == len(self.check_lines) - 1 and self.check_lines[self.index] in line
+
+
+class ConsoleLog(list):
+    # Captured output lines, 'times' holds the monotonic time in seconds
+    # of each line relative to the process start, 'last_output' the time
+    # any output was last read. 'failure' describes why the process was
+    # stopped early, if it was.
+    # Only the last 'max_lines' lines are kept, except for the lines marked
+    # to keep, such as matched check lines, so check_result still works.
+    def __init__(self, max_lines = 0):
+        list.__init__(self)
+        self.times       = []
+        self.keep        = []
+        self.start       = time.monotonic()
+        self.failure     = None
+        self.last_output = None
+        self.max_lines   = max_lines
+        self.dropped     = 0
+
+    def add (self, line, keep = False):
+        self.times.append (time.monotonic() - self.start)
+        self.keep.append (keep)
+        self.append (line)
+        if self.max_lines and len(self) >= 2 * self.max_lines:
+            self.trim ()
+
+    def trim (self):
+        first = len(self) - self.max_lines
+        index = [idx for idx in range(len(self)) if idx >= first or self.keep[idx]]
+        self.dropped += len(self) - len(index)
+        self[:]    = [self[idx] for idx in index]
+        self.times = [self.times[idx] for idx in index]
+        self.keep  = [self.keep[idx] for idx in index]
+
+
+class FailureMatcher:
+    # Scan output lines for any of the failure signatures with one regex
+    def __init__(self, fail_lines):
+        self.pattern = re.compile ('|'.join(re.escape(line) for line in fail_lines))
+
+    def feed (self, line):
+        match = self.pattern.search (line)
+        return match.group(0) if match else None
+
+
+def open_log_file (log_file):
+    if log_file.endswith ('.gz'):
+        return gzip.open (log_file, 'wb')
+    return open (log_file, 'wb')
+
+
+class ConsoleSession:
+    # A process whose console output is serviced by ConsoleEngine. Output is
+    # read in binary chunks, split into lines for matching, optionally
+    # echoed to stdout and streamed into a log file.
+    def __init__(self, cmd, timeout = 0, check_lines = None, fail_lines = None, idle_timeout = 0,
+                 log_file = None, echo = None, max_lines = 10000, on_match = None, record_file = None):
+        self.cmd          = cmd
+        self.timeout      = timeout
+        self.idle_timeout = idle_timeout
+        self.matcher      = LineMatcher (check_lines) if check_lines else None
+        self.failer       = FailureMatcher (fail_lines) if fail_lines else None
+        self.log_file     = log_file
+        self.echo         = (log_file is None) if echo is None else echo
+        self.on_match     = on_match
+        self.record_file  = record_file
+        self.recorder     = None
+        self.lines        = ConsoleLog (max_lines)
+        self.partial      = b''
+        self.proc         = None
+        self.span         = None
+        self.log          = None
+        self.killed       = False
+        self.done         = False
+        self.retcode      = None
+
+    def start (self):
+        if self.log_file:
+            self.log = open_log_file (self.log_file)
+        if self.record_file:
+            self.recorder = ConsoleRecorder (self.record_file, self.cmd)
+        self.span = ProcessSpan (self.cmd)
+        self.proc = subprocess.Popen (self.cmd, stdout = subprocess.PIPE, stderr = subprocess.STDOUT, stdin = subprocess.DEVNULL,
+                                      env = self.span.get_env ())
+        self.lines.start = time.monotonic()
+        self.last_time   = self.lines.start
+        return self.proc.stdout
+
+    def stop (self, failure = None):
+        if failure and self.lines.failure is None:
+            self.lines.failure = failure
+        if self.proc.poll() is None:
+            self.killed = True
+            self.proc.terminate ()
+        self.finish ()
+
+    def finish (self):
+        if self.done:
+            return
+        self.done = True
+        if self.partial:
+            self.add_line (self.partial)
+            self.partial = b''
+        try:
+            self.retcode = self.proc.wait (5)
+        except subprocess.TimeoutExpired:
+            self.proc.kill ()
+            self.retcode = self.proc.wait ()
+        self.span.end ()
+        if self.log:
+            self.log.close ()
+        if self.recorder:
+            self.recorder.close (time.monotonic() - self.lines.start, self.retcode, self.killed)
+        if self.matcher and not self.matcher.done() and not self.killed and self.lines.failure is None:
+            # with -no-reboot QEMU exits by itself on reset or triple fault
+            self.lines.failure = 'Process exited with code %d before all check lines were seen' % self.retcode
+
+    def add_line (self, data):
+        line = data.decode ('utf-8', errors = 'replace').rstrip()
+        keep = bool(self.matcher and self.matcher.feed (line))
+        if keep and self.on_match:
+            # called before the process is stopped on the last check line
+            self.on_match (self.matcher.index - 1, line)
+        failure = self.failer.feed (line) if self.failer else None
+        self.lines.add (line, keep or bool(failure))
+        if failure:
+            self.stop ("Detected failure signature '%s'" % failure)
+        elif self.matcher and self.matcher.done():
+            # the result is known, no need to wait for the timeout
+            self.stop ()
+
+    def on_data (self, data):
+        self.last_time = time.monotonic()
+        self.lines.last_output = self.last_time - self.lines.start
+        if self.echo:
+            sys.stdout.buffer.write (data)
+            sys.stdout.flush ()
+        if self.log:
+            self.log.write (data)
+        if self.recorder:
+            self.recorder.add (self.last_time - self.lines.start, data)
+
+        lines = (self.partial + data).split (b'\n')
+        self.partial = b''
+        partial = lines.pop ()
+        for line in lines:
+            self.add_line (line)
+            if self.done:
+                return
+        self.partial = partial
+
+        # prompts such as '=>' are not terminated by a new line
+        if not self.done and self.partial and self.matcher and \
+           self.matcher.is_last (self.partial.decode ('utf-8', errors = 'replace')):
+            line, self.partial = self.partial, b''
+            self.add_line (line)
+
+    def check_timers (self, now):
+        if self.done:
+            return
+        if self.timeout and now - self.lines.start >= self.timeout:
+            self.stop ()
+        elif self.idle_timeout and now - self.last_time >= self.idle_timeout:
+            self.stop ('No console output for %d seconds' % self.idle_timeout)
+
+    def next_deadline (self):
+        deadlines = []
+        if self.timeout:
+            deadlines.append (self.lines.start + self.timeout)
+        if self.idle_timeout:
+            deadlines.append (self.last_time + self.idle_timeout)
+        return min(deadlines) if deadlines else None
+
+
+class ConsoleEngine:
+    # Service the console output of many processes from a single thread,
+    # with at most 'jobs' of them running at a time when it is not 0.
+    def __init__(self, jobs = 0):
+        self.sessions = []
+        self.jobs     = jobs
+
+    def add (self, session):
+        self.sessions.append (session)
+
+    def start_sessions (self, pending, active, start):
+        while pending and (not self.jobs or len(active) < self.jobs):
+            session = pending.pop (0)
+            start (session, session.start ())
+            active.append (session)
+
+    def run (self):
+        if os.name == 'nt':
+            return self.run_threaded ()
+
+        selector = selectors.DefaultSelector ()
+        def start (session, pipe):
+            os.set_blocking (pipe.fileno(), False)
+            selector.register (pipe, selectors.EVENT_READ, session)
+
+        pending = list(self.sessions)
+        active  = []
+        self.start_sessions (pending, active, start)
+        while active:
+            deadlines = [session.next_deadline() for session in active]
+            deadlines = [deadline for deadline in deadlines if deadline is not None]
+            wait = max(0, min(deadlines) - time.monotonic()) if deadlines else None
+            for key, events in selector.select (wait):
+                session = key.data
+                if session.done:
+                    continue
+                try:
+                    data = os.read (key.fileobj.fileno(), 0x10000)
+                except BlockingIOError:
+                    continue
+                if data:
+                    session.on_data (data)
+                else:
+                    session.finish ()
+
+            now = time.monotonic()
+            for session in list(active):
+                session.check_timers (now)
+                if session.done:
+                    selector.unregister (session.proc.stdout)
+                    session.proc.stdout.close ()
+                    active.remove (session)
+            self.start_sessions (pending, active, start)
+
+        selector.close ()
+
+    def run_threaded (self):
+        # pipes can not be polled on Windows, read them with helper threads
+        events = queue.Queue ()
+        def reader (session, pipe):
+            for data in iter(lambda: pipe.read1 (0x10000), b''):
+                events.put ((session, data))
+            events.put ((session, b''))
+
+        def start (session, pipe):
+            threading.Thread (target = reader, args = [session, pipe], daemon = True).start()
+
+        pending = list(self.sessions)
+        active  = []
+        self.start_sessions (pending, active, start)
+        while active:
+            try:
+                session, data = events.get (timeout = 0.1)
+                if not session.done:
+                    if data:
+                        session.on_data (data)
+                    else:
+                        session.finish ()
+            except queue.Empty:
+                pass
+            now = time.monotonic()
+            for session in list(active):
+                session.check_timers (now)
+                if session.done:
+                    active.remove (session)
+            self.start_sessions (pending, active, start)
+
+        for session in self.sessions:
+            session.proc.stdout.close ()
+
+
+def run_process (cmd, timeout = 0, check_lines = None, fail_lines = None, idle_timeout = 0, log_file = None, echo = None, on_match = None,
+                 record_file = None):
+    session = ConsoleSession (cmd, timeout, check_lines, fail_lines, idle_timeout, log_file, echo, on_match = on_match,
+                              record_file = record_file)
+    engine  = ConsoleEngine ()
+    engine.add (session)
+    engine.run ()
+    return session.lines
 
 
 def check_result (output, check_lines):
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+## @ toolchain.py
+#
+# Locate external tools once and remember them across runs
+#
+# Copyright (c) 2021, Intel Corporation. All rights reserved.<BR>
+# SPDX-License-Identifier: BSD-2-Clause-Patent
+#
+##
+
+import os
+import sys
+import json
+import shutil
+import argparse
+
+script_dir     = os.path.dirname (os.path.realpath (__file__))
+TOOLCHAIN_FILE = os.path.normpath (os.path.join (script_dir, '..', 'Outputs', 'toolchain.json'))
+
+# tool name : directories searched before PATH
+if os.name == 'nt':
+    TOOL_DIRS = {
+      'qemu-system-x86_64' : [r'C:\Program Files\qemu'],
+      'qemu-img'           : [r'C:\Program Files\qemu'],
+      'LzmaCompress'       : [script_dir, os.path.join (script_dir, '..', 'SlimBoot', 'BaseTools', 'Bin', 'Win32')],
+    }
+else:
+    TOOL_DIRS = {
+      'LzmaCompress'       : [script_dir, os.path.join (script_dir, '..', 'SlimBoot', 'BaseTools', 'BinWrappers', 'PosixLike')],
+    }
+
+tool_paths = None
+
+
+def load_toolchain (toolchain_file = TOOLCHAIN_FILE):
+    if not os.path.exists (toolchain_file):
+        return {}
+    try:
+        with open (toolchain_file) as fd:
+            return json.load (fd)
+    except ValueError:
+        return {}
+
+
+def save_toolchain (tools, toolchain_file = TOOLCHAIN_FILE):
+    out_dir = os.path.dirname (toolchain_file)
+    if not os.path.exists (out_dir):
+        os.makedirs (out_dir, exist_ok = True)
+    # several test processes may resolve tools at the same time
+    tmp_file = toolchain_file + '.%d.tmp' % os.getpid()
+    with open (tmp_file, 'w') as fd:
+        json.dump (tools, fd, indent = 2, sort_keys = True)
+    os.replace (tmp_file, toolchain_file)
+
+
+def is_entry_valid (entry):
+    # A saved path is reused while PATH is the same and the tool binary has
+    # not been replaced since it was found.
+    if entry.get ('env') != os.environ.get ('PATH', ''):
+        return False
+    try:
+        return os.stat (entry['path']).st_mtime_ns == entry['mtime']
+    except OSError:
+        return False
+
+
+def search_tool (name):
+    for tool_dir in TOOL_DIRS.get (name, []):
+        path = shutil.which (name, path = tool_dir)
+        if path:
+            return os.path.abspath (path)
+    path = shutil.which (name)
+    return os.path.abspath (path) if path else None
+
+
+def find_tool (name, toolchain_file = TOOLCHAIN_FILE):
+    # Return the full path of a tool, or None if it can not be found
+    global tool_paths
+
+    if name == 'python':
+        return sys.executable
+
+    if tool_paths is None:
+        tool_paths = load_toolchain (toolchain_file)
+
+    entry = tool_paths.get (name)
+    if entry and is_entry_valid (entry):
+        return entry['path']
+
+    path = search_tool (name)
+    if path is None:
+        return None
+    tool_paths[name] = {'path' : path, 'mtime' : os.stat (path).st_mtime_ns, 'env' : os.environ.get ('PATH', '')}
+    save_toolchain (tool_paths, toolchain_file)
+    return path
+
+
+def get_tool (name):
+    # Same as find_tool, but falls back to the bare name so that a missing
+    # tool fails at the point it is launched.
+    return find_tool (name) or name
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('tools', nargs='*', help='Tool names to resolve',
+                        default = ['python', 'strip', 'qemu-system-x86_64', 'qemu-img', 'LzmaCompress'])
+    parser.add_argument('-r', dest='refresh', action='store_true', help='Discard the saved tool paths')
+    args = parser.parse_args()
+
+    if args.refresh and os.path.exists (TOOLCHAIN_FILE):
+        os.remove (TOOLCHAIN_FILE)
+
+    missing = 0
+    for name in args.tools:
+        path = find_tool (name)
+        if path is None:
+            missing += 1
+        print ('%-20s %s' % (name, path or 'NOT FOUND'))
+    return 1 if missing else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+## @ trace_prof.py
+#
+# Timing spans for build and test stages and for the processes they run
+#
+# Copyright (c) 2021, Intel Corporation. All rights reserved.<BR>
+# SPDX-License-Identifier: BSD-2-Clause-Patent
+#
+##
+
+import os
+import sys
+import json
+import glob
+import time
+import atexit
+import shutil
+import argparse
+import threading
+import contextlib
+import subprocess
+
+# Each process appends its finished spans to <trace dir>/<pid>.jsonl, so
+# that processes started by QEMU test cases and process pools are kept even
+# when they exit without running atexit handlers. The trace directory and
+# the parent span of a child process are passed through the environment.
+TRACE_DIR_ENV    = 'UPLD_TRACE_DIR'
+TRACE_PARENT_ENV = 'UPLD_TRACE_PARENT'
+
+tracer = None
+
+
+class Tracer:
+    def __init__(self, trace_dir, parent = ''):
+        self.trace_dir = trace_dir
+        self.parent    = parent
+        self.stacks    = {}
+        self.reset ()
+
+    def reset (self):
+        # also called in a forked child, whose spans belong to the span
+        # that was open in the parent when it forked
+        self.parent    = self.get_parent ()
+        self.pid       = os.getpid()
+        self.count     = 0
+        self.lock      = threading.Lock()
+        self.stacks    = {}
+        self.main_tid  = threading.get_ident()
+
+    def new_id (self):
+        with self.lock:
+            self.count += 1
+            return '%d.%d' % (self.pid, self.count)
+
+    def get_parent (self):
+        # spans in worker threads without an open span belong to the
+        # innermost span of the main thread
+        stack = self.stacks.get (threading.get_ident()) or self.stacks.get (getattr (self, 'main_tid', 0))
+        return stack[-1] if stack else self.parent
+
+    def push (self, span_id):
+        self.stacks.setdefault (threading.get_ident(), []).append (span_id)
+
+    def pop (self):
+        self.stacks[threading.get_ident()].pop ()
+
+    def write (self, record):
+        record['pid'] = self.pid
+        record['tid'] = threading.get_ident()
+        with self.lock:
+            with open (os.path.join (self.trace_dir, '%d.jsonl' % self.pid), 'a') as fd:
+                fd.write (json.dumps (record) + '\n')
+
+
+def get_peak_rss ():
+    # ru_maxrss is in KB on Linux, resource only exists on Unix and is only
+    # needed once tracing is enabled there
+    import resource
+    return resource.getrusage (resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def get_current_rss ():
+    try:
+        with open ('/proc/self/statm') as fd:
+            return int(fd.read ().split ()[1]) * os.sysconf ('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+@contextlib.contextmanager
+def span (name, cat = 'stage'):
+    # Record the wall time, the CPU time of the current thread and the peak
+    # RSS of the current process for a block of code.
+    if tracer is None:
+        yield
+        return
+
+    span_id = tracer.new_id ()
+    parent  = tracer.get_parent ()
+    start   = time.time()
+    cpu     = time.thread_time()
+    tracer.push (span_id)
+    try:
+        yield
+    finally:
+        tracer.pop ()
+        tracer.write ({'id' : span_id, 'parent' : parent, 'name' : name, 'cat' : cat, 'start' : start,
+                       'end' : time.time(), 'cpu' : time.thread_time() - cpu, 'rss' : get_peak_rss ()})
+
+
+def get_children_usage ():
+    # CPU time and peak RSS of all reaped child processes
+    import resource
+    usage = resource.getrusage (resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime, usage.ru_maxrss * 1024
+
+
+def get_process_name (args):
+    if isinstance (args, (str, bytes)):
+        argv = str(args).split ()
+    else:
+        argv = [str(arg) for arg in args]
+    return ' '.join ([os.path.basename (argv[0])] + argv[1:3]) if argv else 'process'
+
+
+class ProcessSpan:
+    # Span of a child process, from before it is started until after it is
+    # reaped. The CPU time is the growth of RUSAGE_CHILDREN in that time, so
+    # it also counts other children reaped meanwhile, such as those of
+    # parallel build tasks. The children peak RSS is a maximum, it is only
+    # known when this child raised it. Linux also keeps the peak RSS across
+    # exec, so a child starts with the RSS of the process that forked it, a
+    # peak that is not above that is recorded as unknown.
+    def __init__(self, cmd):
+        self.span_id = None
+        if tracer is None:
+            return
+        self.span_id = tracer.new_id ()
+        self.parent  = tracer.get_parent ()
+        self.name    = get_process_name (cmd)
+        self.start   = time.time()
+        self.base    = get_current_rss ()
+        self.usage   = get_children_usage ()
+
+    def get_env (self, env = None):
+        # the environment for the child, so that a traced child nests its spans here
+        if self.span_id is None:
+            return env
+        env = dict(os.environ if env is None else env)
+        env[TRACE_PARENT_ENV] = self.span_id
+        return env
+
+    def end (self):
+        if self.span_id is None:
+            return
+        cpu, rss = get_children_usage ()
+        tracer.write ({'id' : self.span_id, 'parent' : self.parent, 'name' : self.name, 'cat' : 'process',
+                       'start' : self.start, 'end' : time.time(), 'cpu' : cpu - self.usage[0],
+                       'rss' : rss if rss > max(self.usage[1], self.base) else None})
+        self.span_id = None
+
+
+def traced_call (cmd, **kwargs):
+    # subprocess.call with a span for the process
+    proc_span = ProcessSpan (cmd)
+    kwargs['env'] = proc_span.get_env (kwargs.get ('env'))
+    try:
+        return subprocess.call (cmd, **kwargs)
+    finally:
+        proc_span.end ()
+
+
+def traced_check_output (cmd, **kwargs):
+    # subprocess.check_output with a span for the process
+    proc_span = ProcessSpan (cmd)
+    kwargs['env'] = proc_span.get_env (kwargs.get ('env'))
+    try:
+        return subprocess.check_output (cmd, **kwargs)
+    finally:
+        proc_span.end ()
+
+
+def can_trace ():
+    # getrusage only exists on Unix
+    try:
+        import resource
+    except ImportError:
+        return False
+    return True
+
+
+def enable_tracing (trace_dir, parent = ''):
+    global tracer
+    if tracer is not None or not can_trace ():
+        return
+    if not os.path.exists (trace_dir):
+        os.makedirs (trace_dir, exist_ok = True)
+    os.environ[TRACE_DIR_ENV] = os.path.realpath (trace_dir)
+    tracer = Tracer (os.path.realpath (trace_dir), parent)
+    os.register_at_fork (after_in_child = tracer.reset)
+
+
+def start_profile (trace_file, name):
+    # Trace the current process and its children, and write the merged trace
+    # and a summary when the process exits.
+    if not can_trace ():
+        print ('Tracing is not supported on this platform, ignoring --profile')
+        return
+    trace_dir = os.path.splitext (trace_file)[0] + '.d'
+    if os.path.exists (trace_dir):
+        shutil.rmtree (trace_dir)
+    enable_tracing (trace_dir)
+    root = span (name, 'run')
+    root.__enter__ ()
+
+    def finish ():
+        root.__exit__ (None, None, None)
+        spans = load_spans (trace_dir)
+        write_chrome_trace (spans, trace_file)
+        print_summary (spans)
+        print ('Trace is saved in %s' % trace_file)
+
+    atexit.register (finish)
+
+
+def load_spans (trace_dir):
+    spans = []
+    for file in sorted(glob.glob (os.path.join (trace_dir, '*.jsonl'))):
+        with open (file) as fd:
+            for line in fd:
+                if line.strip ():
+                    spans.append (json.loads (line))
+    return spans
+
+
+def write_chrome_trace (spans, trace_file):
+    base   = min([span['start'] for span in spans] or [0])
+    events = []
+    for span in spans:
+        events.append ({
+          'name' : span['name'], 'cat' : span['cat'], 'ph' : 'X',
+          'ts'   : round((span['start'] - base) * 1e6), 'dur' : round((span['end'] - span['start']) * 1e6),
+          'pid'  : span['pid'], 'tid' : span['tid'],
+          'args' : {'id' : span['id'], 'parent' : span['parent'], 'cpu_ms' : round(span['cpu'] * 1000, 1),
+                    'peak_rss_mb' : None if span['rss'] is None else round(span['rss'] / 1048576.0, 1)},
+        })
+    out_dir = os.path.dirname (trace_file)
+    if out_dir and not os.path.exists (out_dir):
+        os.makedirs (out_dir)
+    with open (trace_file, 'w') as fd:
+        json.dump ({'traceEvents' : events, 'displayTimeUnit' : 'ms'}, fd)
+
+
+def print_summary (spans, top = 15):
+    # Self time is the span time not covered by its child spans, it shows
+    # where the time is really spent rather than which stage contains it.
+    children = {}
+    for span in spans:
+        children.setdefault (span['parent'], []).append (span)
+
+    rows = []
+    for span in spans:
+        total  = span['end'] - span['start']
+        nested = sum(child['end'] - child['start'] for child in children.get (span['id'], []))
+        rows.append ((max(0, total - nested), total, span))
+
+    print ('\n%-40s %-8s %10s %10s %10s %10s' % ('Span', 'Kind', 'Self(s)', 'Total(s)', 'CPU(s)', 'RSS(MB)'))
+    for self_time, total, span in sorted(rows, key = lambda row: -row[0])[:top]:
+        rss = '-' if span['rss'] is None else '%.1f' % (span['rss'] / 1048576.0)
+        print ('%-40s %-8s %10.2f %10.2f %10.2f %10s' % (span['name'][:40], span['cat'], self_time, total,
+                                                        span['cpu'], rss))
+    print ('')
+
+
+# child processes of a traced run trace themselves
+if os.environ.get (TRACE_DIR_ENV):
+    enable_tracing (os.environ[TRACE_DIR_ENV], os.environ.get (TRACE_PARENT_ENV, ''))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('trace_dir', type=str, help='Directory with the spans of a traced run')
+    parser.add_argument('-o', dest='trace_file', type=str, help='Chrome trace output file', default = '')
+    parser.add_argument('-n', dest='top', type=int, help='Number of top spans to show', default = 15)
+    args = parser.parse_args()
+
+    spans = load_spans (args.trace_dir)
+    if args.trace_file:
+        write_chrome_trace (spans, args.trace_file)
+    print_summary (spans, args.top)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
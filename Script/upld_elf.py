@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+## @ upld_elf.py
+#
+# Universal Payload ELF section injector
+#
+# Copyright (c) 2021, Intel Corporation. All rights reserved.<BR>
+# SPDX-License-Identifier: BSD-2-Clause-Patent
+#
+##
+
+import os
+import sys
+import mmap
+import shutil
+import argparse
+from   ctypes import LittleEndianStructure, c_uint8, c_uint16, c_uint32, c_uint64, sizeof, ARRAY
+
+SHT_PROGBITS = 1
+SHT_NOBITS   = 8
+
+class Elf32_Ehdr(LittleEndianStructure):
+    _pack_ = 1
+    _fields_ = [
+        ('e_ident',              ARRAY(c_uint8, 16)),
+        ('e_type',               c_uint16),
+        ('e_machine',            c_uint16),
+        ('e_version',            c_uint32),
+        ('e_entry',              c_uint32),
+        ('e_phoff',              c_uint32),
+        ('e_shoff',              c_uint32),
+        ('e_flags',              c_uint32),
+        ('e_ehsize',             c_uint16),
+        ('e_phentsize',          c_uint16),
+        ('e_phnum',              c_uint16),
+        ('e_shentsize',          c_uint16),
+        ('e_shnum',              c_uint16),
+        ('e_shstrndx',           c_uint16),
+        ]
+
+class Elf64_Ehdr(LittleEndianStructure):
+    _pack_ = 1
+    _fields_ = [
+        ('e_ident',              ARRAY(c_uint8, 16)),
+        ('e_type',               c_uint16),
+        ('e_machine',            c_uint16),
+        ('e_version',            c_uint32),
+        ('e_entry',              c_uint64),
+        ('e_phoff',              c_uint64),
+        ('e_shoff',              c_uint64),
+        ('e_flags',              c_uint32),
+        ('e_ehsize',             c_uint16),
+        ('e_phentsize',          c_uint16),
+        ('e_phnum',              c_uint16),
+        ('e_shentsize',          c_uint16),
+        ('e_shnum',              c_uint16),
+        ('e_shstrndx',           c_uint16),
+        ]
+
+class Elf32_Shdr(LittleEndianStructure):
+    _pack_ = 1
+    _fields_ = [
+        ('sh_name',              c_uint32),
+        ('sh_type',              c_uint32),
+        ('sh_flags',             c_uint32),
+        ('sh_addr',              c_uint32),
+        ('sh_offset',            c_uint32),
+        ('sh_size',              c_uint32),
+        ('sh_link',              c_uint32),
+        ('sh_info',              c_uint32),
+        ('sh_addralign',         c_uint32),
+        ('sh_entsize',           c_uint32),
+        ]
+
+class Elf64_Shdr(LittleEndianStructure):
+    _pack_ = 1
+    _fields_ = [
+        ('sh_name',              c_uint32),
+        ('sh_type',              c_uint32),
+        ('sh_flags',             c_uint64),
+        ('sh_addr',              c_uint64),
+        ('sh_offset',            c_uint64),
+        ('sh_size',              c_uint64),
+        ('sh_link',              c_uint32),
+        ('sh_info',              c_uint32),
+        ('sh_addralign',         c_uint64),
+        ('sh_entsize',           c_uint64),
+        ]
+
+
+class ElfFile:
+    # Parsed ELF header, section headers and section names of an ELF image.
+    # 'data' can be any buffer object, such as bytes or mmap.
+    def __init__(self, data):
+        if bytes(data[0:4]) != b'\x7fELF':
+            raise Exception ('Not a valid ELF image !')
+        if data[5] != 1:
+            raise Exception ('Only little endian ELF image is supported !')
+        if data[4] == 1:
+            self.is_64 = False
+            ehdr_type, shdr_type = Elf32_Ehdr, Elf32_Shdr
+        elif data[4] == 2:
+            self.is_64 = True
+            ehdr_type, shdr_type = Elf64_Ehdr, Elf64_Shdr
+        else:
+            raise Exception ('Unknown ELF class %d !' % data[4])
+
+        self.shdr_type = shdr_type
+        self.ehdr      = ehdr_type.from_buffer_copy (data[0:sizeof(ehdr_type)])
+        if self.ehdr.e_shnum and self.ehdr.e_shentsize != sizeof(shdr_type):
+            raise Exception ('Unexpected ELF section header size %d !' % self.ehdr.e_shentsize)
+
+        self.shdrs = []
+        for idx in range(self.ehdr.e_shnum):
+            offset = self.ehdr.e_shoff + idx * sizeof(shdr_type)
+            self.shdrs.append (shdr_type.from_buffer_copy (data[offset:offset + sizeof(shdr_type)]))
+
+        self.shstrtab = b''
+        if self.ehdr.e_shstrndx < len(self.shdrs):
+            shdr = self.shdrs[self.ehdr.e_shstrndx]
+            self.shstrtab = bytes(data[shdr.sh_offset:shdr.sh_offset + shdr.sh_size])
+
+    def get_name (self, shdr):
+        end = self.shstrtab.find (b'\x00', shdr.sh_name)
+        return self.shstrtab[shdr.sh_name:end].decode()
+
+    def get_section (self, name):
+        for shdr in self.shdrs:
+            if self.get_name (shdr) == name:
+                return shdr
+        return None
+
+    def get_sections (self):
+        return [(self.get_name (shdr), shdr) for shdr in self.shdrs]
+
+    def get_body_end (self, file_size):
+        # Return the end of the file content that needs to be kept when the
+        # section header table is moved to the end of the file.
+        end = self.ehdr.e_phoff + self.ehdr.e_phnum * self.ehdr.e_phentsize
+        for idx, shdr in enumerate(self.shdrs):
+            if shdr.sh_type == SHT_NOBITS or idx == self.ehdr.e_shstrndx:
+                continue
+            end = max(end, shdr.sh_offset + shdr.sh_size)
+        if end > self.ehdr.e_shoff:
+            # something follows the section header table, keep the whole file
+            return file_size
+        return self.ehdr.e_shoff
+
+
+def align_up (value, align):
+    if align <= 1:
+        return value
+    return (value + align - 1) & ~(align - 1)
+
+
+def copy_file_range (out_fd, in_fd, offset, count):
+    # Copy file content without loading it into memory
+    if hasattr(os, 'sendfile'):
+        while count > 0:
+            copied = os.sendfile (out_fd, in_fd, offset, count)
+            if copied == 0:
+                raise Exception ('Unexpected end of file during copy !')
+            offset += copied
+            count  -= copied
+    else:
+        os.lseek (in_fd, offset, os.SEEK_SET)
+        while count > 0:
+            data = os.read (in_fd, min(count, 0x100000))
+            if not data:
+                raise Exception ('Unexpected end of file during copy !')
+            os.write (out_fd, data)
+            count -= len(data)
+
+
+def add_sections (elf_file, sections, out_file = None):
+    # Add new sections into an ELF image in a single pass.
+    # sections is a list of (name, data, alignment), where data is either
+    # bytes or the path of the file providing the section content.
+    if out_file is None:
+        out_file = elf_file
+
+    with open (elf_file, 'rb') as fd:
+        file_size = os.fstat(fd.fileno()).st_size
+        with mmap.mmap (fd.fileno(), 0, access = mmap.ACCESS_READ) as data:
+            elf = ElfFile (data)
+
+    if elf.ehdr.e_shstrndx >= len(elf.shdrs):
+        raise Exception ('ELF image %s has no section name table !' % elf_file)
+
+    existing = set(name for name, shdr in elf.get_sections())
+    shstrtab = bytearray(elf.shstrtab)
+    new_shdrs = []
+    for name, sec_data, align in sections:
+        if name in existing:
+            raise Exception ("Section '%s' already exists in %s !" % (name, elf_file))
+        existing.add (name)
+        shdr = elf.shdr_type ()
+        shdr.sh_name      = len(shstrtab)
+        shdr.sh_type      = SHT_PROGBITS
+        shdr.sh_addralign = align
+        shstrtab.extend (name.encode() + b'\x00')
+        new_shdrs.append (shdr)
+
+    tmp_file = out_file + '.tmp'
+    with open (elf_file, 'rb') as in_fd, open (tmp_file, 'wb') as out_fd:
+        body_end = elf.get_body_end (file_size)
+        copy_file_range (out_fd.fileno(), in_fd.fileno(), 0, body_end)
+        offset = body_end
+
+        # append section contents with the required alignment
+        for (name, sec_data, align), shdr in zip(sections, new_shdrs):
+            pad = align_up (offset, align) - offset
+            os.write (out_fd.fileno(), b'\x00' * pad)
+            offset += pad
+            shdr.sh_offset = offset
+            if isinstance(sec_data, (bytes, bytearray)):
+                os.write (out_fd.fileno(), sec_data)
+                shdr.sh_size = len(sec_data)
+            else:
+                with open (sec_data, 'rb') as sec_fd:
+                    shdr.sh_size = os.fstat(sec_fd.fileno()).st_size
+                    copy_file_range (out_fd.fileno(), sec_fd.fileno(), 0, shdr.sh_size)
+            offset += shdr.sh_size
+
+        # new section name table
+        strtab_shdr = elf.shdrs[elf.ehdr.e_shstrndx]
+        strtab_shdr.sh_offset = offset
+        strtab_shdr.sh_size   = len(shstrtab)
+        os.write (out_fd.fileno(), shstrtab)
+        offset += len(shstrtab)
+
+        # new section header table
+        pad = align_up (offset, 8 if elf.is_64 else 4) - offset
+        os.write (out_fd.fileno(), b'\x00' * pad)
+        offset += pad
+        shdr_data = bytearray()
+        for shdr in elf.shdrs + new_shdrs:
+            shdr_data.extend (bytearray(shdr))
+        os.write (out_fd.fileno(), shdr_data)
+
+        # update ELF header
+        elf.ehdr.e_shoff = offset
+        elf.ehdr.e_shnum = len(elf.shdrs) + len(new_shdrs)
+        os.lseek (out_fd.fileno(), 0, os.SEEK_SET)
+        os.write (out_fd.fileno(), bytearray(elf.ehdr))
+
+    shutil.copymode (elf_file, tmp_file)
+    os.replace (tmp_file, out_file)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('elf_file', type=str, help='ELF image file path')
+    parser.add_argument('-s', '--add-section', dest='sections', action='append', default=[],
+                        help='Section to add in format NAME=FILE[:ALIGN]')
+    parser.add_argument('-o', '--output', dest='out_file', type=str, help='Output ELF image file path')
+    args = parser.parse_args()
+
+    sections = []
+    for section in args.sections:
+        name, path = section.split('=', 1)
+        align = 1
+        if ':' in path:
+            path, align = path.rsplit(':', 1)
+            align = int(align, 0)
+        sections.append ((name, path, align))
+
+    add_sections (args.elf_file, sections, args.out_file)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+## @ upld_footprint.py
+#
+# Universal Payload image footprint and compression analyzer
+#
+# Copyright (c) 2021, Intel Corporation. All rights reserved.<BR>
+# SPDX-License-Identifier: BSD-2-Clause-Patent
+#
+##
+
+import os
+import sys
+import glob
+import json
+import lzma
+import time
+import argparse
+from   upld_elf  import ElfFile, SHT_NOBITS
+from   upld_swap import COMPRESS_FILE, lzma_compress_data
+
+# LZMA settings to try, the SBL decompressor only handles plain LZMA with
+# lc=3 lp=0 pb=2, so x86 BCJ is measured for reference but never applied.
+LZMA_TRIALS = [
+  ('preset %d' % preset, {'preset' : preset}, False) for preset in range(10)
+] + [
+  ('preset 9e',         {'preset' : 9 | lzma.PRESET_EXTREME}, False),
+  ('preset 9e dict 1M', {'preset' : 9 | lzma.PRESET_EXTREME, 'dict_size' : 1 << 20}, False),
+  ('preset 9e + BCJ',   {'preset' : 9 | lzma.PRESET_EXTREME}, True),
+]
+
+
+def get_header_end (elf):
+    return max(elf.ehdr.e_ehsize, elf.ehdr.e_phoff + elf.ehdr.e_phnum * elf.ehdr.e_phentsize)
+
+
+def get_section_padding (data):
+    # Return [(name, offset, size, align, padding)] in file order, padding
+    # is the gap between the previous section data and this section.
+    elf      = ElfFile (data)
+    sections = [(shdr.sh_offset, name, shdr) for name, shdr in elf.get_sections ()
+                if shdr.sh_type != SHT_NOBITS and shdr.sh_size]
+    prev_end = get_header_end (elf)
+    report   = []
+    for offset, name, shdr in sorted(sections, key = lambda item: item[0]):
+        report.append ((name, offset, shdr.sh_size, shdr.sh_addralign, max(0, offset - prev_end)))
+        prev_end = max(prev_end, offset + shdr.sh_size)
+    return report
+
+
+def get_bcj_filters (preset, dict_size):
+    return [{'id' : lzma.FILTER_X86},
+            {'id' : lzma.FILTER_LZMA1, 'preset' : preset, 'dict_size' : dict_size, 'lc' : 3, 'lp' : 0, 'pb' : 2}]
+
+
+def measure (func, repeat):
+    best = None
+    for idx in range(repeat):
+        start  = time.perf_counter ()
+        result = func ()
+        spent  = time.perf_counter () - start
+        best   = spent if best is None else min(best, spent)
+    return result, best
+
+
+def try_compress (data, setting, bcj, repeat = 3):
+    # Return (compressed size, compress seconds, decompress seconds)
+    if bcj:
+        filters = get_bcj_filters (setting['preset'], setting.get ('dict_size', 1 << 22))
+        comp, comp_time = measure (lambda: lzma.compress (data, format = lzma.FORMAT_RAW, filters = filters), 1)
+        size = len(comp) + 13
+        out, dec_time = measure (lambda: lzma.decompress (comp, format = lzma.FORMAT_RAW, filters = filters), repeat)
+    else:
+        comp, comp_time = measure (lambda: lzma_compress_data (data, **setting), 1)
+        size = len(comp)
+        props = comp[:13]
+        dict_size = int.from_bytes (props[1:5], 'little')
+        filters = [{'id' : lzma.FILTER_LZMA1, 'dict_size' : dict_size, 'lc' : 3, 'lp' : 0, 'pb' : 2}]
+        out, dec_time = measure (lambda: lzma.decompress (comp[13:], format = lzma.FORMAT_RAW, filters = filters), repeat)
+    if out[:len(data)] != data:
+        raise Exception ('LZMA round trip failed for %s !' % setting)
+    return size, comp_time, dec_time
+
+
+def analyze_payload (elf_file, goal = 'size', repeat = 3):
+    with open (elf_file, 'rb') as fd:
+        data = fd.read ()
+
+    print ('\n%s: %d bytes' % (elf_file, len(data)))
+    print ('  %-16s %10s %10s %6s %8s' % ('Section', 'Offset', 'Size', 'Align', 'Padding'))
+    total = 0
+    for name, offset, size, align, padding in get_section_padding (bytearray(data)):
+        print ('  %-16s %10x %10d %6d %8d' % (name, offset, size, align, padding))
+        total += padding
+    print ('  Alignment padding: %d bytes (%.2f%%)' % (total, total * 100.0 / len(data)))
+
+    print ('\n  %-20s %10s %8s %12s %12s' % ('Setting', 'Size', 'Ratio', 'Compress(ms)', 'Decomp(ms)'))
+    results = []
+    for label, setting, bcj in LZMA_TRIALS:
+        size, comp_time, dec_time = try_compress (data, setting, bcj, repeat)
+        results.append ((label, setting, bcj, size, dec_time))
+        print ('  %-20s %10d %7.2f%% %12.1f %12.2f%s' % (label, size, size * 100.0 / len(data), comp_time * 1000,
+                                                     dec_time * 1000, '  (not supported by SBL)' if bcj else ''))
+
+    # decompression time on the host is a proxy for the boot time cost
+    usable = [result for result in results if not result[2]]
+    if goal == 'speed':
+        best = min(usable, key = lambda result: (result[4], result[3]))
+    else:
+        best = min(usable, key = lambda result: (result[3], result[4]))
+    print ('\n  Recommended for %s: %s (%d bytes, %.2f ms to decompress)' % (goal, best[0], best[3], best[4] * 1000))
+    return best[1]
+
+
+def save_setting (elf_file, setting, compress_file = COMPRESS_FILE):
+    settings = {}
+    if os.path.exists (compress_file):
+        with open (compress_file) as fd:
+            settings = json.load (fd)
+    settings[os.path.basename (elf_file)] = setting
+    out_dir = os.path.dirname (compress_file)
+    if out_dir and not os.path.exists (out_dir):
+        os.makedirs (out_dir)
+    with open (compress_file, 'w') as fd:
+        json.dump (settings, fd, indent = 2, sort_keys = True)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('elf_files', nargs='*', help='Universal payload ELF images, default is Outputs/*Pld*.elf')
+    parser.add_argument('-g', dest='goal', choices=['size', 'speed'], help='Optimize for container size or decompression time', default = 'size')
+    parser.add_argument('-n', dest='repeat', type=int, help='Number of decompression runs to time', default = 3)
+    parser.add_argument('-a', dest='apply', action='store_true', help='Save the recommended setting for upld_swap.py')
+    parser.add_argument('-o', dest='compress_file', type=str, help='Compression setting file, pass it to upld_swap.py with -z or UPLD_COMPRESS_FILE', default = COMPRESS_FILE)
+    args = parser.parse_args()
+
+    elf_files = args.elf_files or sorted(glob.glob ('Outputs/*Pld*.elf'))
+    if not elf_files:
+        print ('No payload image found !')
+        return 1
+
+    for elf_file in elf_files:
+        setting = analyze_payload (elf_file, args.goal, args.repeat)
+        if args.apply:
+            save_setting (elf_file, setting, args.compress_file)
+            print ('  Saved setting into %s' % args.compress_file)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+## @ upld_inspect.py
+#
+# Universal Payload ELF image pre-flight checker
+#
+# Copyright (c) 2021, Intel Corporation. All rights reserved.<BR>
+# SPDX-License-Identifier: BSD-2-Clause-Patent
+#
+##
+
+import os
+import sys
+import mmap
+import time
+import hashlib
+import argparse
+from   ctypes    import sizeof
+from   upld_elf  import ElfFile, SHT_NOBITS
+from   upld_info import UPLD_INFO_HEADER
+
+# payload name : (ImageId, 64-bit ELF, {section : minimum alignment})
+PAYLOAD_RULES = {
+  'uboot_32' : ('u-boot',  False, {'.upld_info' : 16}),
+  'linux_32' : ('Linux32', False, {'.upld_info' : 16, '.upld.kernel' : 256, '.upld.initrd' : 4096, '.upld.cmdline' : 16}),
+  'linux_64' : ('Linux64', True,  {'.upld_info' : 16, '.upld.kernel' : 256, '.upld.initrd' : 4096, '.upld.cmdline' : 16}),
+  'uefi_32'  : ('UEFI32',  False, {'.upld_info' : 16, '.upld.uefi_fv' : 4096}),
+  'uefi_64'  : ('UEFI64',  True,  {'.upld_info' : 16, '.upld.uefi_fv' : 4096}),
+}
+
+
+def get_data_hash (data):
+    return hashlib.sha256 (data).hexdigest()
+
+
+def check_uefi_fv (data, elf_file, pld_name, problems):
+    # The FV embedded in the payload must be the one built for the same arch
+    if bytes(data[0x28:0x2c]) != b'_FVH':
+        problems.append ("Section '.upld.uefi_fv' does not contain a firmware volume")
+        return
+
+    out_dir = os.path.dirname (elf_file)
+    target  = pld_name.split('_')[-1]
+    fv_hash = get_data_hash (data)
+    for fv_target in ['32', '64']:
+        fv_file = os.path.join (out_dir, 'DXEFV%s.fv' % fv_target)
+        if not os.path.exists (fv_file):
+            continue
+        with open (fv_file, 'rb') as fd:
+            same = get_data_hash (fd.read ()) == fv_hash
+        if fv_target == target and not same:
+            problems.append ("Section '.upld.uefi_fv' does not match %s" % fv_file)
+        if fv_target != target and same:
+            problems.append ("Section '.upld.uefi_fv' contains %s built for the wrong arch" % fv_file)
+
+
+def check_linux_kernel (data, problems):
+    if bytes(data[0x202:0x206]) != b'HdrS':
+        problems.append ("Section '.upld.kernel' is not a bzImage kernel")
+
+
+def inspect_payload (elf_file, pld_name):
+    # Return a list of problems found in the payload image
+    if pld_name not in PAYLOAD_RULES:
+        return ["Unknown payload type '%s'" % pld_name]
+    image_id, is_64, sec_rules = PAYLOAD_RULES[pld_name]
+
+    if not os.path.exists (elf_file):
+        return ['Payload image %s does not exist' % elf_file]
+
+    problems = []
+    with open (elf_file, 'rb') as fd:
+        file_size = os.fstat(fd.fileno()).st_size
+        # copy-on-write mapping allows ctypes structures to be decoded in place
+        with mmap.mmap (fd.fileno(), 0, access = mmap.ACCESS_COPY) as data:
+            try:
+                elf = ElfFile (data)
+            except Exception as ex:
+                return [str(ex)]
+
+            if elf.is_64 != is_64:
+                problems.append ('Payload should be a %d-bit ELF image' % (64 if is_64 else 32))
+
+            sections = {}
+            for name, shdr in elf.get_sections ():
+                if name in sections and name in sec_rules:
+                    problems.append ("Section '%s' is duplicated" % name)
+                sections[name] = shdr
+
+            for name, align in sorted(sec_rules.items()):
+                shdr = sections.get (name)
+                if shdr is None:
+                    problems.append ("Section '%s' is missing" % name)
+                    continue
+                if shdr.sh_type == SHT_NOBITS or shdr.sh_size == 0:
+                    problems.append ("Section '%s' is empty" % name)
+                    continue
+                if shdr.sh_offset + shdr.sh_size > file_size:
+                    problems.append ("Section '%s' exceeds the end of file" % name)
+                    continue
+                if shdr.sh_addralign < align or shdr.sh_offset % align:
+                    problems.append ("Section '%s' should be aligned to %d (alignment %d, offset 0x%x)" % \
+                                     (name, align, shdr.sh_addralign, shdr.sh_offset))
+
+                sec_data = memoryview(data)[shdr.sh_offset:shdr.sh_offset + shdr.sh_size]
+                if name == '.upld_info':
+                    if shdr.sh_size < sizeof(UPLD_INFO_HEADER):
+                        problems.append ("Section '.upld_info' is too small")
+                    else:
+                        info = UPLD_INFO_HEADER.from_buffer (data, shdr.sh_offset)
+                        if info.Identifier != b'UPLD':
+                            problems.append ("Invalid UPLD_INFO_HEADER identifier '%s'" % info.Identifier.decode(errors = 'replace'))
+                        if info.HeaderLength != sizeof(UPLD_INFO_HEADER):
+                            problems.append ('Invalid UPLD_INFO_HEADER length %d' % info.HeaderLength)
+                        if info.ImageId != image_id.encode():
+                            problems.append ("ImageId is '%s', expecting '%s'" % (info.ImageId.decode(errors = 'replace'), image_id))
+                        del info
+                elif name == '.upld.uefi_fv':
+                    check_uefi_fv (sec_data, elf_file, pld_name, problems)
+                elif name == '.upld.kernel':
+                    check_linux_kernel (sec_data, problems)
+                sec_data.release ()
+
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('elf_file', type=str, help='Universal payload ELF image file path')
+    parser.add_argument('pld_name', type=str, choices=sorted(PAYLOAD_RULES.keys()), help='Payload type')
+    args = parser.parse_args()
+
+    start    = time.time()
+    problems = inspect_payload (args.elf_file, args.pld_name)
+    for problem in problems:
+        print ('  %s' % problem)
+    print ('Inspected %s in %.1f ms: %s' % (args.elf_file, (time.time() - start) * 1000, 'FAILED' if problems else 'PASSED'))
+
+    return 1 if problems else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -12,62 +12,261 @@
 import os
 import sys
 import glob
+import mmap
+import lzma
+import struct
 import threading
 import platform
 import argparse
+import json
 import hashlib
+import shutil
+import traceback
 import subprocess
 from   shutil import copy
 
+from   toolchain import find_tool
+from   trace_prof import span
+
 script_dir = os.path.dirname(__file__)
 tool_dir   = script_dir + '/../SlimBoot/BootloaderCorePkg/Tools'
-sys.path.insert(0, tool_dir)
-from CommonUtility import *
-from BuildUtility  import gen_hash_file, HashStoreData, HashStoreTable
 
+# per payload LZMA settings, written by upld_footprint.py, another file
+# can be given in the UPLD_COMPRESS_FILE environment variable
+COMPRESS_FILE = 'Outputs/upld_compress.json'
 
-def swap_payload (args):
 
-    if 'SBL_KEY_DIR' not in os.environ:
-        os.environ['SBL_KEY_DIR'] = "SblKeys/"
+def load_sbl_tools ():
+    # The SlimBoot tool modules are slow to import and are not needed for
+    # --help or a cache hit, so they are only loaded on first use.
+    if tool_dir not in sys.path:
+        sys.path.insert(0, tool_dir)
+    import CommonUtility
+    return CommonUtility
 
-    out_dir  = 'Outputs'
 
+def load_swap_tools ():
+    # CommonUtility, GenContainer and the IFWI parser used for a swap
+    util = load_sbl_tools ()
+    import GenContainer
+    from   IfwiUtility import IFWI_PARSER
+    return util, GenContainer, IFWI_PARSER
+
+
+def get_compress_tool_dir ():
+    tool = find_tool ('LzmaCompress')
+    if tool:
+        return os.path.dirname (tool)
     if os.name == 'nt':
-        if os.path.exists (os.path.join (script_dir, 'LzmaCompress.exe')):
-            compress_tool_dir = script_dir
+        return os.path.realpath (os.path.join (script_dir, '../SlimBoot/BaseTools/Bin/Win32'))
+    return os.path.realpath (os.path.join (script_dir, '../SlimBoot/BaseTools/BinWrappers/PosixLike'))
+
+
+def get_compress_file ():
+    return os.environ.get ('UPLD_COMPRESS_FILE') or COMPRESS_FILE
+
+
+def load_compress_setting (payload_bin, compress_file = None):
+    # Return the LZMA setting chosen for a payload, {} means the defaults
+    compress_file = compress_file or get_compress_file ()
+    if not os.path.exists (compress_file):
+        return {}
+    with open (compress_file) as fd:
+        return json.load (fd).get (os.path.basename (payload_bin), {})
+
+
+def lzma_compress_data (data, dict_size = 1 << 22, preset = 9):
+    # Produce the same stream layout as the EDK II LzmaCompress tool:
+    # 5 bytes of properties, 8 bytes of uncompressed size, then raw LZMA data.
+    lc, lp, pb = 3, 0, 2
+    dict_size  = max(1 << 12, min(dict_size, 1 << max(12, len(data).bit_length())))
+    filters    = [{'id' : lzma.FILTER_LZMA1, 'preset' : preset, 'dict_size' : dict_size, 'lc' : lc, 'lp' : lp, 'pb' : pb}]
+    header     = struct.pack ('<BIQ', (pb * 5 + lp) * 9 + lc, dict_size, len(data))
+    return header + lzma.compress (data, format = lzma.FORMAT_RAW, filters = filters)
+
+
+def compress_file (in_file, alg, svn = 0, out_path = '', tool_dir = ''):
+    # In-process replacement for CommonUtility.compress, Lzma is done with
+    # the Python lzma module instead of the external LzmaCompress tool.
+    util = load_sbl_tools ()
+    if alg != 'Lzma':
+        return util.compress (in_file, alg, svn, out_path, tool_dir)
+
+    basename = os.path.splitext(os.path.basename (in_file))[0]
+    if out_path:
+        if os.path.isdir (out_path):
+            out_file = os.path.join (out_path, basename + '.lz')
         else:
-            compress_tool_dir = os.path.realpath (os.path.join (script_dir, '../SlimBoot/BaseTools/Bin/Win32'))
+            out_file = out_path
     else:
-        if os.path.exists (os.path.join (script_dir, 'LzmaCompress')):
-            compress_tool_dir = script_dir
-        else:
-            compress_tool_dir = os.path.realpath (os.path.join (script_dir, '../SlimBoot/BaseTools/BinWrappers/PosixLike'))
+        out_file = os.path.splitext(in_file)[0] + '.lz'
 
-    # create output dir
-    if not os.path.exists(args.out_dir):
-        os.mkdir (args.out_dir)
+    in_data = util.get_file_data (in_file)
+    setting  = load_compress_setting (in_file)
+    compress_data = lzma_compress_data (bytes(in_data), **setting) if len(in_data) else b''
 
-    new_ifwi =  os.path.join (args.out_dir, os.path.basename(args.ifwi_image))
-    shutil.copyfile (args.ifwi_image, new_ifwi)
+    lz_hdr = util.LZ_HEADER ()
+    lz_hdr.signature      = b'LZMA'
+    lz_hdr.svn            = svn
+    lz_hdr.compressed_len = len(compress_data)
+    lz_hdr.length         = len(in_data)
+    data = bytearray ()
+    data.extend (lz_hdr)
+    data.extend (compress_data)
+    util.gen_file_from_object (out_file, data)
 
-    print ('\nSwap payload')
-    print ('============================')
+    return out_file
 
-    layout = [
-      "( 'EPLD', 'EPLD.bin'      , 'NORMAL'  , 'RSA3072_PSS_SHA2_384'  , 'KEY_ID_CONTAINER_RSA3072'      , 0x10      , 0         , 0x0       ),"
-      "( 'UPLD', '%s'  , 'Lzma'  , 'SHA2_384'              , ''                              , 0x10      , 0         , 0x0       )," % args.payload_bin
+
+def get_epld_layout (payload_bin):
+    return [
+      ('EPLD', 'EPLD.bin', 'NORMAL', 'RSA3072_PSS_SHA2_384', 'KEY_ID_CONTAINER_RSA3072', 0x10, 0, 0x0),
+      ('UPLD', payload_bin, 'Lzma', 'SHA2_384', '', 0x10, 0, 0x0),
     ]
 
-    gen_file_from_object ( out_dir + '/EPLD.txt', '\n'.join(layout).encode())
 
-    print ('\nCreating new EPLD with %s ...' % args.payload_bin)
-    cmd = ['python', tool_dir + '/GenContainer.py', 'create', '-l', out_dir + '/EPLD.txt', '-td', compress_tool_dir, '-o', out_dir]
-    run_process (cmd)
+def get_file_hash (path):
+    digest = hashlib.sha256 ()
+    with open (path, 'rb') as fd:
+        for chunk in iter(lambda: fd.read (0x100000), b''):
+            digest.update (chunk)
+    return digest.hexdigest()
+
+
+class IfwiCache:
+    # Cache of swapped IFWI images with size bounded LRU eviction.
+    # The modification time of a cached image is its last use time.
+    def __init__(self, cache_dir, max_size = 1 << 30):
+        self.cache_dir = cache_dir
+        self.max_size  = max_size
+
+    def get_key (self, ifwi_image, payload_bin, comp_path):
+        layout = get_epld_layout ('UPLD')
+        key_id = layout[0][4]
+        items  = [
+          get_file_hash (ifwi_image),
+          get_file_hash (payload_bin),
+          repr(layout),
+          key_id,
+          os.path.realpath (os.environ.get ('SBL_KEY_DIR', '')),
+          comp_path,
+          repr(sorted(load_compress_setting (payload_bin).items())),
+        ]
+        return hashlib.sha256 ('\n'.join(items).encode()).hexdigest()
+
+    def get (self, key, out_file):
+        path = os.path.join (self.cache_dir, key + '.bin')
+        if not os.path.exists (path):
+            return False
+        shutil.copyfile (path, out_file)
+        os.utime (path)
+        return True
+
+    def put (self, key, in_file):
+        if not os.path.exists (self.cache_dir):
+            os.makedirs (self.cache_dir)
+        path = os.path.join (self.cache_dir, key + '.bin')
+        shutil.copyfile (in_file, path + '.tmp')
+        os.replace (path + '.tmp', path)
+        self.evict ()
+
+    def evict (self):
+        entries = []
+        for name in os.listdir (self.cache_dir):
+            if not name.endswith ('.bin'):
+                continue
+            path = os.path.join (self.cache_dir, name)
+            try:
+                stat = os.stat (path)
+            except FileNotFoundError:
+                continue
+            entries.append ((stat.st_mtime, stat.st_size, path))
+
+        # other processes may evict the same entries at the same time
+        total = sum(entry[1] for entry in entries)
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove (path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+def get_component_range (IFWI_PARSER, ifwi_bin, comp_path):
+    # Return the offset and length of a component, None if it is missing.
+    # The parsed entries are views into ifwi_bin and go away with this frame.
+    ifwi = IFWI_PARSER.parse_ifwi_binary (ifwi_bin)
+    comp = IFWI_PARSER.locate_component (ifwi, comp_path)
+    if comp is None:
+        return None
+    return comp.offset, comp.length
+
+
+def swap_payload_image (ifwi_image, payload_bin, out_dir, comp_path = 'IFWI/BIOS/NRD/EPLD', cache = None):
+    # Build the EPLD container and patch it into a copy of the IFWI image,
+    # everything runs in the current process.
+    if 'SBL_KEY_DIR' not in os.environ:
+        os.environ['SBL_KEY_DIR'] = "SblKeys/"
+
+    # create output dir
+    if not os.path.exists(out_dir):
+        os.mkdir (out_dir)
+
+    new_ifwi = os.path.join (out_dir, os.path.basename(ifwi_image))
+    if cache:
+        key = cache.get_key (ifwi_image, payload_bin, comp_path)
+        if cache.get (key, new_ifwi):
+            print ('\nUsing cached IFWI image for %s' % payload_bin)
+            return new_ifwi
+
+    util, GenContainer, IFWI_PARSER = load_swap_tools ()
+
+    shutil.copyfile (ifwi_image, new_ifwi)
+
+    print ('\nCreating new EPLD with %s ...' % payload_bin)
+    GenContainer.compress = compress_file
+    layout = get_epld_layout (os.path.realpath (payload_bin))
+    with span ('gen container'):
+        GenContainer.gen_container_bin ([layout], out_dir, '', os.environ['SBL_KEY_DIR'], get_compress_tool_dir ())
+    epld_bin = util.get_file_data (os.path.join (out_dir, 'EPLD.bin'))
 
     print ('\nSwapping EPLD ...')
-    cmd = ['python', tool_dir + '/IfwiUtility.py', 'replace', '-f', out_dir + '/EPLD.bin', '-p', 'IFWI/BIOS/NRD/EPLD', '-i', new_ifwi]
-    run_process (cmd)
+    with open (new_ifwi, 'r+b') as fd:
+        with mmap.mmap (fd.fileno(), 0) as ifwi_bin:
+            try:
+                comp_range = get_component_range (IFWI_PARSER, ifwi_bin, comp_path)
+            except Exception as ex:
+                # the traceback frames still hold views into the map, closing
+                # it would then raise BufferError in place of this error
+                traceback.clear_frames (ex.__traceback__)
+                raise
+            if comp_range is None:
+                raise Exception ("Could not find component '%s' in IFWI image !" % comp_path)
+            offset, length = comp_range
+            if len(epld_bin) > length:
+                raise Exception ('EPLD container (0x%x bytes) does not fit into %s (0x%x bytes) !' % (len(epld_bin), comp_path, length))
+            ifwi_bin[offset:offset + length] = epld_bin + b'\xff' * (length - len(epld_bin))
+
+    if cache:
+        cache.put (key, new_ifwi)
+
+    return new_ifwi
+
+
+def swap_payload (args):
+
+    print ('\nSwap payload')
+    print ('============================')
+
+    if args.compress_file:
+        os.environ['UPLD_COMPRESS_FILE'] = args.compress_file
+
+    cache = None
+    if args.cache_dir:
+        cache = IfwiCache (args.cache_dir, args.cache_size << 20)
+    new_ifwi = swap_payload_image (args.ifwi_image, args.payload_bin, args.out_dir, cache = cache)
 
     print ('\nPayload has been swapped successfully !')
     print ('New IFWI image is generated at:')
@@ -80,6 +279,9 @@ def main():
     parser.add_argument('-p',  '--pldbin' , dest='payload_bin', type=str, help='Payload binary file path',  required = True)
     parser.add_argument('-n',  '--non-redundant' , dest='non_redundant', action="store_true", help='Non-redundant flash map layout')
     parser.add_argument('-o',  '--outdir' , dest='out_dir',     type=str, help='Output directory path', default = 'Out')
+    parser.add_argument('-c',  '--cache-dir' , dest='cache_dir', type=str, help='Swapped IFWI image cache directory path', default = '')
+    parser.add_argument('-s',  '--cache-size', dest='cache_size', type=int, help='Swapped IFWI image cache size limit in MB', default = 1024)
+    parser.add_argument('-z',  '--compress-file', dest='compress_file', type=str, help='LZMA setting file written by upld_footprint.py', default = '')
     parser.set_defaults(func=swap_payload)
 
     # Parse arguments and run sub-command
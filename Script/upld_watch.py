@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+## @ upld_watch.py
+#
+# Poll payload build inputs for changes
+#
+# Copyright (c) 2021, Intel Corporation. All rights reserved.<BR>
+# SPDX-License-Identifier: BSD-2-Clause-Patent
+#
+##
+
+import os
+import sys
+import time
+import argparse
+import subprocess
+
+
+def get_path_state (path):
+    # Return {file : (mtime, size)} for a file or for all files under a directory
+    state = {}
+    if os.path.isfile (path):
+        info = os.stat (path)
+        state[path] = (info.st_mtime_ns, info.st_size)
+    elif os.path.isdir (path):
+        for root, dirs, files in os.walk (path):
+            for name in files:
+                file = os.path.join (root, name)
+                try:
+                    info = os.stat (file)
+                except OSError:
+                    continue
+                state[file] = (info.st_mtime_ns, info.st_size)
+    return state
+
+
+def get_repo_state (repo_dir, ignore = ()):
+    # Walking a whole source tree on every poll is too slow, so a git
+    # checkout is tracked by its HEAD plus the modified files git reports,
+    # except for the files in ignore that the build itself writes.
+    excludes = [':(exclude)%s' % path for path in ignore]
+    state = {}
+    if not os.path.exists (os.path.join (repo_dir, '.git')):
+        return state
+    try:
+        state[repo_dir] = subprocess.check_output (['git', 'rev-parse', 'HEAD'], cwd = repo_dir,
+                                                   stderr = subprocess.DEVNULL).decode().strip()
+        output = subprocess.check_output (['git', 'status', '--porcelain', '-z', '--untracked-files=all', '--', '.'] + excludes,
+                                          cwd = repo_dir, stderr = subprocess.DEVNULL).decode()
+    except subprocess.CalledProcessError:
+        return state
+    for entry in output.split ('\0'):
+        if len(entry) < 4:
+            continue
+        file = os.path.join (repo_dir, entry[3:])
+        try:
+            info = os.stat (file)
+            state[file] = (info.st_mtime_ns, info.st_size)
+        except OSError:
+            state[file] = None
+    return state
+
+
+class InputWatcher:
+    # Poll a set of files, directories and git checkouts, and report the
+    # watched paths whose content changed since the previous poll.
+    # ignore maps a git checkout to the files in it that are not watched.
+    def __init__(self, paths, repo_dirs = None, ignore = None):
+        self.paths     = sorted(set(paths))
+        self.repo_dirs = sorted(set(repo_dirs or []))
+        self.ignore    = ignore or {}
+        self.state     = self.get_state ()
+
+    def get_state (self):
+        state = {}
+        for path in self.paths:
+            state[path] = get_path_state (path)
+        for repo_dir in self.repo_dirs:
+            state[repo_dir] = get_repo_state (repo_dir, self.ignore.get (repo_dir, ()))
+        return state
+
+    def reset (self):
+        # Take the current state as the baseline, so that the files written
+        # by a rebuild do not count as changes on the next poll.
+        self.state = self.get_state ()
+
+    def poll (self):
+        state   = self.get_state ()
+        changed = [path for path in state if state[path] != self.state.get (path)]
+        self.state = state
+        return changed
+
+    def wait (self, interval = 1.0, settle = 0.5):
+        # Block until something changes, then wait for the writes to settle
+        # so that one save in an editor triggers a single rebuild.
+        while True:
+            changed = self.poll ()
+            if changed:
+                break
+            time.sleep (interval)
+
+        while True:
+            time.sleep (settle)
+            more = self.poll ()
+            if not more:
+                break
+            changed.extend (path for path in more if path not in changed)
+
+        return changed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('paths', nargs='+', help='Files or directories to watch')
+    parser.add_argument('-g', dest='repo_dirs', nargs='*', help='Git checkouts to watch', default = [])
+    parser.add_argument('-i', dest='interval', type=float, help='Poll interval in seconds', default = 1.0)
+    args = parser.parse_args()
+
+    watcher = InputWatcher (args.paths, args.repo_dirs)
+    try:
+        while True:
+            for path in watcher.wait (args.interval):
+                print ('Changed: %s' % path)
+            sys.stdout.flush ()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
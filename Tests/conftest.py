@@ -0,0 +1,15 @@
+## @ conftest.py
+#
+# Shared setup for the harness tests
+#
+# Copyright (c) 2021, Intel Corporation. All rights reserved.<BR>
+# SPDX-License-Identifier: BSD-2-Clause-Patent
+#
+##
+
+import os
+import sys
+
+ROOT_DIR = os.path.dirname (os.path.dirname (os.path.realpath (__file__)))
+sys.path.insert (0, ROOT_DIR)
+sys.path.insert (0, os.path.join (ROOT_DIR, 'Script'))
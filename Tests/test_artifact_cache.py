@@ -0,0 +1,171 @@
+## @ test_artifact_cache.py
+#
+# ArtifactCache against a local 'artifact_cache.py serve' store
+#
+# Copyright (c) 2021, Intel Corporation. All rights reserved.<BR>
+# SPDX-License-Identifier: BSD-2-Clause-Patent
+#
+##
+
+import os
+import sys
+import time
+import socket
+import subprocess
+import pytest
+from   conftest import ROOT_DIR
+from   artifact_cache import ArtifactCache, get_artifact_key
+from   task_sched import Task, run_tasks
+import upld_test
+
+
+def get_free_port ():
+    with socket.socket () as sock:
+        sock.bind (('127.0.0.1', 0))
+        return sock.getsockname ()[1]
+
+
+@pytest.fixture
+def store (tmp_path):
+    # run the stand-in store and return its URL and directory
+    store_dir = str(tmp_path / 'store')
+    port = get_free_port ()
+    proc = subprocess.Popen ([sys.executable, os.path.join (ROOT_DIR, 'Script', 'artifact_cache.py'), 'serve',
+                              '-d', store_dir, '-p', str(port)], stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
+    deadline = time.monotonic() + 10
+    while True:
+        try:
+            socket.create_connection (('127.0.0.1', port), 0.2).close ()
+            break
+        except OSError:
+            if time.monotonic() > deadline:
+                proc.kill ()
+                raise
+            time.sleep (0.05)
+    yield 'http://127.0.0.1:%d' % port, store_dir
+    proc.terminate ()
+    proc.wait ()
+
+
+def write_outputs (files):
+    for path, data in files.items():
+        if not os.path.exists (os.path.dirname (path)):
+            os.makedirs (os.path.dirname (path))
+        with open (path, 'w') as fd:
+            fd.write (data)
+
+
+OUTPUTS = {os.path.join ('Outputs', 'Build', 'stub.dll') : 'stub', os.path.join ('Outputs', 'DXEFV.fv') : 'fv'}
+
+
+def test_upload_and_fetch (store, tmp_path, monkeypatch):
+    url, store_dir = store
+    key = get_artifact_key ('uefi_build_64', 'repo.git', 'abc123')
+
+    monkeypatch.chdir (tmp_path)
+    os.makedirs ('builder')
+    os.chdir ('builder')
+    write_outputs (OUTPUTS)
+    assert ArtifactCache (url).upload (key, list(OUTPUTS))
+    assert os.path.exists (os.path.join (store_dir, key + '.zip'))
+
+    # another agent restores the outputs into its own tree and local directory
+    os.chdir (str(tmp_path))
+    os.makedirs ('agent')
+    os.chdir ('agent')
+    cache = ArtifactCache (url, str(tmp_path / 'local'))
+    assert cache.fetch (key, list(OUTPUTS))
+    for path, data in OUTPUTS.items():
+        with open (path) as fd:
+            assert fd.read () == data
+    assert os.path.exists (cache.get_local_path (key))
+
+
+def test_fetch_miss (store, tmp_path, monkeypatch):
+    url, store_dir = store
+    monkeypatch.chdir (tmp_path)
+    cache = ArtifactCache (url)
+    assert not cache.fetch (get_artifact_key ('sbl', 'repo.git', 'abc123'), list(OUTPUTS))
+    # a miss keeps the store in use
+    assert cache.url == url
+
+
+def test_fetch_rejects_unexpected_files (store, tmp_path, monkeypatch):
+    url, store_dir = store
+    key = get_artifact_key ('sbl', 'repo.git', 'abc123')
+    monkeypatch.chdir (tmp_path)
+    write_outputs (OUTPUTS)
+    assert ArtifactCache (url).upload (key, list(OUTPUTS)[:1])
+    assert not ArtifactCache (url).fetch (key, list(OUTPUTS))
+
+
+def test_key_depends_on_inputs (tmp_path):
+    fsp = str(tmp_path / 'Fsp.bin')
+    write_outputs ({fsp : 'one'})
+    key = get_artifact_key ('sbl', 'repo.git', 'abc123', [fsp])
+    assert key != get_artifact_key ('sbl', 'repo.git', 'abc124', [fsp])
+    write_outputs ({fsp : 'two'})
+    assert key != get_artifact_key ('sbl', 'repo.git', 'abc123', [fsp])
+
+
+def test_unreachable_store_falls_back (tmp_path, monkeypatch):
+    monkeypatch.chdir (tmp_path)
+    key   = get_artifact_key ('sbl', 'repo.git', 'abc123')
+    cache = ArtifactCache ('http://127.0.0.1:%d' % get_free_port (), str(tmp_path / 'local'))
+    assert not cache.fetch (key, list(OUTPUTS))
+    assert cache.url == ''
+
+    # the local directory still works as the whole store
+    write_outputs (OUTPUTS)
+    assert cache.upload (key, list(OUTPUTS))
+    for path in OUTPUTS:
+        os.remove (path)
+    assert cache.fetch (key, list(OUTPUTS))
+
+
+def test_partial_hit_restores_after_clone (tmp_path, monkeypatch):
+    # only the SBL image is in the store, the SlimBoot clone must still work
+    repo = str(tmp_path / 'sbl.git')
+    work = str(tmp_path / 'work')
+    subprocess.check_call (['git', 'init', '-q', '--bare', '-b', 'main', repo])
+    subprocess.check_call (['git', 'clone', '-q', repo, work], stderr = subprocess.DEVNULL)
+    write_outputs ({os.path.join (work, 'BuildLoader.py') : ''})
+    git = ['git', '-c', 'user.name=test', '-c', 'user.email=test@example.com']
+    subprocess.check_call (git + ['add', '.'], cwd = work)
+    subprocess.check_call (git + ['commit', '-q', '-m', 'init'], cwd = work)
+    subprocess.check_call (git + ['push', '-q', 'origin', 'HEAD:main'], cwd = work)
+    commit = subprocess.check_output (['git', 'rev-parse', 'HEAD'], cwd = work).decode().strip()
+
+    monkeypatch.setenv ('UPLD_MIRROR_DIR', '')
+    monkeypatch.setattr (upld_test, 'SBL_REPO',  (repo, 'main'))
+    monkeypatch.setattr (upld_test, 'UEFI_REPO', (repo, 'missing'))
+    monkeypatch.chdir (tmp_path)
+    sbl_img = os.path.join ('SlimBoot', 'Outputs', 'qemu', 'SlimBootloader.bin')
+    write_outputs ({path : path for path in upld_test.FSP_BINS + [sbl_img]})
+    cache = ArtifactCache ('', str(tmp_path / 'local'))
+    assert cache.upload (get_artifact_key ('sbl', repo, commit, upld_test.FSP_BINS), [sbl_img])
+    os.remove (sbl_img)
+    os.removedirs (os.path.dirname (sbl_img))
+
+    def clone ():
+        upld_test.clone_repo ('SlimBoot', repo, 'main')
+        return 0
+    def build (name):
+        write_outputs ({os.path.join ('Outputs', name) : name})
+        return 0
+    tasks = [Task ('sbl_clone', clone, outputs = ['SlimBoot']),
+             Task ('sbl', lambda: 1, inputs = ['SlimBoot'], outputs = [sbl_img])]
+    for name in ['linux_stub_32', 'linux_stub_64', 'uefi_build_32', 'uefi_build_64']:
+        tasks.append (Task (name, lambda name = name: build (name), inputs = ['SlimBoot'], outputs = [os.path.join ('Outputs', name)]))
+
+    dir_dict = {'sbl_dir' : 'SlimBoot', 'uefi_dir' : 'UefiPayload', 'out_dir' : 'Outputs'}
+    stage_dir = str(tmp_path / 'stage')
+    done, missed = upld_test.fetch_artifacts (cache, dir_dict, tasks, stage_dir)
+    assert 'sbl_clone' not in done
+    assert len(missed) == 2
+    assert not os.path.exists ('SlimBoot')
+
+    assert run_tasks (tasks, 1, done) == 0
+    assert upld_test.get_repo_commit ('SlimBoot') == commit
+    with open (sbl_img) as fd:
+        assert fd.read () == sbl_img
@@ -0,0 +1,103 @@
+## @ test_clone_repo.py
+#
+# clone_repo against local bare repositories
+#
+# Copyright (c) 2021, Intel Corporation. All rights reserved.<BR>
+# SPDX-License-Identifier: BSD-2-Clause-Patent
+#
+##
+
+import os
+import subprocess
+import pytest
+import upld_test
+
+
+def git (args, cwd = None):
+    cmd = ['git', '-c', 'user.name=test', '-c', 'user.email=test@example.com'] + args
+    return subprocess.check_output (cmd, cwd = cwd, stderr = subprocess.STDOUT).decode().strip()
+
+
+def push_commit (work_dir, name, data):
+    with open (os.path.join (work_dir, name), 'w') as fd:
+        fd.write (data)
+    git (['add', name], work_dir)
+    git (['commit', '-q', '-m', 'update %s' % name], work_dir)
+    git (['push', '-q', 'origin', 'HEAD:main'], work_dir)
+    return git (['rev-parse', 'HEAD'], work_dir)
+
+
+@pytest.fixture
+def upstream (tmp_path, monkeypatch):
+    # a bare repo with one commit on 'main', and a work tree to push from
+    repo = str(tmp_path / 'upstream.git')
+    git (['init', '-q', '--bare', repo])
+    git (['symbolic-ref', 'HEAD', 'refs/heads/main'], repo)
+    work = str(tmp_path / 'work')
+    git (['clone', '-q', repo, work])
+    commit = push_commit (work, 'file.txt', 'one\n')
+    monkeypatch.setenv ('UPLD_MIRROR_DIR', str(tmp_path / 'mirrors'))
+    return repo, work, commit
+
+
+def test_clone_through_mirror (upstream, tmp_path):
+    repo, work, commit = upstream
+    clone_dir = str(tmp_path / 'clone')
+    upld_test.clone_repo (clone_dir, repo, 'main')
+    assert git (['rev-parse', 'HEAD'], clone_dir) == commit
+    assert os.path.exists (upld_test.get_mirror_dir (repo))
+    # the clone must not depend on the objects of the mirror
+    assert not os.path.exists (os.path.join (clone_dir, '.git', 'objects', 'info', 'alternates'))
+
+
+def test_clone_without_mirror (upstream, tmp_path, monkeypatch):
+    repo, work, commit = upstream
+    monkeypatch.setenv ('UPLD_MIRROR_DIR', '')
+    clone_dir = str(tmp_path / 'clone')
+    upld_test.clone_repo (clone_dir, repo, 'main')
+    assert git (['rev-parse', 'HEAD'], clone_dir) == commit
+
+
+def test_clone_is_incremental (upstream, tmp_path, capsys):
+    repo, work, commit = upstream
+    clone_dir = str(tmp_path / 'clone')
+    upld_test.clone_repo (clone_dir, repo, 'main')
+    capsys.readouterr ()
+    upld_test.clone_repo (clone_dir, repo, 'main')
+    assert 'is up to date' in capsys.readouterr ().out
+
+    commit = push_commit (work, 'file.txt', 'two\n')
+    upld_test.clone_repo (clone_dir, repo, 'main')
+    assert git (['rev-parse', 'HEAD'], clone_dir) == commit
+    with open (os.path.join (clone_dir, 'file.txt')) as fd:
+        assert fd.read () == 'two\n'
+
+
+def test_clone_discards_local_changes (upstream, tmp_path, capsys):
+    repo, work, commit = upstream
+    clone_dir = str(tmp_path / 'clone')
+    upld_test.clone_repo (clone_dir, repo, 'main')
+    with open (os.path.join (clone_dir, 'file.txt'), 'w') as fd:
+        fd.write ('local edit\n')
+    capsys.readouterr ()
+    upld_test.clone_repo (clone_dir, repo, 'main')
+    assert 'is up to date' not in capsys.readouterr ().out
+    with open (os.path.join (clone_dir, 'file.txt')) as fd:
+        assert fd.read () == 'one\n'
+
+
+def test_clone_missing_branch (upstream, tmp_path):
+    repo, work, commit = upstream
+    with pytest.raises (Exception, match = 'Failed to find branch'):
+        upld_test.clone_repo (str(tmp_path / 'clone'), repo, 'no_such_branch')
+
+
+def test_clone_ignores_build_written_files (upstream, tmp_path, capsys):
+    repo, work, commit = upstream
+    clone_dir = str(tmp_path / 'clone')
+    upld_test.clone_repo (clone_dir, repo, 'main', ignore = ['file.txt'])
+    with open (os.path.join (clone_dir, 'file.txt'), 'w') as fd:
+        fd.write ('copied by the build\n')
+    capsys.readouterr ()
+    upld_test.clone_repo (clone_dir, repo, 'main', ignore = ['file.txt'])
+    assert 'is up to date' in capsys.readouterr ().out
@@ -0,0 +1,122 @@
+## @ test_console_replay.py
+#
+# The qemu_test flow driven by console recordings instead of QEMU
+#
+# Copyright (c) 2021, Intel Corporation. All rights reserved.<BR>
+# SPDX-License-Identifier: BSD-2-Clause-Patent
+#
+##
+
+import os
+import json
+import time
+import shutil
+import pytest
+import upld_test
+from   conftest import ROOT_DIR
+from   console_replay import ConsoleRecorder, load_recording
+
+# uboot_32.rec.gz is a synthetic fixture, not a recording of a real boot.
+# It was written by hand in the recording format with the uboot_32 check
+# lines at round timestamps, and its cmd has no -drive arguments. Replace
+# it with a 'upld_test.py --record' capture when the console output of a
+# real boot matters to a test.
+DATA_DIR = os.path.join (ROOT_DIR, 'Tests', 'Data')
+
+
+def write_recording (rec_file, chunks, end, killed = True, retcode = -15):
+    recorder = ConsoleRecorder (rec_file, ['qemu-system-x86_64'])
+    for stamp, data in chunks:
+        recorder.add (stamp, data.encode ())
+    recorder.close (end, retcode, killed)
+
+
+@pytest.fixture
+def workspace (tmp_path, monkeypatch):
+    # qemu_test runs Script/sbl_upld.py from the current directory
+    shutil.copytree (os.path.join (ROOT_DIR, 'Script'), str(tmp_path / 'Script'),
+                     ignore = shutil.ignore_patterns ('__pycache__'))
+    rec_dir = tmp_path / 'Recordings'
+    rec_dir.mkdir ()
+    shutil.copy (os.path.join (DATA_DIR, 'uboot_32.rec.gz'), str(rec_dir))
+    monkeypatch.chdir (tmp_path)
+    monkeypatch.setenv ('SBL_KEY_DIR', 'SblKeys/')
+    return tmp_path
+
+
+def run_matrix (workspace, cases, speed = 0, jobs = 1):
+    matrix_file = str(workspace / 'matrix.json')
+    with open (matrix_file, 'w') as fd:
+        json.dump ({'cases' : cases}, fd)
+    result_file = str(workspace / 'results.json')
+    console = {'mode' : 'replay', 'dir' : str(workspace / 'Recordings'), 'speed' : speed}
+    start = time.monotonic()
+    ret = upld_test.qemu_test ('', jobs, '', '', matrix_file, result_file = result_file, console = console)
+    with open (result_file) as fd:
+        results = dict((result['name'], result) for result in json.load (fd)['results'])
+    return ret, results, time.monotonic() - start
+
+
+def get_case (name, checks = 'uboot_32', timeout = 0):
+    return {'name' : name, 'payload' : 'UbootPld.elf', 'checks' : checks, 'timeout' : timeout}
+
+
+def test_recording_is_valid ():
+    records = load_recording (os.path.join (DATA_DIR, 'uboot_32.rec.gz'))
+    assert records[-1]['killed']
+    assert '=>' in records[-2]['data']
+
+
+def test_replay_passes (workspace):
+    ret, results, spent = run_matrix (workspace, [get_case ('uboot_32')])
+    assert ret == 0
+    assert results['uboot_32']['ret'] == 0
+    with open (str(workspace / 'Outputs' / 'Tests' / 'uboot_32' / 'latency.json')) as fd:
+        latency = json.load (fd)
+    assert latency['passed'] and latency['stages'][-1]['marker'] == '=>'
+
+
+def test_replay_real_speed_stops_at_last_line (workspace):
+    # QEMU was stopped after the '=>' prompt, the replay then waits like
+    # QEMU would, so the test only ends this early through the early exit
+    ret, results, spent = run_matrix (workspace, [get_case ('uboot_32')], speed = 1)
+    assert ret == 0
+    with open (str(workspace / 'Outputs' / 'Tests' / 'uboot_32' / 'latency.json')) as fd:
+        stages = json.load (fd)['stages']
+    assert 1.6 <= stages[-1]['time'] < 3
+    assert spent < 8
+
+
+def test_replay_timeout (workspace):
+    write_recording (str(workspace / 'Recordings' / 'uboot_slow.rec.gz'),
+                     [(0.1, '===== Intel Slim Bootloader STAGE1A =====\n'), (0.2, '===== Intel Slim Bootloader STAGE1B =====\n'),
+                      (0.5, '===== Intel Slim Bootloader STAGE2 ======\n'), (6.0, 'Univeral Payload u-boot\n')], 6.1)
+    ret, results, spent = run_matrix (workspace, [get_case ('uboot_slow', timeout = 1)], speed = 1)
+    assert ret != 0
+    assert results['uboot_slow']['ret'] == -3
+    assert spent < 5
+
+
+def test_replay_failure_signature (workspace):
+    write_recording (str(workspace / 'Recordings' / 'linux_64.rec.gz'),
+                     [(0.1, '===== Intel Slim Bootloader STAGE1A =====\n'), (0.2, 'Kernel panic - not syncing\n')], 0.3)
+    ret, results, spent = run_matrix (workspace, [get_case ('linux_64', checks = 'linux_64')], speed = 1)
+    assert results['linux_64']['ret'] == -3
+    with open (str(workspace / 'Outputs' / 'Tests' / 'linux_64' / 'latency.json')) as fd:
+        assert 'Kernel panic' in json.load (fd)['failure']
+
+
+def test_replay_exit_before_last_line (workspace):
+    write_recording (str(workspace / 'Recordings' / 'uboot_reset.rec.gz'),
+                     [(0.1, '===== Intel Slim Bootloader STAGE1A =====\n')], 0.2, killed = False, retcode = 0)
+    ret, results, spent = run_matrix (workspace, [get_case ('uboot_reset')])
+    assert results['uboot_reset']['ret'] == -3
+
+
+def test_replay_parallel_report (workspace):
+    cases = [get_case ('uboot_32'), get_case ('uboot_missing')]
+    ret, results, spent = run_matrix (workspace, cases, jobs = 2)
+    assert ret != 0
+    assert results['uboot_32']['ret'] == 0
+    # no recording is like a missing IFWI image
+    assert results['uboot_missing']['ret'] == -1
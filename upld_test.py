@@ -7,11 +7,35 @@
 #
 
 import os
+import re
 import sys
+import json
+import time
 import shutil
+import hashlib
 import subprocess
 import fnmatch
 import argparse
+import tempfile
+import contextlib
+import concurrent.futures
+
+sys.path.insert (0, os.path.join (os.path.dirname (os.path.realpath (__file__)), 'Script'))
+from upld_elf import add_sections
+from build_cache import BuildCache, run_cached, get_file_hash
+from task_sched  import Task, run_tasks, get_affected_tasks
+from upld_watch  import InputWatcher
+from upld_inspect import inspect_payload
+from upld_info   import UPLD_INFO_HEADER
+from toolchain   import get_tool
+from bench_db    import HISTORY_DB, record_run
+from artifact_cache import ArtifactCache, get_artifact_key
+from trace_prof  import span, start_profile, traced_call, traced_check_output
+
+SBL_REPO  = ('https://github.com/universalpayload/slimbootloader.git', 'universal_payload')
+UEFI_REPO = ('https://github.com/universalpayload/edk2.git', 'upld_elf')
+FSP_BINS  = ['QemuFspBins/Fsp.bsf', 'QemuFspBins/FspRel.bin']
+FSP_DEST  = ['Silicon/QemuSocPkg/FspBin/Fsp.bsf', 'Silicon/QemuSocPkg/FspBin/FspRel.bin']
 
 def fatal (msg):
     sys.stdout.flush()
@@ -30,9 +54,9 @@ def run_process (arg_list, print_cmd = False, capture_out = False):
     output = ''
     try:
         if capture_out:
-            output = subprocess.check_output(arg_list).decode()
+            output = traced_check_output (arg_list).decode()
         else:
-            result = subprocess.call (arg_list)
+            result = traced_call (arg_list)
     except Exception as ex:
         result = 1
         exc    = ex
@@ -47,258 +71,822 @@ def run_process (arg_list, print_cmd = False, capture_out = False):
 
     return output
 
-def clone_repo (clone_dir, repo, branch, commit = 'HEAD'):
+def git_output (args, cwd = None):
+    try:
+        return subprocess.check_output (['git'] + args, cwd = cwd, stderr = subprocess.DEVNULL).decode().rstrip()
+    except subprocess.CalledProcessError:
+        return ''
+
+def get_remote_commit (repo, branch):
+    # Return '' when the remote can not be reached or has no such branch
+    output = git_output (['ls-remote', repo, 'refs/heads/%s' % branch])
+    return output.split()[0] if output else ''
+
+def get_mirror_dir (repo):
+    # Local bare mirrors are shared by all clones of the same repo.
+    # Set UPLD_MIRROR_DIR to an empty string to disable mirrors.
+    mirror_root = os.environ.get ('UPLD_MIRROR_DIR', os.path.join (os.path.expanduser ('~'), '.cache', 'upld_test', 'mirrors'))
+    if not mirror_root:
+        return ''
+    name = re.sub (r'[^A-Za-z0-9_.-]', '_', repo.rstrip('/'))
+    if not name.endswith ('.git'):
+        name += '.git'
+    return os.path.join (mirror_root, name)
+
+def update_mirror (repo):
+    mirror = get_mirror_dir (repo)
+    if not mirror:
+        return ''
+    if not os.path.exists (mirror):
+        print ('Creating mirror of %s ...' % repo)
+        ret = traced_call (['git', 'clone', '--mirror', '--quiet', repo, mirror])
+    else:
+        print ('Updating mirror of %s ...' % repo)
+        ret = traced_call (['git', 'fetch', '--prune', '--quiet', 'origin'], cwd = mirror)
+    if ret:
+        print ('Failed to update mirror %s, using the remote repo directly' % mirror)
+        return ''
+    return mirror
+
+def is_repo_up_to_date (clone_dir, commit, ignore = ()):
+    if not os.path.exists(clone_dir + '/.git'):
+        return False
+    if git_output (['rev-parse', 'HEAD'], clone_dir) != commit:
+        return False
+    # local edits are discarded by the forced checkout, like a fresh clone,
+    # files that the build copies into the tree do not count
+    if get_repo_changes (clone_dir, ignore):
+        return False
+    # initialized submodules at the recorded commit are listed with a leading space
+    for line in git_output (['submodule', 'status', '--recursive'], clone_dir).splitlines():
+        if not line.startswith (' '):
+            return False
+    return True
+
+def clone_repo (clone_dir, repo, branch, commit = 'HEAD', jobs = 8, ignore = ()):
+    if commit == 'HEAD':
+        commit = get_remote_commit (repo, branch)
+        if not commit:
+            fatal ('Failed to find branch %s in repo %s !' % (branch, repo))
+    elif os.path.exists(clone_dir + '/.git'):
+        commit = git_output (['rev-parse', '--verify', '--quiet', '%s^{commit}' % commit], clone_dir) or commit
+
+    if is_repo_up_to_date (clone_dir, commit, ignore):
+        print ('Repo %s is up to date at %s\n' % (clone_dir, commit))
+        return
+
+    mirror = update_mirror (repo)
     if not os.path.exists(clone_dir + '/.git'):
         print ('Cloning the repo ... %s' % repo)
-        cmd = 'git clone %s %s' % (repo, clone_dir)
-        ret = subprocess.call(cmd.split(' '))
+        if mirror:
+            # dissociate so that pruning or gc of the mirror can not break the clone
+            cmd = ['git', 'clone', '--no-checkout', '--reference', mirror, '--dissociate', repo, clone_dir]
+        else:
+            cmd = ['git', 'clone', '--no-checkout', '--filter=blob:none', repo, clone_dir]
+        ret = traced_call (cmd)
         if ret:
             fatal ('Failed to clone repo to directory %s !' % clone_dir)
         print ('Done\n')
     else:
         print ('Update the repo ...')
-        cmd = 'git fetch origin'
-        ret = subprocess.call(cmd.split(' '), cwd=clone_dir)
+        # objects come from the local mirror when it is available
+        cmd = ['git', 'fetch', mirror or 'origin', '+refs/heads/%s:refs/remotes/origin/%s' % (branch, branch)]
+        ret = traced_call (cmd, cwd=clone_dir)
+        if ret == 0 and git_output (['cat-file', '-t', commit], clone_dir) != 'commit':
+            cmd = ['git', 'fetch', 'origin', commit]
+            ret = traced_call (cmd, cwd=clone_dir)
         if ret:
             fatal ('Failed to update repo in directory %s !' % clone_dir)
         print ('Done\n')
 
     print ('Checking out specified version ... %s' % commit)
 
-    cmd = 'git checkout %s -f' % branch
-    ret = subprocess.call(cmd.split(' '), cwd=clone_dir)
+    cmd = ['git', 'checkout', '-f', '-B', branch, commit]
+    ret = traced_call (cmd, cwd=clone_dir)
     if ret:
         fatal ('Failed to check out specified branch !')
     print ('Done\n')
 
-    cmd = 'git submodule init'
-    ret = subprocess.call(cmd.split(' '), cwd=clone_dir)
-    if ret:
-        fatal ('Failed to init submodules !')
-    print ('Done\n')
-
-    cmd = 'git submodule update'
-    ret = subprocess.call(cmd.split(' '), cwd=clone_dir)
+    cmd = ['git', 'submodule', 'sync', '--recursive', '--quiet']
+    ret = traced_call (cmd, cwd=clone_dir)
+    if ret == 0:
+        cmd = ['git', 'submodule', 'update', '--init', '--recursive', '--force', '--jobs', str(jobs)]
+        ret = traced_call (cmd, cwd=clone_dir)
     if ret:
         fatal ('Failed to update submodules !')
+
     print ('Done\n')
 
-    cmd = 'git pull'
-    ret = subprocess.call(cmd.split(' '), cwd=clone_dir)
-    if ret:
-        fatal ('Failed to pull latest code !')
+def create_dirs (dirs):
+    for dir_name in dirs:
+        if not os.path.exists(dir_name):
+            os.makedirs (dir_name)
+
+def load_test_matrix (matrix_file):
+    # Each test case gives its name, test script, payload image, IFWI image,
+    # check line set, QEMU profile, boot timeout and expected duration.
+    # A timeout of 0 lets sbl_upld.py derive it from recent boot durations.
+    with open (matrix_file) as fd:
+        matrix = json.load (fd)
+    test_cases = []
+    for case in matrix['cases']:
+        test_case = {
+          'script'   : 'sbl_upld.py',
+          'ifwi'     : 'SlimBoot/Outputs/qemu/SlimBootloader.bin',
+          'profile'  : 'auto',
+          'timeout'  : 0,
+          'duration' : 10,
+        }
+        test_case.update (case)
+        test_case.setdefault ('checks', test_case['name'])
+        test_cases.append (test_case)
+    return test_cases
+
+
+def get_shard (test_cases, shard):
+    # Split test cases into N shards balanced by expected duration. The
+    # longest case goes to the least loaded shard first, ties are broken
+    # by name and shard index so that every machine gets the same split.
+    match = re.match (r'^(\d+)/(\d+)$', shard.strip ())
+    index, count = (int(match.group(1)), int(match.group(2))) if match else (0, 0)
+    if count < 1 or not 1 <= index <= count:
+        fatal ("Invalid shard '%s', expecting i/N with 1 <= i <= N !" % shard)
+    loads  = [0] * count
+    owners = {}
+    for case in sorted(test_cases, key = lambda case: (-case['duration'], case['name'])):
+        owner = loads.index (min(loads))
+        loads[owner] += case['duration']
+        owners[case['name']] = owner
+    return [case for case in test_cases if owners[case['name']] == index - 1]
+
+
+def get_test_cases (test_pat, profile = '', matrix_file = 'test_matrix.json', shard = '', names = None):
+    test_cases = load_test_matrix (matrix_file)
+
+    if names is not None:
+        test_cases = [case for case in test_cases if case['name'] in names]
+
+    if profile:
+        for test_case in test_cases:
+            test_case['profile'] = profile
+
+    if test_pat:
+        test_cases = [case for case in test_cases if fnmatch.filter([case['payload'].lower()], test_pat)]
+
+    if shard:
+        test_cases = get_shard (test_cases, shard)
+
+    return test_cases
+
+
+def run_test_case (test_case, disk_dir, out_dir, log_file = None, cache_dir = '', console = None):
+    name     = test_case['name']
+    upld_img = test_case['payload']
+    sbl_img  = test_case['ifwi']
+    start    = time.time()
+    stats    = {'profile' : test_case['profile'], 'swap_time' : None, 'boot_time' : None, 'size' : None}
+
+    def result (ret):
+        stats.update ({'name' : name, 'payload' : upld_img, 'ret' : ret, 'time' : round(time.time() - start, 2)})
+        return stats
+
+    # each case works in a private directory so that cases can run concurrently
+    work_dir = os.path.join (out_dir, 'Tests', name)
+    if os.path.exists(work_dir):
+        shutil.rmtree (work_dir)
+    os.makedirs (work_dir)
+    if cache_dir:
+        # boot from a copy-on-write overlay of the cached disk image
+        case_disk = disk_dir
+    else:
+        case_disk = os.path.join (work_dir, 'Disk')
+        shutil.copytree (disk_dir, case_disk)
+    tst_img   = os.path.join (work_dir, os.path.basename(sbl_img))
 
-    print ('Done\n')
+    # a console recording of the case stands in for QEMU, the payload and the IFWI image
+    replay   = bool(console) and console['mode'] == 'replay'
+    rec_file = os.path.realpath (os.path.join (console['dir'], '%s.rec.gz' % name)) if console else ''
+
+    sys.stdout.flush()
+    out = None
+    if log_file:
+        out = open (log_file, 'w')
 
-def get_objcopy ():
-    objcopy = 'llvm-objcopy-10'
-    cmd = '%s -V' % objcopy
     try:
-        run_process(cmd.split(' '), capture_out = True)
-        ret = 0
-    except:
-        ret = -1
-    if ret:
-        objcopy = 'objcopy'
-    return objcopy
+        if replay:
+            if not os.path.exists(rec_file):
+                print ('Could not find console recording %s !' % rec_file, file = out, flush = True)
+                return result (-1)
+        else:
+            if not os.path.exists(sbl_img):
+                print ('Could not find IFWI image %s !' % sbl_img, file = out, flush = True)
+                return result (-1)
+
+            # check the payload image before spending time on swap and boot
+            with span ('%s inspect' % name):
+                problems = inspect_payload (os.path.join (out_dir, upld_img), test_case['checks'])
+            if problems:
+                print ('Payload %s failed pre-flight check:' % upld_img, file = out)
+                for problem in problems:
+                    print ('  %s' % problem, file = out)
+                sys.stdout.flush()
+                return result (-4)
+            stats['size'] = os.path.getsize (os.path.join (out_dir, upld_img))
+
+            # create new IFWI using the upld
+            swap_start = time.time()
+            try:
+                with contextlib.redirect_stdout (out or sys.stdout), span ('%s swap' % name):
+                    import upld_swap
+                    cache = upld_swap.IfwiCache (os.path.join (cache_dir, 'Ifwi')) if cache_dir else None
+                    upld_swap.swap_payload_image (sbl_img, os.path.join (out_dir, upld_img), work_dir, cache = cache)
+            except Exception as ex:
+                print ('Failed to swap payload %s: %s' % (upld_img, ex), file = out, flush = True)
+                return result (-2)
+            stats['swap_time'] = round(time.time() - swap_start, 2)
+
+        # run QEMU test cases
+        cmd = [ sys.executable, 'Script/%s' % test_case['script'], tst_img, case_disk, test_case['checks'],
+                '-q', test_case['profile'], '-t', str(test_case['timeout']),
+                '-l', os.path.join (work_dir, 'latency.json')]
+        if cache_dir:
+            cmd.extend (['-d', os.path.join (cache_dir, 'Disk')])
+        if log_file:
+            # the full console log goes to a file, the case log keeps the summary
+            cmd.extend (['-o', os.path.join (work_dir, 'console.log.gz')])
+        if replay:
+            cmd.extend (['--console-replay', rec_file, '--replay-speed', str(console['speed'])])
+        elif console:
+            cmd.extend (['--console-record', rec_file])
+        boot_start = time.time()
+        with span ('%s boot' % name):
+            ret = traced_call (cmd, stdout = out, stderr = subprocess.STDOUT)
+        stats['boot_time'] = round(time.time() - boot_start, 2)
+        if ret:
+            print ('Failed to run test %s !' % test_case['script'], file = out, flush = True)
+            return result (-3)
+    finally:
+        if out:
+            out.close()
+
+    return result (0)
 
 
-def qemu_test (test_pat):
+def print_test_report (results):
+    failed = 0
+    print ('\n%-12s %-16s %-8s %8s' % ('Test', 'Payload', 'Result', 'Time(s)'))
+    for result in results:
+        print ('%-12s %-16s %-8s %8.2f' % (result['name'], result['payload'], 'PASSED' if result['ret'] == 0 else 'FAILED', result['time']))
+        if result['ret']:
+            failed += 1
+
+    if failed:
+        print ('\n%d of %d test cases failed !\n' % (failed, len(results)))
+        return -3
+
+    print ('\nAll %d test cases passed !\n' % len(results))
+    return 0
+
+
+def save_test_results (results, result_file, shard = ''):
+    if not result_file:
+        return
+    with open (result_file, 'w') as fd:
+        json.dump ({'shard' : shard, 'results' : results}, fd, indent = 2)
+
+
+def record_test_results (results, history_db):
+    # Keep the results in the test history for trend and regression checks
+    if not history_db or not results:
+        return
+    commits = []
+    for repo_dir in ['SlimBoot', 'UefiPayload']:
+        commits.append (get_repo_commit (repo_dir) if os.path.exists (os.path.join (repo_dir, '.git')) else '')
+    run_id = record_run (results, commits[0], commits[1], db_file = history_db)
+    print ('Test results are saved as run %d in %s' % (run_id, history_db))
+
+
+def merge_test_results (result_files, result_file = '', matrix_file = 'test_matrix.json'):
+    # Combine per-shard result files into one report in test matrix order
+    results = {}
+    for file in result_files:
+        with open (file) as fd:
+            for result in json.load (fd)['results']:
+                results[result['name']] = result
+
+    # a case without a result comes from a shard that crashed or is missing
+    cases   = load_test_matrix (matrix_file)
+    order   = [case['name'] for case in cases]
+    for case in cases:
+        if case['name'] not in results:
+            print ('No result for test case %s !' % case['name'])
+            results[case['name']] = {'name' : case['name'], 'payload' : case['payload'], 'ret' : -1,
+                                     'time' : 0, 'error' : 'missing result'}
+    merged  = [results[name] for name in order if name in results]
+    merged += [results[name] for name in sorted(results) if name not in order]
+    save_test_results (merged, result_file)
+    return print_test_report (merged)
+
+
+def qemu_test (test_pat, jobs = 1, cache_dir = '', profile = '', matrix_file = 'test_matrix.json', shard = '', result_file = '', names = None,
+               history_db = '', console = None):
 
     if 'SBL_KEY_DIR' not in os.environ:
         os.environ['SBL_KEY_DIR'] = "SblKeys/"
 
-    # check QEMU SlimBootloader.bin
-    sbl_img  = 'SlimBoot/Outputs/qemu/SlimBootloader.bin'
-    tst_img  = 'Outputs/SlimBootloader.bin'
-    if not os.path.exists(sbl_img):
-        print ('Could not find QEMU SlimBootloader.bin image !')
-        return -1
-
     disk_dir = 'Disk'
     out_dir  = 'Outputs'
     if not os.path.exists(disk_dir):
         os.mkdir(disk_dir)
 
-
     # run test cases
-    test_cases = [
-      ('sbl_upld.py',  [tst_img, disk_dir, 'uboot_32'], 'UbootPld.elf'),
-      ('sbl_upld.py',  [tst_img, disk_dir, 'linux_32'], 'LinuxPld32.elf'),
-      ('sbl_upld.py',  [tst_img, disk_dir, 'linux_64'], 'LinuxPld64.elf'),
-      ('sbl_upld.py',  [tst_img, disk_dir, 'uefi_32'],  'UefiPld32.elf'),
-      ('sbl_upld.py',  [tst_img, disk_dir, 'uefi_64'],  'UefiPld64.elf'),
+    test_cases = get_test_cases (test_pat, profile, matrix_file, shard, names)
+
+    if jobs <= 1:
+        results = []
+        for test_case in test_cases:
+            print ('######### Running run test %s (%s)' % (test_case['script'], test_case['name']))
+            result = run_test_case (test_case, disk_dir, out_dir, cache_dir = cache_dir, console = console)
+            results.append (result)
+            if result['ret']:
+                save_test_results (results, result_file, shard)
+                record_test_results (results, history_db)
+                return result['ret']
+            print ('######### Completed test %s (%s)\n\n' % (test_case['script'], test_case['name']))
+
+        save_test_results (results, result_file, shard)
+        record_test_results (results, history_db)
+        print ('\nAll %d test cases passed !\n' % len(results))
+        return 0
+
+    # run test cases in parallel, output of each case goes into its own log file
+    print ('######### Running %d test cases with %d jobs' % (len(test_cases), jobs))
+    log_files = {}
+    for test_case in test_cases:
+        log_files[test_case['name']] = os.path.realpath (os.path.join (out_dir, 'Tests', '%s.log' % test_case['name']))
+    create_dirs ([os.path.join (out_dir, 'Tests')])
+
+    with concurrent.futures.ProcessPoolExecutor (max_workers = jobs) as executor:
+        futures = [executor.submit (run_test_case, test_case, disk_dir, out_dir, log_files[test_case['name']], cache_dir, console)
+                   for test_case in test_cases]
+        results = [future.result() for future in futures]
+
+    # report results in the order of the test matrix
+    save_test_results (results, result_file, shard)
+    record_test_results (results, history_db)
+    for result in results:
+        if result['ret']:
+            print ('\n######### Log for failed test %s (%s):' % (result['name'], log_files[result['name']]))
+            with open (log_files[result['name']]) as fd:
+                print (fd.read())
+
+    return print_test_report (results)
+
+
+def get_repo_commit (repo_dir):
+    cmd = ['git', 'rev-parse', 'HEAD']
+    return subprocess.check_output (cmd, cwd = repo_dir).decode().strip()
+
+
+def get_repo_changes (repo_dir, ignore = ()):
+    # Uncommitted changes of a repo and its submodules, except for the
+    # files that the build itself copies into the tree
+    excludes = [':(exclude)%s' % path for path in ignore]
+    return git_output (['status', '--porcelain', '--', '.'] + excludes, repo_dir)
+
+
+def get_repo_state (repo_dir, ignore = ()):
+    # The commit of a clean tree, or the commit with a digest of the local
+    # changes, so that outputs built from uncommitted edits are never
+    # restored for or stored under the clean commit.
+    commit  = get_repo_commit (repo_dir)
+    changes = get_repo_changes (repo_dir, ignore)
+    if not changes:
+        return commit
+    excludes = [':(exclude)%s' % path for path in ignore]
+    digest   = hashlib.sha256 (changes.encode())
+    digest.update (git_output (['diff', 'HEAD', '--submodule=diff', '--', '.'] + excludes, repo_dir).encode())
+    for path in git_output (['ls-files', '--others', '--exclude-standard', '--', '.'] + excludes, repo_dir).splitlines():
+        path = os.path.join (repo_dir, path)
+        if os.path.isfile (path):
+            digest.update (('%s:%s' % (path, get_file_hash (path))).encode())
+    return '%s-dirty-%s' % (commit, digest.hexdigest())
+
+
+def gen_upld_info (out_dir, image_id):
+    info_file = '%s/upld_info_%s.bin' % (out_dir, image_id)
+    upld_info_hdr = UPLD_INFO_HEADER()
+    upld_info_hdr.ImageId = image_id.encode()[:16]
+    with open (info_file, 'wb') as fd:
+        fd.write (bytearray(upld_info_hdr))
+    return info_file
+
+
+def get_uboot_sections (info_file):
+    return [
+      ('.upld_info',    info_file,                   16),
     ]
 
-    test_cnt = 0
-    for test_file, test_args, upld_img in test_cases:
-        if test_pat:
-            filtered = fnmatch.filter([upld_img.lower()], test_pat)
-            if len(filtered) == 0:
-                continue
 
-        print ('######### Running run test %s' % test_file)
-        # create new IFWI using the upld
-        cmd = [ sys.executable, 'Script/upld_swap.py', '-i', sbl_img, '-p', 'Outputs/%s' % upld_img, '-o', out_dir]
-        run_process (cmd)
+def get_linux_sections (info_file):
+    return [
+      ('.upld.initrd',  'LinuxBins/initrd',        4096),
+      ('.upld.cmdline', 'LinuxBins/config.cfg',      16),
+      ('.upld.kernel',  'LinuxBins/vmlinuz',        256),
+      ('.upld_info',    info_file,                   16),
+    ]
 
-        # run QEMU test cases
-        cmd = [ sys.executable, 'Script/%s' % test_file] + test_args
-        try:
-            output = subprocess.run (cmd)
-            output.check_returncode()
-        except subprocess.CalledProcessError:
-            print ('Failed to run test %s !' % test_file)
-            return -3
-        print ('######### Completed test %s\n\n' % test_file)
-        test_cnt += 1
-
-    print ('\nAll %d test cases passed !\n' % test_cnt)
 
-    return 0
+def get_uefi_sections (info_file, fv_file):
+    return [
+      ('.upld_info',    info_file,                   16),
+      ('.upld.uefi_fv', fv_file,                   4096),
+    ]
 
 
-def build_sbl_images (dir_dict):
-    out_dir = dir_dict['out_dir']
+def inject_sections (dir_dict, name, src_file, elf_file, sections):
+    # Copy the raw payload and add the UPLD sections, the result only
+    # depends on the section layout and the section contents.
+    def inject ():
+        shutil.copy (src_file, elf_file)
+        add_sections (elf_file, sections)
+        return 0
+
+    inputs = [src_file] + ['%s=%s:%d' % sec for sec in sections] + [sec[1] for sec in sections]
+    return run_cached (dir_dict['cache'], name, inputs, [elf_file], inject)
+
+
+def get_sbl_tasks (dir_dict):
     sbl_dir = dir_dict['sbl_dir']
+    sbl_img = '%s/Outputs/qemu/SlimBootloader.bin' % sbl_dir
 
-    clone_repo  (sbl_dir, 'https://github.com/universalpayload/slimbootloader.git', 'universal_payload')
-    shutil.copy ('QemuFspBins/Fsp.bsf', '%s/Silicon/QemuSocPkg/FspBin/Fsp.bsf' % sbl_dir)
-    shutil.copy ('QemuFspBins/FspRel.bin', '%s/Silicon/QemuSocPkg/FspBin/FspRel.bin' % sbl_dir)
+    def clone ():
+        clone_repo  (sbl_dir, *SBL_REPO, ignore = FSP_DEST)
+        return 0
 
     # Build SBL
-    cmd = 'python BuildLoader.py build qemu -k'
-    ret = subprocess.call(cmd.split(' '), cwd=sbl_dir)
-    if ret:
-        fatal ('Failed to build SBL!')
+    cmd = 'BuildLoader.py build qemu -k'
 
-    return 0
+    def build ():
+        for src, dst in zip(FSP_BINS, FSP_DEST):
+            shutil.copy (src, os.path.join (sbl_dir, dst))
+        ret = traced_call ([get_tool ('python')] + cmd.split(' '), cwd=sbl_dir)
+        if ret:
+            fatal ('Failed to build SBL!')
+        return 0
 
-def build_linux_images (dir_dict):
+    def cached_build ():
+        inputs = [get_repo_state (sbl_dir, FSP_DEST), cmd] + FSP_BINS
+        return run_cached (dir_dict['cache'], 'sbl', inputs, [sbl_img], build)
+
+    return [
+      Task ('sbl_clone', clone, outputs = [sbl_dir]),
+      Task ('sbl', cached_build, inputs = [sbl_dir, 'QemuFspBins/Fsp.bsf', 'QemuFspBins/FspRel.bin'], outputs = [sbl_img]),
+    ]
+
+
+def get_linux_tasks (dir_dict):
     out_dir = dir_dict['out_dir']
     sbl_dir = dir_dict['sbl_dir']
-    objcopy = dir_dict['objcopy_path']
+    bld_dir = '%s/Build' % out_dir
 
-    # Build Linux Payload 32
-    cmd = 'python BuildLoader.py build_dsc -p UniversalPayloadPkg/UniversalPayloadPkg.dsc'
-    ret = subprocess.call(cmd.split(' '), cwd=sbl_dir)
-    if ret:
-        fatal ('Failed to build Linux Payload 32!')
-    shutil.copy ('%s/Build/UniversalPayloadPkg/DEBUG_GCC5/IA32/UniversalPayloadPkg/LinuxLoaderStub/LinuxLoaderStub/DEBUG/LinuxLoaderStub.dll' % sbl_dir, '%s/LinuxPld32.elf' % out_dir)
+    tasks = []
+    for target in ['32', '64']:
+        arch = 'IA32' if target == '32' else 'X64'
+        stub = '%s/LinuxLoaderStub%s.dll' % (bld_dir, target)
+        pld  = '%s/LinuxPld%s.elf' % (out_dir, target)
 
-    # Inject sections
-    cmd = 'python Script/upld_info.py %s/upld_info.bin Linux32' % out_dir
-    run_process (cmd.split(' '))
-    cmd = objcopy + " -I elf32-i386 -O elf32-i386 --add-section .upld.initrd=LinuxBins/initrd --add-section .upld.cmdline=LinuxBins/config.cfg --add-section .upld.kernel=LinuxBins/vmlinuz --add-section .upld_info=%s/upld_info.bin %s/LinuxPld32.elf" % (out_dir, out_dir)
-    run_process (cmd.split(' '))
-    cmd = objcopy + " -I elf32-i386 -O elf32-i386 --set-section-alignment .upld.kernel=256 --set-section-alignment .upld.initrd=4096 --set-section-alignment .upld.cmdline=16 --set-section-alignment .upld.info=16 %s/LinuxPld32.elf" % (out_dir)
-    run_process (cmd.split(' '))
-
-    # Build Linux Payload 64
-    cmd = 'python BuildLoader.py build_dsc -a x64 -p UniversalPayloadPkg/UniversalPayloadPkg.dsc'
-    ret = subprocess.call(cmd.split(' '), cwd=sbl_dir)
-    if ret:
-        fatal ('Failed to build Linux Payload 64!')
-    shutil.copy ('%s/Build/UniversalPayloadPkg/DEBUG_GCC5/X64/UniversalPayloadPkg/LinuxLoaderStub/LinuxLoaderStub/DEBUG/LinuxLoaderStub.dll' % sbl_dir, '%s/LinuxPld64.elf' % out_dir)
+        # Build Linux Payload
+        cmd = 'BuildLoader.py build_dsc -p UniversalPayloadPkg/UniversalPayloadPkg.dsc'
+        if target == '64':
+            cmd += ' -a x64'
 
-    # Inject sections
-    cmd = 'python Script/upld_info.py %s/upld_info.bin Linux64' % out_dir
-    run_process (cmd.split(' '))
-    cmd = objcopy + " -I elf64-x86-64 -O elf64-x86-64 --add-section .upld.initrd=LinuxBins/initrd --add-section .upld.cmdline=LinuxBins/config.cfg --add-section .upld.kernel=LinuxBins/vmlinuz --add-section .upld_info=%s/upld_info.bin %s/LinuxPld64.elf" % (out_dir, out_dir)
-    run_process (cmd.split(' '))
-    cmd = objcopy + " -I elf64-x86-64 -O elf64-x86-64 --set-section-alignment .upld.kernel=256 --set-section-alignment .upld.initrd=4096 --set-section-alignment .upld.cmdline=16 --set-section-alignment .upld.info=16 %s/LinuxPld64.elf" % (out_dir)
-    run_process (cmd.split(' '))
+        def build (cmd = cmd, arch = arch, stub = stub, target = target):
+            ret = traced_call ([get_tool ('python')] + cmd.split(' '), cwd=sbl_dir)
+            if ret:
+                fatal ('Failed to build Linux Payload %s!' % target)
+            create_dirs ([bld_dir])
+            shutil.copy ('%s/Build/UniversalPayloadPkg/DEBUG_GCC5/%s/UniversalPayloadPkg/LinuxLoaderStub/LinuxLoaderStub/DEBUG/LinuxLoaderStub.dll' % (sbl_dir, arch), stub)
+            return 0
 
-    return 0
+        def cached_build (cmd = cmd, stub = stub, target = target, build = build):
+            return run_cached (dir_dict['cache'], 'linux_stub_%s' % target, [get_repo_state (sbl_dir, FSP_DEST), cmd], [stub], build)
+
+        # Inject sections
+        def inject (stub = stub, pld = pld, target = target):
+            info_file = gen_upld_info (out_dir, 'Linux%s' % target)
+            return inject_sections (dir_dict, 'linux_%s' % target, stub, pld, get_linux_sections (info_file))
+
+        # The stub build shares the SlimBoot workspace with the SBL build
+        tasks.extend ([
+          Task ('linux_stub_%s' % target, cached_build, deps = ['sbl'], inputs = [sbl_dir], outputs = [stub]),
+          Task ('linux_%s' % target, inject, inputs = [stub, 'LinuxBins'], outputs = [pld]),
+        ])
+
+    return tasks
 
 
-def build_uboot_images (dir_dict):
+def get_uboot_tasks (dir_dict):
     out_dir = dir_dict['out_dir']
-    objcopy = dir_dict['objcopy_path']
+    bld_dir = '%s/Build' % out_dir
+    uboot   = '%s/UbootPld.elf' % bld_dir
+    pld     = '%s/UbootPld.elf' % out_dir
 
     # Copy u-boot image
-    shutil.copy ('UbootBin/u-boot', '%s/UbootPld.elf' % out_dir)
-    cmd = 'strip --strip-unneeded %s/UbootPld.elf' % out_dir
-    run_process (cmd.split(' '))
+    def build ():
+        create_dirs ([bld_dir])
+        shutil.copy ('UbootBin/u-boot', uboot)
+        run_process ([get_tool ('strip'), '--strip-unneeded', uboot])
+        return 0
 
-    # Inject sections
-    cmd = 'python Script/upld_info.py %s/upld_info.bin u-boot' % out_dir
-    run_process (cmd.split(' '))
-
-    cmd = objcopy + " -I elf32-i386 -O elf32-i386 --add-section .upld_info=%s/upld_info.bin %s/UbootPld.elf" % (out_dir, out_dir)
-    run_process (cmd.split(' '))
-    cmd = objcopy + " -I elf32-i386 -O elf32-i386 --set-section-alignment .upld_info=16 %s/UbootPld.elf" % (out_dir)
-    run_process (cmd.split(' '))
+    def cached_build ():
+        return run_cached (dir_dict['cache'], 'uboot_strip', ['UbootBin/u-boot', 'strip --strip-unneeded'], [uboot], build)
 
-    return 0
+    # Inject sections
+    def inject ():
+        info_file = gen_upld_info (out_dir, 'u-boot')
+        return inject_sections (dir_dict, 'uboot', uboot, pld, get_uboot_sections (info_file))
 
+    return [
+      Task ('uboot_strip', cached_build, inputs = ['UbootBin/u-boot'], outputs = [uboot]),
+      Task ('uboot', inject, inputs = [uboot], outputs = [pld]),
+    ]
 
 
-def build_uefi_images (dir_dict):
+def get_uefi_tasks (dir_dict):
     out_dir  = dir_dict['out_dir']
     uefi_dir = dir_dict['uefi_dir']
-    objcopy  = dir_dict['objcopy_path']
-    clone_repo  (uefi_dir, 'https://github.com/universalpayload/edk2.git', 'upld_elf')
+    bld_dir  = '%s/Build' % out_dir
+
+    def clone ():
+        clone_repo  (uefi_dir, *UEFI_REPO)
+        return 0
+
+    tasks = [Task ('uefi_clone', clone, outputs = [uefi_dir])]
 
     # Build UEFI
     for target in ['32', '64']:
-        cmd = 'python BuildPayload.py build'
+        cmd = 'BuildPayload.py build'
         if target == '64':
             cmd += ' -a x64'
-            fmt  = 'elf64-x86-64'
-        else:
-            fmt  = 'elf32-i386'
-        ret = subprocess.call(cmd.split(' '), cwd=uefi_dir)
-        if ret:
-            fatal ('Failed to build SBL!')
-        shutil.copy ('%s/Build/UefiPayloadPkg/DEBUG_GCC5/FV/UefiPld%s.elf' % (uefi_dir, target),  '%s/UefiPld%s.elf' % (out_dir, target))
-        shutil.copy ('%s/Build/UefiPayloadPkg/DEBUG_GCC5/FV/DXEFV.Fv' % uefi_dir,  '%s/DXEFV%s.fv' % (out_dir, target))
+        uefi_elf = '%s/UefiPld%s.elf' % (bld_dir, target)
+        uefi_fv  = '%s/DXEFV%s.fv' % (out_dir, target)
+        pld      = '%s/UefiPld%s.elf' % (out_dir, target)
+
+        def build (cmd = cmd, uefi_elf = uefi_elf, uefi_fv = uefi_fv, target = target):
+            ret = traced_call ([get_tool ('python')] + cmd.split(' '), cwd=uefi_dir)
+            if ret:
+                fatal ('Failed to build UEFI Payload %s!' % target)
+            create_dirs ([bld_dir])
+            shutil.copy ('%s/Build/UefiPayloadPkg/DEBUG_GCC5/FV/UefiPld%s.elf' % (uefi_dir, target),  uefi_elf)
+            shutil.copy ('%s/Build/UefiPayloadPkg/DEBUG_GCC5/FV/DXEFV.Fv' % uefi_dir,  uefi_fv)
+            return 0
+
+        def cached_build (cmd = cmd, uefi_elf = uefi_elf, uefi_fv = uefi_fv, target = target, build = build):
+            return run_cached (dir_dict['cache'], 'uefi_build_%s' % target, [get_repo_state (uefi_dir), cmd], [uefi_elf, uefi_fv], build)
 
         # Inject sections
-        cmd = 'python Script/upld_info.py %s/upld_info.bin UEFI%s' % (out_dir, target)
-        run_process (cmd.split(' '))
-        bin_fmt = " -I %s -O %s" % (fmt, fmt)
-        cmd = objcopy + bin_fmt + " --add-section .upld_info=%s/upld_info.bin --add-section .upld.uefi_fv=%s/DXEFV32.fv %s/UefiPld%s.elf" % (out_dir, out_dir, out_dir, target)
-        run_process (cmd.split(' '))
-        cmd = objcopy + bin_fmt + " --set-section-alignment .upld.info=16 --set-section-alignment .upld.uefi_fv=4096 %s/UefiPld%s.elf" % (out_dir, target)
-        run_process (cmd.split(' '))
+        def inject (uefi_elf = uefi_elf, uefi_fv = uefi_fv, pld = pld, target = target):
+            info_file = gen_upld_info (out_dir, 'UEFI%s' % target)
+            return inject_sections (dir_dict, 'uefi_%s' % target, uefi_elf, pld, get_uefi_sections (info_file, uefi_fv))
+
+        # Both UEFI builds use the same FV output directory, so they can not overlap
+        deps = ['uefi_build_32'] if target == '64' else []
+        tasks.extend ([
+          Task ('uefi_build_%s' % target, cached_build, deps = deps, inputs = [uefi_dir], outputs = [uefi_elf, uefi_fv]),
+          Task ('uefi_%s' % target, inject, inputs = [uefi_elf, uefi_fv], outputs = [pld]),
+        ])
+
+    return tasks
+
+
+def get_build_tasks (dir_dict):
+    return get_uboot_tasks (dir_dict) + get_sbl_tasks (dir_dict) + get_linux_tasks (dir_dict) + get_uefi_tasks (dir_dict)
+
+
+def get_watch_map (tasks, test_cases, out_dir):
+    # Map each build input to the payload images and test cases it feeds
+    produced = set(output for task in tasks for output in task.outputs)
+    sources  = sorted(set(item for task in tasks for item in task.inputs))
+    watch_map = {}
+    for source in sources:
+        outputs = set(output for task in get_affected_tasks (tasks, [source]) for output in task.outputs)
+        names   = [case['name'] for case in test_cases
+                   if os.path.join (out_dir, case['payload']) in outputs or case['ifwi'] in outputs]
+        watch_map[source] = (sorted(output for output in outputs if os.path.dirname (output) == out_dir), names)
+    return watch_map, [source for source in sources if source not in produced]
+
+
+def watch (dir_dict, args, cache_dir, console = None):
+    # Rebuild and retest only what depends on the changed inputs. Test cases
+    # run in this process so that the SlimBoot tool modules stay loaded.
+    out_dir   = dir_dict['out_dir']
+    repo_dirs = [dir_dict['sbl_dir'], dir_dict['uefi_dir']]
+    try:
+        import upld_swap
+        upld_swap.load_swap_tools ()
+    except ImportError as ex:
+        print ('SlimBoot tools are not loaded yet: %s' % ex)
+
+    tasks      = get_build_tasks (dir_dict)
+    test_cases = get_test_cases (args.test, args.profile, args.matrix)
+    watch_map, paths = get_watch_map (tasks, test_cases, out_dir)
+    print ('\n%-40s %s' % ('Input', 'Payloads / Tests'))
+    for source in paths + repo_dirs:
+        images, names = watch_map.get (source, ([], []))
+        print ('%-40s %s' % (source, ' '.join (images + names) or '-'))
 
+    disk_dir = 'Disk'
+    watcher  = InputWatcher (paths + [disk_dir, args.matrix], repo_dirs, {dir_dict['sbl_dir'] : FSP_DEST})
+    print ('\nWatching %d inputs for changes, press Ctrl+C to stop ...' % (len(paths) + len(repo_dirs) + 2))
+    sys.stdout.flush()
+
+    try:
+        while True:
+            changed = watcher.wait ()
+            begin   = time.time()
+            print ('\n######### Changed: %s' % ' '.join (changed))
+
+            tasks      = get_build_tasks (dir_dict)
+            test_cases = get_test_cases (args.test, args.profile, args.matrix)
+            if disk_dir in changed or args.matrix in changed:
+                names = [case['name'] for case in test_cases]
+            else:
+                names = []
+
+            affected = get_affected_tasks (tasks, changed)
+            if affected:
+                done = [task.name for task in tasks if task not in affected]
+                if run_tasks (affected, args.build_jobs, done):
+                    print ('######### Build failed, waiting for changes ...')
+                    watcher.reset ()
+                    continue
+                outputs = set(output for task in affected for output in task.outputs)
+                names  += [case['name'] for case in test_cases if case['name'] not in names and
+                           (os.path.join (out_dir, case['payload']) in outputs or case['ifwi'] in outputs)]
+
+            if names:
+                ret = qemu_test (args.test, 1, cache_dir, args.profile, args.matrix, names = names, console = console)
+                print ('######### %s in %.1f seconds, waiting for changes ...' % ('FAILED' if ret else 'PASSED', time.time() - begin))
+            else:
+                print ('######### No payload affected, waiting for changes ...')
+            watcher.reset ()
+            sys.stdout.flush()
+    except KeyboardInterrupt:
+        pass
+
+    return 0
+
+
+def get_artifact_groups (dir_dict):
+    # (repo dir, (repo url, branch), clone task, {build task : extra inputs}, files the build writes)
+    # The clone task is skipped when all outputs of the repo are restored.
+    # SlimBoot also holds the tools for the payload swap, it is always cloned.
+    return [
+      (dir_dict['sbl_dir'],  SBL_REPO,  None,         {'sbl' : FSP_BINS, 'linux_stub_32' : [], 'linux_stub_64' : []}, FSP_DEST),
+      (dir_dict['uefi_dir'], UEFI_REPO, 'uefi_clone', {'uefi_build_32' : [], 'uefi_build_64' : []}, []),
+    ]
+
+
+def restore_outputs (stage_dir, outputs):
+    # Move restored outputs from the stage directory into place
+    for output in outputs:
+        out_dir = os.path.dirname (output)
+        if out_dir and not os.path.exists (out_dir):
+            os.makedirs (out_dir)
+        shutil.move (os.path.join (stage_dir, output), output)
     return 0
 
+
+def fetch_artifacts (artifacts, dir_dict, tasks, stage_dir):
+    # Restore build outputs from the artifact cache. Return the tasks that
+    # do not need to run, and the missed artifacts to upload after the build.
+    # Outputs inside a repo would stop its clone, so the artifacts go into
+    # stage_dir and the build task moves them into place instead of building.
+    tasks   = dict((task.name, task) for task in tasks)
+    done    = []
+    missed  = []
+    for repo_dir, (repo, branch), clone_task, builds, ignore in get_artifact_groups (dir_dict):
+        # local edits are built locally, the artifacts are for the clean commit
+        if os.path.exists (os.path.join (repo_dir, '.git')) and get_repo_changes (repo_dir, ignore):
+            print ('Repo %s has local changes, not using the artifact cache' % repo_dir)
+            continue
+        commit = get_remote_commit (repo, branch)
+        if not commit:
+            print ('Failed to find branch %s in repo %s, building %s locally' % (branch, repo, repo_dir))
+            continue
+        hits = 0
+        for name, inputs in builds.items():
+            key     = get_artifact_key (name, repo, commit, inputs)
+            outputs = tasks[name].outputs
+            if artifacts.fetch (key, outputs, stage_dir):
+                print ('Restored %s from artifact cache' % name)
+                tasks[name].func = lambda outputs = outputs: restore_outputs (stage_dir, outputs)
+                hits += 1
+            else:
+                missed.append ((repo_dir, commit, key, outputs, ignore))
+        # no need to clone the repo when all its outputs are restored
+        if clone_task and hits == len(builds):
+            done.append (clone_task)
+    return done, missed
+
+
+def upload_artifacts (artifacts, missed):
+    for repo_dir, commit, key, outputs, ignore in missed:
+        # the branch may have moved between the lookup and the clone, and
+        # outputs of a tree with local changes must not go under its key
+        if get_repo_commit (repo_dir) != commit or not all(os.path.exists (output) for output in outputs):
+            continue
+        if get_repo_changes (repo_dir, ignore):
+            print ('Repo %s has local changes, not uploading %s' % (repo_dir, ' '.join (outputs)))
+            continue
+        if artifacts.upload (key, outputs):
+            print ('Uploaded %s to artifact cache' % ' '.join (outputs))
+
+
 def main ():
     dir_dict = {
                   'out_dir'      : 'Outputs',
                   'sbl_dir'      : 'SlimBoot',
                   'uefi_dir'     : 'UefiPayload',
-                  'objcopy_path' : get_objcopy(),
                }
 
     arg_parse  = argparse.ArgumentParser()
     arg_parse.add_argument('-sb',   dest='skip_build', action='store_true', help='Specify name pattern for payloads to be built')
     arg_parse.add_argument('-t',   dest='test',  type=str, help='Specify name pattern for payloads to be tested', default = '')
+    arg_parse.add_argument('-j',   dest='jobs',  type=int, help='Specify number of test cases to run in parallel', default = 1)
+    arg_parse.add_argument('-q',   dest='profile', type=str, help='Specify QEMU launch profile for all test cases', default = '')
+    arg_parse.add_argument('-m',   dest='matrix', type=str, help='Specify test matrix file', default = 'test_matrix.json')
+    arg_parse.add_argument('--shard', dest='shard', type=str, help='Run only shard i of N of the test matrix, in format i/N', default = '')
+    arg_parse.add_argument('-r',   dest='result_file', type=str, help='Specify file to save test results into', default = '')
+    arg_parse.add_argument('--merge', dest='merge', nargs='+', help='Merge per-shard test result files into one report')
+    arg_parse.add_argument('--history', dest='history_db', type=str, help='Specify test history database, empty to disable', default = HISTORY_DB)
+    arg_parse.add_argument('-bj',  dest='build_jobs', type=int, help='Specify number of build tasks to run in parallel', default = 1)
+    arg_parse.add_argument('-c',   dest='cache_dir', type=str, help='Specify cache directory for build outputs, swapped IFWI images and disk images', default = 'Cache')
+    arg_parse.add_argument('-w', '--watch', dest='watch', action='store_true', help='Keep running, rebuild and retest the payloads affected by changed inputs')
+    arg_parse.add_argument('-au',  dest='artifact_url', type=str, help='Specify shared HTTP store for SBL and UEFI build artifacts', default = os.environ.get ('UPLD_ARTIFACT_URL', ''))
+    arg_parse.add_argument('-ad',  dest='artifact_dir', type=str, help='Specify local or network directory for SBL and UEFI build artifacts', default = os.environ.get ('UPLD_ARTIFACT_DIR', ''))
+    arg_parse.add_argument('--profile', dest='trace_file', nargs='?', const='Outputs/trace.json', default = '',
+                           help='Trace all stages and processes into a Chrome trace file, default Outputs/trace.json')
+    arg_parse.add_argument('--record', dest='record_dir', type=str, help='Record the console output of each test case into this directory', default = '')
+    arg_parse.add_argument('--replay', dest='replay_dir', type=str, help='Replay recorded console output instead of building and booting', default = '')
+    arg_parse.add_argument('--replay-speed', dest='replay_speed', type=float, help='Console replay speed factor, 0 for no delay', default = 1.0)
+    arg_parse.add_argument('-nc',  dest='no_cache', action='store_true', help='Disable all caches')
     args = arg_parse.parse_args()
 
+    console = None
+    if args.replay_dir and args.watch:
+        print ('Watch mode rebuilds and boots the payloads, it can not be used with --replay !')
+        return 1
+    if args.replay_dir:
+        # replayed runs need no build and do not belong in the test history
+        console = {'mode' : 'replay', 'dir' : args.replay_dir, 'speed' : args.replay_speed}
+        args.skip_build = True
+        args.history_db = ''
+    elif args.record_dir:
+        console = {'mode' : 'record', 'dir' : args.record_dir}
+
+    dir_dict['cache'] = None if args.no_cache else BuildCache (os.path.join (args.cache_dir, 'Build'))
+
+    if args.trace_file:
+        start_profile (args.trace_file, 'upld_test')
+
     if os.name != 'posix':
         fatal ('Only Linux is supported!')
 
+    if args.merge:
+        return 0 if merge_test_results (args.merge, args.result_file, args.matrix) == 0 else 5
+
     if not os.path.exists(dir_dict['out_dir']):
         os.mkdir(dir_dict['out_dir'])
 
     if not args.skip_build:
-        if build_uboot_images (dir_dict):
-            return 1
-
-        if build_sbl_images (dir_dict):
-            return 2
-
-        if build_linux_images (dir_dict):
-            return 3
-
-        if build_uefi_images (dir_dict):
-            return 4
-
-    if qemu_test (args.test):
-        return 5
+        tasks     = get_build_tasks (dir_dict)
+        done      = []
+        missed    = []
+        artifacts = None
+        if not args.no_cache and (args.artifact_url or args.artifact_dir):
+            artifacts = ArtifactCache (args.artifact_url, args.artifact_dir)
+        # next to the outputs, so that restoring them is a rename
+        with tempfile.TemporaryDirectory (prefix = 'upld_art_', dir = dir_dict['out_dir']) as stage_dir:
+            if artifacts:
+                with span ('fetch artifacts'):
+                    done, missed = fetch_artifacts (artifacts, dir_dict, tasks, stage_dir)
+            with span ('build'):
+                if run_tasks ([task for task in tasks if task.name not in done], args.build_jobs, done):
+                    return 1
+        if artifacts:
+            with span ('upload artifacts'):
+                upload_artifacts (artifacts, missed)
+
+    cache_dir = '' if args.no_cache else args.cache_dir
+    if args.watch:
+        return watch (dir_dict, args, cache_dir, console)
+
+    with span ('test'):
+        if qemu_test (args.test, args.jobs, cache_dir, args.profile, args.matrix, args.shard, args.result_file, history_db = args.history_db,
+                      console = console):
+            return 5
 
     return 0
 